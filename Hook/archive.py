@@ -0,0 +1,86 @@
+""" Cold archive of old tests
+
+Tests older than a given age are moved, usually through the `flask hook-archive` command, from the RepoTest, UnitTest
+and WordCount tables to the ArchivedTest table, where each test is a single row. The hot tables and their indexes only
+grow with recent activity, while Repository.get_test and Repository.history still read archived tests.
+
+The last master test of a repository, and every test its units are rebuilt from, are never archived : they are needed
+for the next diff and for the badges.
+"""
+import datetime
+
+
+class ArchivePolicy(object):
+    """ Rules deciding which tests are archived
+
+    :param days: Age in days after which tests are archived, None to keep every test in the hot tables
+    :param batch_size: Number of tests archived per transaction
+    """
+    def __init__(self, days=None, batch_size=100):
+        self.days = days
+        self.batch_size = batch_size
+
+    def apply(self, db, models, now=None, progress=None):
+        """ Move the tests older than the policy allows to the archive
+
+        :param db: Flask SQLAlchemy Database instance
+        :param models: Models of the extension
+        :param now: Reference date of the ages, defaults to the current UTC date
+        :param progress: Callable receiving a message after each batch
+        :return: Number of archived tests
+        :rtype: int
+        """
+        if self.days is None:
+            return 0
+        now = now or datetime.datetime.utcnow()
+        cutoff = now - datetime.timedelta(days=self.days)
+        progress = progress or (lambda message: None)
+        RepoTest = models.RepoTest
+        archived = 0
+
+        for repo in models.Repository.query.order_by(models.Repository.uuid).all():
+            masters = db.session.query(RepoTest.uuid, RepoTest.run_at).filter(
+                RepoTest.repository == repo.uuid, RepoTest.source == repo.main_branch
+            ).order_by(RepoTest.run_at.desc()).all()
+            protected = set()
+            for index, (uuid, run_at) in enumerate(masters):
+                if (index == 0 or run_at >= cutoff) and uuid not in protected:
+                    protected.update(RepoTest.query.get(uuid).snapshot_chain())
+
+            # The latest tests go first, so that a delta is always archived before the tests it is rebuilt from
+            old = db.session.query(RepoTest.uuid).filter(RepoTest.repository == repo.uuid, RepoTest.run_at < cutoff)
+            if protected:
+                old = old.filter(~RepoTest.uuid.in_(protected))
+            old = old.order_by(RepoTest.run_at.desc(), RepoTest.uuid.desc())
+            before = archived
+            while True:
+                ids = [row[0] for row in old.limit(self.batch_size)]
+                if not ids:
+                    break
+                self.archive(db, models, ids)
+                archived += len(ids)
+                progress("{}: {} tests archived".format(repo.full_name, archived))
+            if archived > before:
+                models.LatestTest.rebuild(repo.uuid)
+                db.session.commit()
+        return archived
+
+    @staticmethod
+    def archive(db, models, ids):
+        """ Move some tests to the archive in a single transaction
+
+        :param db: Flask SQLAlchemy Database instance
+        :param models: Models of the extension
+        :param ids: Identifiers of the tests
+        """
+        for test in models.RepoTest.query.filter(models.RepoTest.uuid.in_(ids)).all():
+            db.session.add(models.ArchivedTest.from_test(test))
+            db.session.expunge(test)
+        db.session.flush()
+
+        for model in (models.UnitTest, models.WordCount, models.CommentOutbox, models.LatestTest):
+            model.query.filter(model.test_id.in_(ids)).delete(synchronize_session=False)
+        models.IngestJob.query.filter(models.IngestJob.test_id.in_(ids)).\
+            update({"test_id": None}, synchronize_session=False)
+        models.RepoTest.query.filter(models.RepoTest.uuid.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
@@ -0,0 +1,103 @@
+""" Small key-value caches with a time to live
+
+Backends only need a `get(key)` method returning None for missing or expired keys and a `set(key, value, ttl)`
+method. MemoryCache is shared by the threads of a process, DatabaseCache by every process using the same database.
+"""
+import datetime
+import json
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+from sqlalchemy.exc import IntegrityError
+
+
+class MemoryCache(object):
+    """ Thread-safe least recently used cache whose entries expire
+
+    :param size: Maximum number of entries
+    """
+    def __init__(self, size=1024):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        """ Get a value
+
+        :param key: Key of the value
+        :return: Value or None if the key is unknown or expired
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        """ Store a value
+
+        :param key: Key of the value
+        :param value: Value
+        :param ttl: Time to live in seconds
+        """
+        with self.lock:
+            self.entries[key] = (value, monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+class DatabaseCache(object):
+    """ Cache stored in the CacheEntry table, values being serialized as json
+
+    Entries are read and written in their own transaction, outside of the session of the caller, so that caching
+    never commits nor rolls back the work in progress of an ingest.
+
+    :param db: Flask SQLAlchemy Database instance
+    :param model: CacheEntry model
+    """
+    def __init__(self, db, model):
+        self.db = db
+        self.model = model
+
+    def get(self, key):
+        """ Get a value
+
+        :param key: Key of the value
+        :return: Value or None if the key is unknown or expired
+        """
+        table = self.model.__table__
+        with self.db.engine.connect() as connection:
+            entry = connection.execute(
+                self.db.select([table.c.value, table.c.expires_at]).where(table.c.key == key)
+            ).first()
+        if entry is None or entry.expires_at <= datetime.datetime.utcnow():
+            return None
+        return json.loads(entry.value)
+
+    def set(self, key, value, ttl):
+        """ Store a value
+
+        :param key: Key of the value
+        :param value: Json serializable value
+        :param ttl: Time to live in seconds
+        """
+        table = self.model.__table__
+        entry = {
+            "value": json.dumps(value),
+            "expires_at": datetime.datetime.utcnow() + datetime.timedelta(seconds=ttl)
+        }
+        try:
+            with self.db.engine.begin() as connection:
+                updated = connection.execute(table.update().where(table.c.key == key), entry).rowcount
+                if updated == 0:
+                    connection.execute(table.insert(), dict(entry, key=key))
+        except IntegrityError:
+            # Another process cached the same key in the meantime, its value is as fresh as ours
+            pass
@@ -0,0 +1,96 @@
+""" Comparison of the units of a test with the units of a former test
+
+Units are compared in a single pass, while they are read from the report. The same comparison gives the rows of a
+unit delta (see RepoTest.stream_delta) and the Units part of RepoTest.diff, so that the units of the former test are
+copied and looked up only once per ingest. Paths are looked up in a dictionary rather than merged as sorted arrays :
+in Python, sorting both sides costs more than the lookups it saves, see benchmarks/diff.py.
+"""
+from operator import itemgetter
+
+
+MISSING = object()
+
+
+class UnitDiff(object):
+    """ Differences between units and the units of a former test
+
+    :param former_units: Units of the former test
+    :type former_units: dict
+    :param copy: Copy former_units instead of emptying it as units are compared
+    """
+    def __init__(self, former_units, copy=True):
+        self.remaining = dict(former_units) if copy else former_units
+        self.new = []
+        self.changed = []
+
+    def compare(self, units):
+        """ Compare units while passing them through
+
+        :param units: Iterable of (Path, Status) pairs, each path appearing once
+        :return: Generator of (Path, Status, Changed) triples, Changed being True for new units and for units whose \
+        status changed
+        """
+        pop, new, changed = self.remaining.pop, self.new.append, self.changed.append
+        for path, status in units:
+            former = pop(path, MISSING)
+            if former is MISSING:
+                new(path)
+                changed((path, status))
+                yield path, status, True
+            elif former != status:
+                changed((path, status))
+                yield path, status, True
+            else:
+                yield path, status, False
+
+    def track(self, units):
+        """ Compare units while passing them through
+
+        :param units: Iterable of (Path, Status) pairs, each path appearing once
+        :return: Generator of the same (Path, Status) pairs
+        """
+        pop, new, changed = self.remaining.pop, self.new.append, self.changed.append
+        for path, status in units:
+            former = pop(path, MISSING)
+            if former is MISSING:
+                new(path)
+                changed((path, status))
+            elif former != status:
+                changed((path, status))
+            yield path, status
+
+    def consume(self, units):
+        """ Compare units at once
+
+        :param units: Dictionary Path->Status or iterable of (Path, Status) pairs
+        :return: Itself
+        :rtype: UnitDiff
+        """
+        if isinstance(units, dict):
+            units = units.items()
+        pop, new, changed = self.remaining.pop, self.new.append, self.changed.append
+        for path, status in units:
+            former = pop(path, MISSING)
+            if former is MISSING:
+                new(path)
+                changed((path, status))
+            elif former != status:
+                changed((path, status))
+        return self
+
+    @property
+    def deleted(self):
+        """ Units of the former test which were not compared, once the units are exhausted
+
+        :rtype: dict
+        """
+        return self.remaining
+
+    def categories(self):
+        """ Sorted differences
+
+        :return: New paths, deleted paths and (Path, Status) pairs of the new units and of the units whose status \
+        changed, each sorted by path
+        :rtype: ([str], [str], [(str, bool)])
+        """
+        return sorted(self.new), sorted(self.remaining), sorted(self.changed, key=itemgetter(0))
@@ -1,4 +1,6 @@
-from werkzeug.exceptions import Forbidden
+from werkzeug.exceptions import (
+    Forbidden, BadRequest, Conflict, RequestEntityTooLarge, TooManyRequests, InternalServerError
+)
 
 
 class ModelException(Exception):
@@ -14,3 +16,46 @@ class ModelException(Exception):
 
 class RightsException(ModelException, Forbidden):
     status_code = 403
+
+
+class InvalidPayload(ModelException, BadRequest):
+    status_code = 400
+
+
+class PayloadTooLarge(ModelException, RequestEntityTooLarge):
+    status_code = 413
+
+
+class DuplicateTest(ModelException, Conflict):
+    status_code = 409
+
+    def __init__(self, message, test, diff=None, status_code=None, payload=None):
+        super(DuplicateTest, self).__init__(message, status_code=status_code, payload=payload)
+        self.test = test
+        self.diff = diff
+
+
+class BrokenSnapshot(ModelException, InternalServerError):
+    status_code = 500
+
+    def __init__(self, message, test, missing, status_code=None, payload=None):
+        super(BrokenSnapshot, self).__init__(message, status_code=status_code, payload=payload)
+        self.test = test
+        self.missing = missing
+
+
+class TooBusy(ModelException, TooManyRequests):
+    status_code = 429
+
+    def __init__(self, message, retry_after=1, status_code=None, payload=None):
+        super(TooBusy, self).__init__(message, status_code=status_code, payload=payload)
+        self.retry_after = retry_after
+
+    def get_headers(self, environ=None):
+        headers = [
+            (key, value)
+            for key, value in super(TooBusy, self).get_headers(environ)
+            if key != "Retry-After"
+        ]
+        headers.append(("Retry-After", str(self.retry_after)))
+        return headers
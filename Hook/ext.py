@@ -1,17 +1,30 @@
 from flask import Blueprint, url_for, request, render_template, g, session, redirect, \
-    jsonify, send_from_directory, Markup
-from werkzeug.exceptions import NotFound, Forbidden, BadRequest
+    jsonify, send_from_directory, Markup, Response
+from werkzeug.exceptions import NotFound, Forbidden, BadRequest, Conflict, UnsupportedMediaType
 from flask_github import GitHub
 from flask_login import LoginManager, current_user, login_required, login_user
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import IntegrityError
 
 from pkg_resources import resource_filename
+from io import BytesIO
+from contextlib import contextmanager
 import re
 import hmac
 import hashlib
 import json
+import click
 
 from Hook.models import model_maker
+from Hook.exceptions import DuplicateTest
+from Hook.workers import WorkerPool
+from Hook.cache import MemoryCache, DatabaseCache
+from Hook.limits import ConcurrencyLimiter
+from Hook.metrics import Histogram, StageTimer, render_value
+from Hook.retention import RetentionPolicy
+from Hook.archive import ArchivePolicy
+from Hook.schema import upgrade
+from Hook import stream
 
 
 class HookUI(object):
@@ -29,8 +42,12 @@ class HookUI(object):
         ("/api/hook/v2.0/user/repositories", "r_api_user_repositories", ["GET", "POST"]),
         ("/api/hook/v2.0/user/repositories/<owner>/<repository>", "r_api_user_repository_switch", ["PUT"]),
         ("/api/hook/v2.0/user/repositories/<owner>/<repository>", "r_api_hooktest_endpoint", ["POST"]),
+        ("/api/hook/v2.0/user/repositories/<owner>/<repository>/batch", "r_api_hooktest_batch_endpoint", ["POST"]),
         ('/api/hook/v2.0/user/repositories/<owner>/<repository>/history', "r_api_repo_history", ["GET"]),
+        ('/api/hook/v2.0/user/repositories/<owner>/<repository>/diff', "r_api_repo_diff", ["GET"]),
         ('/api/hook/v2.0/user/repositories/<owner>/<repository>/token', "r_api_update_token", ["PATCH"]),
+        ('/api/hook/v2.0/user/repositories/<owner>/<repository>/ingest/<int:job>', "r_api_ingest_status", ["GET"]),
+        ('/api/hook/v2.0/metrics', "r_api_metrics", ["GET"]),
 
         ('/api/hook/v2.0/badges/<owner>/<repository>/texts.svg', "r_repo_texts_count", ["GET"]),
         ('/api/hook/v2.0/badges/<owner>/<repository>/metadata.svg', "r_repo_metadata_count", ["GET"]),
@@ -60,7 +77,14 @@ class HookUI(object):
          prefix="", database=None, github=None, login=None,
          remote=None, github_secret=None, hooktest_secret=None,
          static_folder=None, template_folder=None, app=None, name=None,
-         commenter_github_access_token=None
+         commenter_github_access_token=None, async_ingest=False, ingest_workers=2, workers_interval=1.0,
+         ingest_lease=3600,
+         async_comments=False, comment_workers=1, comment_backoff=30, comment_max_attempts=5, comment_budget=60000,
+         comment_lease=300,
+         streaming_ingest=False, max_payload_size=256 * 1024 * 1024,
+         author_cache=None, author_cache_ttl=86400, author_cache_negative_ttl=300,
+         ingest_concurrency=None, repository_ingest_concurrency=None, packed_units=False, sql_diff=False,
+         retention=None, archive=None, diff_cache_size=1000
     ):
         """ Initiate the class
 
@@ -76,6 +100,41 @@ class HookUI(object):
         :param app: Application on which to register
         :param name: Name to use for the blueprint
         :param commenter_github_access_token: Access Token of the User who posts comment
+        :param async_ingest: Store HookTest reports and answer right away, leaving the processing to ingest workers
+        :param ingest_workers: Number of ingest worker threads to start with the app when async_ingest is on
+        :param workers_interval: Seconds a worker waits before polling again an empty queue
+        :param ingest_lease: Seconds after which a report still being processed is considered lost with its worker \
+        and processed again. It should exceed the longest ingest : a report processed twice is only registered once.
+        :param async_comments: Store GitHub comments in an outbox posted by the comment dispatcher
+        :param comment_workers: Number of comment dispatcher threads to start with the app when async_comments is on
+        :param comment_backoff: Seconds to wait before retrying a failed comment, doubled at each failure
+        :param comment_max_attempts: Number of attempts after which a comment is given up
+        :param comment_lease: Seconds after which a comment still being posted is considered lost with its dispatcher \
+        and counted as a failed attempt
+        :param comment_budget: Maximum size in bytes of the body of a comment. Rows of the diff beyond it are counted \
+        and linked to the report of the test instead. GitHub rejects bodies above 65536 characters.
+        :param streaming_ingest: Read HookTest reports incrementally so that their units are never fully decoded \
+        in memory. Requires ijson.
+        :param max_payload_size: Maximum size in bytes of a HookTest report once decompressed
+        :param author_cache: Cache of GitHub author lookups : an object with get(key) and set(key, value, ttl) \
+        methods, "database" to share it through the database or None for an in-memory LRU cache
+        :param author_cache_ttl: Seconds during which a GitHub author lookup is cached
+        :param author_cache_negative_ttl: Seconds during which a failed GitHub author lookup is cached
+        :param ingest_concurrency: Maximum number of HookTest requests processed at once, None for no limit. \
+        Requests above it are answered with a 429 status. Requests are counted by each process : with several web \
+        worker processes, up to this many requests are processed at once by every one of them.
+        :param repository_ingest_concurrency: Maximum number of HookTest requests processed at once for a single \
+        repository by each process, None for no limit
+        :param packed_units: Store the units of master tests as a single compressed blob per test instead of a row \
+        per unit
+        :param sql_diff: Compare the units of tests with the ones of the last master test in the database, through a \
+        temporary table, instead of loading the last master units in memory. Ignored with packed_units.
+        :param retention: Default policy of the hook-retention command. Keeps everything when None.
+        :type retention: RetentionPolicy
+        :param archive: Default policy of the hook-archive command. Archives nothing when None.
+        :type archive: ArchivePolicy
+        :param diff_cache_size: Number of comparisons of the diff API kept in the database, the oldest ones being \
+        deleted beyond it. 0 computes them again at each request.
         """
         self.__g = None
 
@@ -94,6 +153,42 @@ class HookUI(object):
         self.prefix = prefix
         self.commenter_github_access_token = commenter_github_access_token
 
+        self.async_ingest = async_ingest
+        self.ingest_workers = ingest_workers
+        self.workers_interval = workers_interval
+        self.ingest_lease = ingest_lease
+        self.ingest_pool = None
+
+        self.async_comments = async_comments
+        self.comment_workers = comment_workers
+        self.comment_backoff = comment_backoff
+        self.comment_max_attempts = comment_max_attempts
+        self.comment_budget = comment_budget
+        self.comment_lease = comment_lease
+        self.comment_pool = None
+
+        self.streaming_ingest = streaming_ingest
+        if self.streaming_ingest is True and stream.ijson is None:
+            raise ImportError("streaming_ingest requires the ijson package")
+        self.max_payload_size = max_payload_size
+
+        self.author_cache = author_cache
+        if self.author_cache is None:
+            self.author_cache = MemoryCache()
+        self.author_cache_ttl = author_cache_ttl
+        self.author_cache_negative_ttl = author_cache_negative_ttl
+
+        self.ingest_limiter = ConcurrencyLimiter(limit=ingest_concurrency, per_key_limit=repository_ingest_concurrency)
+        self.packed_units = packed_units
+        self.sql_diff = sql_diff
+        self.retention = retention or RetentionPolicy()
+        self.archive = archive or ArchivePolicy()
+        self.diff_cache_size = diff_cache_size
+        self.stage_histogram = Histogram(
+            "hook_ingest_stage_seconds", "Duration of the stages of HookTest report ingests",
+            labels=("stage", "units")
+        )
+
         self.static_folder = static_folder
         if not self.static_folder:
             self.static_folder = resource_filename("Hook", "data/static")
@@ -141,9 +236,75 @@ class HookUI(object):
 
         # Generate Instance models
         self.Models = model_maker(self.db)
+        self.Models.RepoTest.PACK_UNITS = self.packed_units
+        self.Models.RepoTest.SQL_DIFF = self.sql_diff
+        self.Models.TestDiff.CACHE_SIZE = self.diff_cache_size
+        self.init_commands(app)
+
+        if self.author_cache == "database":
+            self.author_cache = DatabaseCache(self.db, self.Models.CacheEntry)
+
+        if self.async_ingest is True and self.ingest_workers > 0:
+            self.ingest_pool = WorkerPool(
+                app, self.process_ingest_job,
+                size=self.ingest_workers, interval=self.workers_interval, name="hook-ingest"
+            )
+            self.ingest_pool.start()
+
+        if self.async_comments is True and self.comment_workers > 0:
+            self.comment_pool = WorkerPool(
+                app, self.dispatch_comment,
+                size=self.comment_workers, interval=self.workers_interval, name="hook-comment"
+            )
+            self.comment_pool.start()
 
         return self.blueprint
 
+    def init_commands(self, app):
+        """ Register the command line commands of the extension
+
+        :param app: Flask Application
+        """
+        policy = self.retention
+
+        @app.cli.command("hook-retention")
+        @click.option("--master-units", type=int, default=policy.master_units,
+                      help="Number of the latest master tests of each repository keeping their units")
+        @click.option("--details-days", type=int, default=policy.details_days,
+                      help="Age in days after which tests only keep their summary")
+        @click.option("--pr-days", type=int, default=policy.pr_days,
+                      help="Age in days after which tests of other branches are deleted")
+        @click.option("--batch-size", type=int, default=policy.batch_size,
+                      help="Number of rows deleted per transaction")
+        def retention(master_units, details_days, pr_days, batch_size):
+            """ Delete old test data following the retention policy """
+            counts = RetentionPolicy(
+                master_units=master_units, details_days=details_days, pr_days=pr_days, batch_size=batch_size
+            ).apply(self.db, self.Models, progress=click.echo)
+            click.echo(", ".join("{} {} deleted".format(count, label) for label, count in counts.items()))
+
+        @app.cli.command("hook-archive")
+        @click.option("--days", type=int, default=self.archive.days,
+                      help="Age in days after which tests are moved to the archive")
+        @click.option("--batch-size", type=int, default=self.archive.batch_size,
+                      help="Number of tests archived per transaction")
+        def archive(days, batch_size):
+            """ Move old tests to the archive table """
+            count = ArchivePolicy(days=days, batch_size=batch_size).apply(self.db, self.Models, progress=click.echo)
+            click.echo("{} tests archived".format(count))
+
+        @app.cli.command("hook-upgrade")
+        def upgrade_schema():
+            """ Create the tables and indexes missing from a database created by a former version """
+            self.db.create_all()
+            created, failed = upgrade(self.db, progress=click.echo)
+            click.echo("{} indexes created, {} failed".format(len(created), len(failed)))
+            count = self.Models.LatestTest.rebuild()
+            self.db.session.commit()
+            click.echo("{} latest tests pointed".format(count))
+            if failed:
+                raise SystemExit(1)
+
     def init_blueprint(self):
         """ Properly generates the blueprint, registering routes and filters and connecting the app and the blueprint
 
@@ -264,7 +425,38 @@ class HookUI(object):
         :param owner: Name of the owner
         :param repository: Name of the repository
         """
-        return jsonify(self.handle_hooktest_log(request=request, owner=owner, repository=repository))
+        content, status_code = self.handle_hooktest_log(request=request, owner=owner, repository=repository)
+        r = jsonify(content)
+        r.status_code = status_code
+        if status_code == 202:
+            r.headers["Location"] = content["link"]
+        return r
+
+    def r_api_hooktest_batch_endpoint(self, owner, repository):
+        """ Route HookTest endpoint for many reports at once
+
+        :param owner: Name of the owner
+        :param repository: Name of the repository
+        """
+        return jsonify(self.handle_hooktest_batch(request=request, owner=owner, repository=repository))
+
+    def r_api_ingest_status(self, owner, repository, job):
+        """ Route giving the status of a queued HookTest report
+
+        :param owner: Name of the owner
+        :param repository: Name of the repository
+        :param job: Identifier of the ingest job
+        """
+        return jsonify(self.ingest_status(owner, repository, job))
+
+    def r_api_metrics(self):
+        """ Route giving the ingest latency histograms and the load of the ingest endpoints and queues in the
+        Prometheus text format
+        """
+        return Response(
+            "\n".join(self.stage_histogram.render() + self.ingest_metrics()) + "\n",
+            mimetype="text/plain; version=0.0.4"
+        )
 
     def r_api_user_repositories(self):
         """ Route fetching user repositories
@@ -358,6 +550,17 @@ class HookUI(object):
         else:
             return self.history(owner, repository)
 
+    def r_api_repo_diff(self, owner, repository):
+        """ Return the diff between two tests of a repository
+
+        :param owner: Name of the user
+        :param repository: Name of the repository
+        """
+        return self.repo_diff(
+            owner, repository,
+            base=request.args.get("base"), head=request.args.get("head"), mode=request.args.get("format", "json")
+        )
+
     def r_api_update_token(self, owner, repository):
         """ Regenerate the Travis Environment Token
 
@@ -431,7 +634,8 @@ class HookUI(object):
         repository = self.Models.Repository.get_or_raise(owner=owner, name=repository)
 
         # PAGINATION !!!
-        tests = repository.tests.order_by(self.Models.RepoTest.run_at.desc()).paginate()
+        tests = repository.history().paginate()
+        tests.items = repository.load_tests([test.uuid for test in tests.items])
 
 
         return {
@@ -463,6 +667,8 @@ class HookUI(object):
 
         repository = self.Models.Repository.get_or_raise(owner=owner, name=repository)
         test = repository.get_test(uuid)
+        # Diffs are read as they were stored when the test was registered, the units they come from may be gone
+        stored = self.Models.TestDiff.of(test.uuid)
 
         if json is True:
             dic = {
@@ -470,34 +676,282 @@ class HookUI(object):
                 'username': 'PerseusDl'
             }
             dic.update(test.dict)
+            if stored is not None:
+                dic["diff"] = {"base": stored.base_id, "tables": stored.diff}
             return jsonify(dic)
         else:
             return {
                 "repository": repository,
-                "test": test
+                "test": test,
+                "diff_base": stored.base_id if stored is not None else None,
+                "diff_rows": self.Models.RepoTest.diff_rows(stored.diff) if stored is not None else []
             }, 200, {}
 
+    def repo_diff(self, owner, repository, base, head, mode="json"):
+        """ Compare two stored tests of a repository
+
+        :param owner: Name of the owner of the repository
+        :param repository: Name of the repository
+        :param base: Unique Identifier of the test compared with
+        :param head: Unique Identifier of the test compared
+        :param mode: json for the diff dict, md or html for its tables
+        :return: Response containing the diff
+        """
+        if mode not in ("json", "md", "html"):
+            raise BadRequest(description="Unknown format " + mode)
+        if not base or not head:
+            raise BadRequest(description="Missing parameter base or head")
+
+        repository = self.Models.Repository.get_or_raise(owner=owner, name=repository)
+        tests = []
+        for uuid in (base, head):
+            test = repository.get_test(uuid)
+            if test is None:
+                raise NotFound(description="Unknown test " + uuid)
+            tests.append(test)
+        base, head = tests
+        diff = repository.diff_tests(base, head)
+
+        if mode == "json":
+            return jsonify({"base": base.uuid, "head": head.uuid, "tables": diff})
+        return Response(
+            self.Models.RepoTest.table(diff, mode=mode),
+            mimetype="text/markdown" if mode == "md" else "text/html"
+        )
+
     def handle_hooktest_log(self, owner, repository, request):
-        """ Handle data received from Redis server commands
+        """ Handle data received from HookTest
 
         :param owner: Name of the owner
         :param repository: Name of the repository
         :param request: request object
-        :return: Status Code
+        :return: (Response content, Status Code)
         """
+        if self.streaming_ingest is True:
+            return self.handle_hooktest_stream(owner, repository, request)
 
         if not request.data:
             raise BadRequest(description="No post data")
         elif request.content_type != "application/json":
             raise BadRequest(description="Data is not json encoded")
 
+        encoding = self.content_encoding(request)
+        repo = self.Models.Repository.get_or_raise(owner, repository)
+        timer = StageTimer()
+        with self.observe_stages(timer):
+            with timer.stage("signature"):
+                signed = self.check_hooktest_signature(request.data, repo, request.headers.get("HookTest-Secure-X"))
+            if signed is False:
+                raise Forbidden(description="Signature is not right")
+
+            with self.ingest_limiter.slot(repo.full_name):
+                if self.async_ingest is True:
+                    return self.enqueue_hooktest_log(repo, request.data, encoding, host_url=request.url_root), 202
+
+                with timer.stage("parse"):
+                    body = stream.decompress(request.data, encoding, self.max_payload_size)
+                    kwargs = self.parse_hooktest_data(json.loads(body.decode('utf-8')))
+                test, status = self.ingest_hooktest_data(repo, kwargs, timer=timer)
+        return {
+            "status": status,
+            "link": self.url_for(".repository_test", owner=owner, repository=repository, uuid=test.uuid)
+        }, 200
+
+    def handle_hooktest_stream(self, owner, repository, request):
+        """ Handle data received from HookTest without ever decoding its units at once
+
+        The body is spooled to a temporary file while being signed, then units are streamed to the database and
+        the diff computation. Compressed bodies are decompressed while they are read.
+
+        :param owner: Name of the owner
+        :param repository: Name of the repository
+        :param request: request object
+        :return: (Response content, Status Code)
+        """
+        if request.content_length == 0:
+            raise BadRequest(description="No post data")
+        elif request.content_type != "application/json":
+            raise BadRequest(description="Data is not json encoded")
+
+        encoding = self.content_encoding(request)
+        repo = self.Models.Repository.get_or_raise(owner, repository)
+        timer = StageTimer()
+        with self.observe_stages(timer):
+            with timer.stage("signature"):
+                body, size, signature = stream.spool_body(request.stream, repo.travis_env)
+            with body:
+                if size == 0:
+                    raise BadRequest(description="No post data")
+                elif signature != request.headers.get("HookTest-Secure-X"):
+                    raise Forbidden(description="Signature is not right")
+
+                with self.ingest_limiter.slot(repo.full_name):
+                    if self.async_ingest is True:
+                        return self.enqueue_hooktest_log(repo, body.read(), encoding, host_url=request.url_root), 202
+
+                    with timer.stage("parse"):
+                        if encoding is not None:
+                            body = stream.DecompressedReader(body, encoding, self.max_payload_size)
+                        kwargs = self.parse_hooktest_data(self.read_streamed_report(body))
+                    test, status = self.ingest_hooktest_data(repo, kwargs, timer=timer)
+
+        return {
+            "status": status,
+            "link": self.url_for(".repository_test", owner=owner, repository=repository, uuid=test.uuid)
+        }, 200
+
+    @staticmethod
+    def read_streamed_report(fileobj):
+        """ Read a HookTest report with its units as a lazy iterator
+
+        :param fileobj: Readable and seekable binary file of the report
+        :return: Decoded report
+        :rtype: dict
+        """
+        try:
+            return stream.read_streamed_report(fileobj)
+        except stream.ijson.JSONError:
+            raise BadRequest(description="Data is not json encoded")
+
+    @staticmethod
+    def content_encoding(request):
+        """ Get the compression of the request body
+
+        :param request: request object
+        :return: gzip, deflate or None when the body is not compressed
+        """
+        encoding = request.headers.get("Content-Encoding", "identity").strip().lower()
+        if encoding == "identity":
+            return None
+        elif encoding not in stream.ENCODINGS:
+            raise UnsupportedMediaType(description="Unsupported content encoding " + encoding)
+        return encoding
+
+    def handle_hooktest_batch(self, owner, repository, request):
+        """ Handle many HookTest reports sent as a JSON array or as newline delimited JSON
+
+        The whole body is signed like a single report. Every report is validated before the valid ones are
+        registered in a single transaction. No diff is computed and no comment is posted.
+
+        :param owner: Name of the owner
+        :param repository: Name of the repository
+        :param request: request object
+        :return: Status of each report, in the order they were sent
+        :rtype: dict
+        """
+        if not request.data:
+            raise BadRequest(description="No post data")
+        elif request.content_type not in ("application/json", "application/x-ndjson"):
+            raise BadRequest(description="Data is not json encoded")
+
+        encoding = self.content_encoding(request)
         repo = self.Models.Repository.get_or_raise(owner, repository)
         if self.check_hooktest_signature(request.data, repo, request.headers.get("HookTest-Secure-X")) is False:
             raise Forbidden(description="Signature is not right")
 
-        repo = self.Models.Repository.get_or_raise(owner, repository)
-        data = json.loads(request.data.decode('utf-8'))
+        with self.ingest_limiter.slot(repo.full_name):
+            return self.register_hooktest_batch(repo, request, encoding)
+
+    def register_hooktest_batch(self, repo, request, encoding=None):
+        """ Validate and register the reports of a signed batch
+
+        :param repo: Repository the batch was sent for
+        :type repo: Repository
+        :param request: request object
+        :param encoding: Compression of the body
+        :return: Status of each report, in the order they were sent
+        :rtype: dict
+        """
+        owner, repository = repo.owner, repo.name
+        body = stream.decompress(request.data, encoding, self.max_payload_size)
+        statuses, parsed = [], []
+        for index, data in enumerate(self.split_hooktest_batch(body, request.content_type)):
+            try:
+                if not isinstance(data, dict):
+                    raise BadRequest(description="Report is not a json object")
+                parsed.append((index, self.parse_hooktest_data(data)))
+                statuses.append(None)
+            except Exception as E:
+                statuses.append({"status": "error", "error": getattr(E, "description", None) or str(E)})
+
+        # Builds which are already registered, or repeated in the batch, are not registered again
+        registered = {
+            key: test.uuid
+            for key, test in repo.find_duplicates(
+                (kwargs["travis_build_id"], kwargs["sha"]) for _, kwargs in parsed
+            ).items()
+        }
+        repeated, valid = {}, []
+        for index, kwargs in parsed:
+            key = (str(kwargs["travis_build_id"]), kwargs["sha"])
+            if key in registered:
+                statuses[index] = {"status": "duplicate", "test": registered[key]}
+            elif key in repeated:
+                statuses[index] = {"status": "duplicate", "index": repeated[key]}
+            else:
+                try:
+                    if "user" not in kwargs:
+                        kwargs.update(self.get_user_information_from_github(kwargs, owner, repository))
+                except Exception as E:
+                    statuses[index] = {"status": "error", "error": str(E)}
+                else:
+                    valid.append((index, kwargs))
+                    if kwargs["sha"] is not None:
+                        repeated[key] = index
 
+        try:
+            registered_tests = repo.register_tests([kwargs for _, kwargs in valid])
+        except IntegrityError:
+            self.db.session.rollback()
+            raise Conflict(description="Builds of the batch were registered concurrently, send it again")
+        tests = {index: test.uuid for (index, _), test in zip(valid, registered_tests)}
+        for index, status in enumerate(statuses):
+            if status is None:
+                status = statuses[index] = {"status": "success", "test": tests[index]}
+            elif "index" in status:
+                # Link repeated reports to the test registered by their first occurrence
+                status["test"] = tests[status.pop("index")]
+            if "test" in status:
+                status["link"] = self.url_for(
+                    ".repository_test", owner=owner, repository=repository, uuid=status.pop("test")
+                )
+        return {"reports": statuses}
+
+    @staticmethod
+    def split_hooktest_batch(body, content_type):
+        """ Decode the reports of a batch
+
+        :param body: Raw body of the request
+        :type body: bytes
+        :param content_type: application/json for an array of reports, application/x-ndjson for a report per line
+        :return: Decoded reports. Lines of a NDJSON body which cannot be decoded are yielded as None.
+        """
+        body = body.decode('utf-8')
+        if content_type == "application/json":
+            try:
+                reports = json.loads(body)
+            except ValueError:
+                raise BadRequest(description="Data is not json encoded")
+            if not isinstance(reports, list):
+                raise BadRequest(description="Batch should be a json array of reports")
+            for report in reports:
+                yield report
+        else:
+            for line in body.splitlines():
+                if line.strip():
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        yield None
+
+    def parse_hooktest_data(self, data):
+        """ Turn a decoded HookTest report into keyword arguments for Repository.register_test
+
+        :param data: Decoded HookTest report
+        :type data: dict
+        :return: Keyword arguments for register_test
+        :rtype: dict
+        """
         # Format of expected data :
         try:
             kwargs = dict(
@@ -519,17 +973,51 @@ class HookUI(object):
             )
             if "words_count" in data:
                 kwargs["words_count"] = data["words_count"]
+            if data.get("user") and data.get("avatar"):
+                kwargs["user"], kwargs["avatar"] = data["user"], data["avatar"]
         except KeyError as E:
             raise BadRequest(description="Missing parameter " + str(E))
+        return kwargs
+
+    def ingest_hooktest_data(self, repo, kwargs, timer=None):
+        """ Register a parsed HookTest report and comment its diff on GitHub
+
+        :param repo: Repository the report was sent for
+        :type repo: Repository
+        :param kwargs: Parsed report, as given by parse_hooktest_data
+        :type kwargs: dict
+        :param timer: Timer of the ingest
+        :type timer: StageTimer
+        :return: Registered test, or former test of the same build and commit, and "success" or "duplicate"
+        :rtype: (RepoTest, str)
+        """
+        owner, repository = repo.owner, repo.name
+        if timer is None:
+            timer = StageTimer()
 
-        # Information about the User
-        try:
-            kwargs.update(self.get_user_information_from_github(kwargs, owner, repository))
-        except:
-            raise Exception("Error on " + request.data.decode('utf-8'))
+        duplicate = repo.find_duplicate(kwargs["travis_build_id"], kwargs["sha"])
+        if duplicate is not None:
+            return duplicate, "duplicate"
+
+        # Streamed units are parsed while they are consumed
+        if isinstance(kwargs["units"], dict):
+            timer.units = len(kwargs["units"])
+        else:
+            kwargs["units"] = timer.iterate("parse", kwargs["units"])
+
+        # Information about the User, unless the report carries it
+        if "user" not in kwargs:
+            try:
+                with timer.stage("author"):
+                    kwargs.update(self.get_user_information_from_github(kwargs, owner, repository))
+            except Exception:
+                raise Exception("Error while retrieving the author of {}@{}".format(repo.full_name, kwargs["sha"]))
 
-        test, diff = repo.register_test(**kwargs)
-        if data["event_type"] == "push":
+        try:
+            test, diff = repo.register_test(_check_duplicate=False, _timer=timer, **kwargs)
+        except DuplicateTest as E:
+            return E.test, "duplicate"
+        if kwargs["event_type"] == "push":
             uri = "repos/{owner}/{repository}/commits/{sha}/comments".format(
                 owner=owner, repository=repository, sha=test.sha
             )
@@ -540,15 +1028,149 @@ class HookUI(object):
 
         # Commenting
         if diff is not None:
-            self.comment(test, diff, uri=uri)
+            self.comment(test, diff, uri=uri, timer=timer)
+        return test, "success"
+
+    @contextmanager
+    def observe_stages(self, timer):
+        """ Record the stage durations of an ingest once it is over, whether it succeeded or not
+
+        :param timer: Timer of the ingest
+        :type timer: StageTimer
+        """
+        try:
+            yield timer
+        finally:
+            self.stage_histogram.observe_timer(timer)
+
+    def enqueue_hooktest_log(self, repo, body, encoding=None, host_url=None):
+        """ Store a signed HookTest report for the ingest workers
+
+        :param repo: Repository the report was sent for
+        :type repo: Repository
+        :param body: Raw body of the request
+        :type body: bytes
+        :param encoding: Compression of the body
+        :param host_url: Root URL of the current request
+        :return: Status of the queued job
+        :rtype: dict
+        """
+        job = self.Models.IngestJob(repository=repo.uuid, payload=body, content_encoding=encoding, host_url=host_url)
+        self.db.session.add(job)
+        self.db.session.commit()
         return {
-            "status": "success",
-            "link": self.url_for(".repository_test", owner=owner, repository=repository, uuid=test.uuid)
+            "status": job.status,
+            "job": job.uuid,
+            "link": self.url_for(".api_ingest_status", owner=repo.owner, repository=repo.name, job=job.uuid)
         }
 
+    def process_ingest_job(self):
+        """ Claim the next queued HookTest report and ingest it
+
+        :return: Whether a job was processed
+        :rtype: bool
+        """
+        job = self.Models.IngestJob.claim(lease=self.ingest_lease)
+        if job is None:
+            return False
+
+        job_id, timer = job.uuid, StageTimer()
+        try:
+            with self.app.test_request_context(base_url=job.host_url), self.observe_stages(timer):
+                with timer.stage("parse"):
+                    if self.streaming_ingest is True:
+                        body = BytesIO(job.payload)
+                        if job.content_encoding is not None:
+                            body = stream.DecompressedReader(body, job.content_encoding, self.max_payload_size)
+                        data = self.read_streamed_report(body)
+                    else:
+                        body = stream.decompress(job.payload, job.content_encoding, self.max_payload_size)
+                        data = json.loads(body.decode('utf-8'))
+                test, _ = self.ingest_hooktest_data(job.repository_dyn, self.parse_hooktest_data(data), timer=timer)
+                test_id = test.uuid
+        except Exception as E:
+            self.db.session.rollback()
+            error, test = getattr(E, "description", None) or str(E), None
+        else:
+            error, test = None, self.Models.RepoTest.query.get(test_id)
+        # The session might have been renewed while processing, so we reload the job
+        self.Models.IngestJob.query.get(job_id).finish(test=test, error=error)
+        return True
+
+    def process_ingest_jobs(self):
+        """ Ingest queued HookTest reports until the queue is empty
+
+        :return: Number of processed jobs
+        :rtype: int
+        """
+        processed = 0
+        while self.process_ingest_job():
+            processed += 1
+        return processed
+
+    def ingest_status(self, owner, repository, job):
+        """ Get the status of an ingest job
+
+        :param owner: Name of the owner
+        :param repository: Name of the repository
+        :param job: Identifier of the job
+        :return: Status of the job
+        :rtype: dict
+        """
+        repo = self.Models.Repository.get_or_raise(owner, repository)
+        job = self.Models.IngestJob.query.filter(
+            self.Models.IngestJob.uuid == job,
+            self.Models.IngestJob.repository == repo.uuid
+        ).first()
+        if job is None:
+            raise NotFound(description="Unknown ingest job")
+        dct = job.dict
+        if job.test_id is not None:
+            dct["link"] = self.url_for(".repository_test", owner=owner, repository=repository, uuid=job.test_id)
+        return dct
+
+    def ingest_metrics(self):
+        """ Get the load of the ingest endpoints and the depth of the queues
+
+        The limiter counts the requests of the current process only, the queues are shared by every process.
+
+        :return: Lines of the metrics of the ingest limiter, of the number of queued reports and of pending comments \
+        in the Prometheus text format
+        :rtype: [str]
+        """
+        limiter = self.ingest_limiter.metrics
+        metrics = [
+            ("hook_ingest_in_flight", "HookTest requests being processed by this process", limiter["in_flight"]),
+            ("hook_ingest_limit", "Maximum number of HookTest requests processed at once by this process",
+             limiter["limit"]),
+            ("hook_ingest_repository_limit",
+             "Maximum number of HookTest requests processed at once for a repository by this process",
+             limiter["per_repository_limit"]),
+            ("hook_ingest_mean_duration_seconds", "Mean duration of the last HookTest requests of this process",
+             limiter["mean_duration"]),
+            ("hook_ingest_queued_reports", "HookTest reports waiting for an ingest worker",
+             self.Models.IngestJob.query.filter(
+                 self.Models.IngestJob.status == self.Models.IngestJob.QUEUED
+             ).count()),
+            ("hook_comments_pending", "GitHub comments waiting in the outbox",
+             self.Models.CommentOutbox.query.filter(
+                 self.Models.CommentOutbox.status == self.Models.CommentOutbox.PENDING
+             ).count())
+        ]
+        lines = []
+        for name, documentation, value in metrics:
+            lines.extend(render_value(name, documentation, value))
+        lines.extend(render_value(
+            "hook_ingest_rejected_total", "HookTest requests turned away by the limits of this process",
+            limiter["rejected"], kind="counter"
+        ))
+        return lines
+
     def get_user_information_from_github(self, data, owner, repository):
         """ Retrieve information about the current user
 
+        Lookups are cached by repository and commit or pull request, failures included.
+
         :param data: Current data built for RepoTest
         :param owner:  Name of the owner
         :param repository: Name of the repository
@@ -556,26 +1178,26 @@ class HookUI(object):
         """
         slug = owner+"/"+repository
         if data["event_type"] == 'pull_request':
-            status = self.api.get(
-                "repos/{slug}/pulls/{_id}".format(
-                    slug=slug,
-                    _id=data["source"]),
-                    params={
-                        'access_token': self.commenter_github_access_token
-                    }
-            )
-            return {"user": status['user']['login'], "avatar": status['user']['avatar_url']}
+            resource, key = "repos/{slug}/pulls/{_id}".format(slug=slug, _id=data["source"]), "user"
         elif data["event_type"] == 'push':
-            status = self.api.get(
-                "repos/{slug}/commits/{_id}".format(
-                    slug=slug,
-                    _id=data["sha"]
-                ),
-                params={
-                    'access_token': self.commenter_github_access_token
-                }
-            )
-            return {"user": status['author']['login'], "avatar": status['author']['avatar_url']}
+            resource, key = "repos/{slug}/commits/{_id}".format(slug=slug, _id=data["sha"]), "author"
+        else:
+            return
+
+        cached = self.author_cache.get(resource)
+        if cached is not None:
+            if "error" in cached:
+                raise Exception(cached["error"])
+            return cached
+
+        try:
+            status = self.api.get(resource, params={'access_token': self.commenter_github_access_token})
+            author = {"user": status[key]['login'], "avatar": status[key]['avatar_url']}
+        except Exception as E:
+            self.author_cache.set(resource, {"error": str(E)}, self.author_cache_negative_ttl)
+            raise
+        self.author_cache.set(resource, author, self.author_cache_ttl)
+        return author
 
     def make_hooktest_signature(self, body, secret):
         """ Check the signature sent by a request with the body
@@ -629,19 +1251,18 @@ class HookUI(object):
         :rtype: (str, dict, int, dict)
         """
         repo = self.get_repo_test(username, reponame, uuid=uuid)
+        words = repo.words_count_as_dict
 
-        if len(repo.words_count) == 0:
+        if len(words) == 0:
             raise NotFound(description="No words count available")
 
         if language is None:
-            cnt = sum([wc.count for wc in repo.words_count])
+            cnt = repo.words_sum
             language = "Words"
+        elif language not in words:
+            raise NotFound(description="Unknown language")
         else:
-            wc = [wc for wc in repo.words_count if wc.lang == language]
-            if len(wc) == 0:
-                raise NotFound(description="Unknown language")
-            else:
-                cnt = wc[0].count
+            cnt = words[language]
 
         template = "svg/wordcount.xml"
         return template, {"language": language, "cnt": cnt}, 200, \
@@ -721,7 +1342,7 @@ class HookUI(object):
         :return: Repoitory Test
         :rtype: RepoTest
         """
-        if uuid is not None or branch is not None:
+        if uuid is not None:
             repo = self.Models.RepoTest.query.join(
                 self.Models.Repository, self.Models.Repository.uuid == self.Models.RepoTest.repository
             ).filter(
@@ -741,6 +1362,14 @@ class HookUI(object):
             repo = repo.first()
             if repo is None:
                 raise NotFound(description="Unknown repository's test")
+        elif branch is not None:
+            repo = self.filter_or_404(
+                self.Models.Repository,
+                self.Models.Repository.owner == owner,
+                self.Models.Repository.name == name
+            ).latest_test(branch)
+            if repo is None:
+                raise NotFound(description="Unknown repository's test")
         else:
             repo = self.filter_or_404(
                 self.Models.Repository,
@@ -757,7 +1386,7 @@ class HookUI(object):
         :return:
         """
         repository = self.Models.Repository.get_or_raise(owner=username, name=reponame)
-        pagination = repository.tests.order_by(self.Models.RepoTest.run_at.desc()).paginate()
+        pagination = repository.history().paginate()
         history = {
             "username": username,
             "reponame": reponame,
@@ -788,33 +1417,92 @@ class HookUI(object):
             )
         return jsonify(**history)
 
-    def comment(self, test, diff, uri):
+    def comment(self, test, diff, uri, timer=None):
         """ Takes care of sending information to github API through the comment / status API
 
+        When async_comments is on, the comment is only stored in the outbox for the comment dispatcher.
+
         :param test: The test currently running or finished
         :param diff: The diff
         :param uri: Address where we want to post
+        :param timer: Timer recording the table and comment stages
+        :type timer: StageTimer
         :return:
         """
-        repo = test.repository_dyn
+        if timer is None:
+            timer = StageTimer()
+        with timer.stage("table"):
+            body = self.comment_body(test, diff)
+
+        with timer.stage("comment"):
+            if self.async_comments is True:
+                self.db.session.add(self.Models.CommentOutbox(test_id=test.uuid, uri=uri, body=body))
+                self.db.session.commit()
+                return
+
+            test.comment_uri = self.post_comment(uri, body)
+            self.db.session.add(test)
+            self.db.session.commit()
 
-        data = {
-          "body": """{}
+    def comment_body(self, test, diff):
+        """ Build the markdown body of a comment
+
+        :param test: The test currently running or finished
+        :param diff: The diff
+        :return: Body of the comment
+        :rtype: str
+        """
+        repo = test.repository_dyn
+        link = self.url_for(".repository_test", owner=repo.owner, repository=repo.name, uuid=test.uuid, _external=True)
+        footer = """
 
 *[Hook UI build recap]({})*
-""".format(
-              test.table(diff, mode="md"),
-              self.url_for(".repository_test", owner=repo.owner, repository=repo.name, uuid=test.uuid, _external=True)
-           ),
-        }
+""".format(link)
+        budget = self.comment_budget - len(footer.encode("utf-8"))
+        return test.table(diff, mode="md", budget=budget, link=link) + footer
+
+    def post_comment(self, uri, body):
+        """ Post a comment through the GitHub API
 
+        :param uri: Address where we want to post
+        :param body: Body of the comment
+        :return: URL Address of the comment
+        :rtype: str
+        """
         params = {"access_token": self.commenter_github_access_token}
+        output = self.api.post(uri, data={"body": body}, params=params)
+        return output["html_url"]
 
-        output = self.api.post(uri, data=data, params=params)
+    def dispatch_comment(self):
+        """ Claim the next comment due in the outbox and post it
 
-        test.comment_uri = output["html_url"]
-        self.db.session.add(test)
-        self.db.session.commit()
+        :return: Whether a comment was claimed
+        :rtype: bool
+        """
+        comment = self.Models.CommentOutbox.claim(lease=self.comment_lease, max_attempts=self.comment_max_attempts)
+        if comment is None:
+            return False
+
+        try:
+            comment_uri = self.post_comment(comment.uri, comment.body)
+        except Exception as E:
+            comment.retry(
+                str(E), backoff=self.comment_backoff, max_attempts=self.comment_max_attempts
+            )
+        else:
+            comment.sent(comment_uri)
+        return True
+
+    def dispatch_comments(self):
+        """ Post comments until no comment is due in the outbox
+
+        :return: Number of claimed comments
+        :rtype: int
+        """
+        dispatched = 0
+        while self.dispatch_comment():
+            dispatched += 1
+        return dispatched
 
     """
         USER CONTROLLER
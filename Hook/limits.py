@@ -0,0 +1,125 @@
+""" Bounded concurrency for the ingest endpoints
+
+A burst of HookTest reports, for example when CI is rerun on every repository of an organization, would otherwise hold
+as many database connections as there are web workers. The limiter lets a bounded number of ingests run at once,
+globally and per repository, and turns away the others with a 429 telling them when to come back.
+
+Limits are kept in memory and apply to a single process : with N web worker processes, up to N times the limit run at
+once. Size them from the number of database connections each process may hold.
+"""
+from collections import Counter, deque
+from contextlib import contextmanager
+from math import ceil
+from threading import Lock
+from time import monotonic
+
+from Hook.exceptions import TooBusy
+
+
+class ConcurrencyLimiter(object):
+    """ Count the requests being processed and refuse the ones above the limits
+
+    The Retry-After value is the mean duration of the last requests, stretched by the number of requests already
+    turned away since a slot was last freed, so that rejected clients do not all come back at the same time.
+
+    :param limit: Maximum number of concurrent requests, None for no limit
+    :param per_key_limit: Maximum number of concurrent requests for a single key, None for no limit
+    :param window: Number of durations kept to compute the mean duration of a request
+    :param max_retry_after: Maximum Retry-After value, in seconds
+    """
+    def __init__(self, limit=None, per_key_limit=None, window=20, max_retry_after=300):
+        self.limit = limit
+        self.per_key_limit = per_key_limit
+        self.max_retry_after = max_retry_after
+        self.in_flight = 0
+        self.by_key = Counter()
+        self.rejected = 0
+        self.waiting = 0
+        self.durations = deque(maxlen=window)
+        self.lock = Lock()
+
+    @property
+    def mean_duration(self):
+        """ Mean duration in seconds of the last requests, or None if no request finished yet
+        """
+        if not self.durations:
+            return None
+        return sum(self.durations) / len(self.durations)
+
+    def retry_after(self, limit):
+        """ Compute the number of seconds a rejected client should wait
+
+        :param limit: Limit which was reached
+        :return: Seconds to wait
+        :rtype: int
+        """
+        mean = self.mean_duration or 1
+        return min(self.max_retry_after, max(1, int(ceil(mean * (1 + self.waiting / limit)))))
+
+    def acquire(self, key):
+        """ Take a slot for a request
+
+        :param key: Key of the request, such as the full name of the repository
+        :raises TooBusy: When a limit is reached
+        """
+        with self.lock:
+            if self.limit is not None and self.in_flight >= self.limit:
+                scope, limit = "Hook", self.limit
+            elif self.per_key_limit is not None and self.by_key[key] >= self.per_key_limit:
+                scope, limit = key, self.per_key_limit
+            else:
+                self.in_flight += 1
+                self.by_key[key] += 1
+                return
+            self.rejected += 1
+            self.waiting += 1
+            retry_after = self.retry_after(limit)
+        raise TooBusy(
+            "{} is already ingesting {} reports, try again later".format(scope, limit),
+            retry_after=retry_after
+        )
+
+    def release(self, key, duration=None):
+        """ Free the slot of a request
+
+        :param key: Key of the request
+        :param duration: Duration of the request in seconds
+        """
+        with self.lock:
+            self.in_flight -= 1
+            self.by_key[key] -= 1
+            if self.by_key[key] <= 0:
+                del self.by_key[key]
+            self.waiting = 0
+            if duration is not None:
+                self.durations.append(duration)
+
+    @contextmanager
+    def slot(self, key):
+        """ Hold a slot while the block runs
+
+        :param key: Key of the request
+        :raises TooBusy: When a limit is reached
+        """
+        self.acquire(key)
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.release(key, monotonic() - start)
+
+    @property
+    def metrics(self):
+        """ Current state of the limiter
+
+        :rtype: dict
+        """
+        with self.lock:
+            return {
+                "in_flight": self.in_flight,
+                "limit": self.limit,
+                "per_repository_limit": self.per_key_limit,
+                "repositories": dict(self.by_key),
+                "rejected": self.rejected,
+                "mean_duration": self.mean_duration
+            }
@@ -0,0 +1,176 @@
+""" Latency histograms of the ingest pipeline, exposed in the Prometheus text format
+
+A StageTimer follows a single report through the pipeline. Stages can be nested : the time spent in an inner stage is
+not counted in the outer one, so that the durations of a report add up to its total ingest time. Once the report is
+ingested, its durations are observed in a Histogram tagged with the size bucket of the report. Repositories are not
+used as labels, as every repository would add its own series to each stage and size. Gauges and counters without
+labels are written with render_value.
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock
+from time import monotonic
+
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+UNIT_BUCKETS = ((100, "0-100"), (1000, "100-1k"), (10000, "1k-10k"), (100000, "10k-100k"))
+
+
+def units_bucket(count):
+    """ Name the size bucket of a report
+
+    :param count: Number of units of the report, None if unknown
+    :return: Label of the bucket
+    :rtype: str
+    """
+    if count is None:
+        return "unknown"
+    for bound, label in UNIT_BUCKETS:
+        if count <= bound:
+            return label
+    return "100k+"
+
+
+class StageTimer(object):
+    """ Accumulate the exclusive duration of the stages of a single ingest
+    """
+    def __init__(self):
+        self.durations = OrderedDict()
+        self.units = None
+        self.__stack = []
+        self.__started = None
+
+    def __switch(self, now):
+        if self.__stack:
+            name = self.__stack[-1]
+            self.durations[name] = self.durations.get(name, 0) + now - self.__started
+        self.__started = now
+
+    @contextmanager
+    def stage(self, name):
+        """ Time the block as the given stage, pausing the stage it is nested in
+
+        :param name: Name of the stage
+        """
+        self.__switch(monotonic())
+        self.__stack.append(name)
+        try:
+            yield
+        finally:
+            self.__switch(monotonic())
+            self.__stack.pop()
+
+    def iterate(self, name, iterable):
+        """ Time the production of each item of a lazy iterable as the given stage, and count the items
+
+        :param name: Name of the stage
+        :param iterable: Iterable to time
+        :return: Generator of the items of iterable
+        """
+        iterator = iter(iterable)
+        self.units = 0
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            self.units += 1
+            yield item
+
+
+class Histogram(object):
+    """ Thread-safe cumulative histogram with labels
+
+    :param name: Name of the metric
+    :param documentation: Description of the metric
+    :param labels: Names of the labels
+    :param buckets: Upper bounds of the buckets, in increasing order
+    """
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets) + (float("inf"), )
+        self.series = OrderedDict()
+        self.lock = Lock()
+
+    def observe(self, value, **labels):
+        """ Record a value
+
+        :param value: Value to record
+        :param labels: Value of each label of the histogram
+        """
+        key = tuple(str(labels[label]) for label in self.labels)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = {"buckets": [0] * len(self.buckets), "sum": 0, "count": 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][index] += 1
+                    break
+            series["sum"] += value
+            series["count"] += 1
+
+    def observe_timer(self, timer, **labels):
+        """ Record every stage duration of a timer
+
+        :param timer: Timer of an ingest
+        :type timer: StageTimer
+        :param labels: Value of each label of the histogram but stage and units
+        """
+        for stage, duration in timer.durations.items():
+            self.observe(duration, stage=stage, units=units_bucket(timer.units), **labels)
+
+    def render(self):
+        """ Write the histogram in the Prometheus text format
+
+        :return: Lines of the histogram
+        :rtype: [str]
+        """
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} histogram".format(self.name)
+        ]
+        with self.lock:
+            for key, series in self.series.items():
+                labels = ['{}="{}"'.format(label, escape(value)) for label, value in zip(self.labels, key)]
+                cumulative = 0
+                for bound, count in zip(self.buckets, series["buckets"]):
+                    cumulative += count
+                    lines.append("{}_bucket{{{}}} {}".format(
+                        self.name, ",".join(labels + ['le="{}"'.format(format_bound(bound))]), cumulative
+                    ))
+                lines.append("{}_sum{{{}}} {}".format(self.name, ",".join(labels), repr(float(series["sum"]))))
+                lines.append("{}_count{{{}}} {}".format(self.name, ",".join(labels), series["count"]))
+        return lines
+
+
+def render_value(name, documentation, value, kind="gauge"):
+    """ Write a metric without labels in the Prometheus text format
+
+    :param name: Name of the metric
+    :param documentation: Description of the metric
+    :param value: Current value, None if it is unknown
+    :param kind: gauge or counter
+    :return: Lines of the metric, none when the value is unknown
+    :rtype: [str]
+    """
+    if value is None:
+        return []
+    return [
+        "# HELP {} {}".format(name, documentation),
+        "# TYPE {} {}".format(name, kind),
+        "{} {}".format(name, repr(float(value)))
+    ]
+
+
+def format_bound(bound):
+    if bound == float("inf"):
+        return "+Inf"
+    return repr(float(bound))
+
+
+def escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
@@ -4,19 +4,74 @@ import datetime
 import re
 import random
 import hashlib
+import json
+import zlib
 
-from tabulate import tabulate
 from Hook.exceptions import *
-from collections import defaultdict
+from Hook.metrics import StageTimer
+from Hook.cache import MemoryCache
+from Hook.packing import pack_units, PackedUnits
+from Hook.diffing import UnitDiff
+from Hook.rendering import render_diff, diff_tables
+from collections import defaultdict, deque
 from math import isclose
 from operator import itemgetter
 from flask_login import UserMixin
 from werkzeug.exceptions import NotFound
+from sqlalchemy.exc import IntegrityError
 
 
 pr_finder = re.compile("pull\/([0-9]+)\/head")
 
 
+def unit_pairs(units):
+    """ Iterate over (Path, Status) pairs whether units are a dictionary or already an iterable of pairs
+
+    :param units: Dictionary Path->Status or iterable of (Path, Status) pairs
+    :return: Iterable of (Path, Status) pairs
+    """
+    if isinstance(units, dict):
+        return units.items()
+    return units
+
+
+def materialize_words(words_count):
+    """ Compute the values of the word count columns of a test
+
+    :param words_count: Dictionary LanguageCode -> Number of words
+    :return: Total number of words and json map Language->Count
+    :rtype: (int, str)
+    """
+    return sum(words_count.values()), json.dumps(words_count, sort_keys=True)
+
+
+def pack_diff(diff):
+    """ Encode a diff, as given by RepoTest.diff, to be stored
+
+    :param diff: Diff dict from RepoTest.diff
+    :return: zlib-compressed json map Name->Category->[[Item, Status]], without empty categories
+    :rtype: bytes
+    """
+    return zlib.compress(json.dumps({
+        name: {category: rows for category, rows in table.items() if rows}
+        for name, table in diff.items()
+    }, sort_keys=True, separators=(",", ":")).encode("utf-8"))
+
+
+def unpack_diff(blob):
+    """ Decode a diff encoded by pack_diff
+
+    :param blob: Encoded diff
+    :type blob: bytes
+    :return: Diff dict, as given by RepoTest.diff
+    :rtype: dict
+    """
+    return {
+        name: defaultdict(list, {category: [tuple(row) for row in rows] for category, rows in table.items()})
+        for name, table in json.loads(zlib.decompress(blob).decode("utf-8")).items()
+    }
+
+
 def make_travis_env():
     by = hashlib.sha1(str(random.getrandbits(128)).encode()).hexdigest()
     return by
@@ -30,6 +85,88 @@ def model_maker(db, prefix=""):
     :return: Models
     """
 
+    def claim_next(model, query, from_status, to_status, lease=None):
+        """ Take the oldest row of a queue-like model and switch its status
+
+        The status switch is a conditional update so that concurrent workers, even in different processes,
+        never claim the same row twice. Claimed rows hold a lease : once it expired, the worker which claimed the row
+        is considered dead and the row can be claimed again.
+
+        :param model: Model of the queue, with a claimed_at column
+        :param query: Query over the candidate rows
+        :param from_status: Status of rows waiting to be claimed
+        :param to_status: Status of claimed rows
+        :param lease: Seconds after which a claimed row is claimed again, None to never claim it again
+        :return: Claimed row or None if the queue is empty
+        """
+        while True:
+            now = datetime.datetime.utcnow()
+            claimable = model.status == from_status
+            if lease is not None:
+                claimable = db.or_(claimable, db.and_(
+                    model.status == to_status,
+                    model.claimed_at < now - datetime.timedelta(seconds=lease)
+                ))
+            row = query.filter(claimable).order_by(model.uuid).first()
+            if row is None:
+                return None
+            claimed = model.query.\
+                filter(model.uuid == row.uuid, claimable).\
+                update({"status": to_status, "claimed_at": now}, synchronize_session=False)
+            db.session.commit()
+            if claimed == 1:
+                db.session.refresh(row)
+                return row
+
+    def bulk_insert(model, rows, chunk_size=1000):
+        """ Insert rows with executemany by chunks, bypassing the ORM unit of work
+
+        :param model: Model of the rows
+        :param rows: Iterable of dictionaries of column values
+        :param chunk_size: Number of rows inserted at once
+        :return: Number of inserted rows
+        :rtype: int
+        """
+        chunk, inserted = [], 0
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                db.session.execute(model.__table__.insert(), chunk)
+                inserted += len(chunk)
+                chunk = []
+        if chunk:
+            db.session.execute(model.__table__.insert(), chunk)
+            inserted += len(chunk)
+        return inserted
+
+    def insert_units(rows, chunk_size=1000):
+        """ Insert unit rows by chunks, their path being replaced by the identifier of the interned path
+
+        :param rows: Iterable of dictionaries with test_id, path, status and optionally deleted
+        :param chunk_size: Number of rows inserted at once
+        """
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                insert_unit_chunk(chunk)
+                chunk = []
+        if chunk:
+            insert_unit_chunk(chunk)
+
+    def insert_unit_chunk(rows):
+        paths = UnitPath.resolve(row["path"] for row in rows)
+        bulk_insert(UnitTest, [
+            {
+                "test_id": row["test_id"], "path_id": paths[row["path"]],
+                "status": row["status"], "deleted": row.get("deleted", False)
+            }
+            for row in rows
+        ], chunk_size=len(rows))
+
+    # Identifiers of interned paths, shared by every session of the process
+    path_cache = MemoryCache(size=500000)
+
     RepoOwnership = db.Table("repoownership",
         db.Column('user_uuid', db.Integer, db.ForeignKey('user.uuid')),
         db.Column('repo_uuid', db.Integer, db.ForeignKey('repository.uuid')),
@@ -108,6 +245,9 @@ def model_maker(db, prefix=""):
 
     class Repository(db.Model):
         """ Just as a cache of available repositories for user """
+        __table_args__ = (
+            db.Index("ux_repository_name", "owner", "name", unique=True),
+        )
         uuid = db.Column(db.Integer, primary_key=True, autoincrement=True)
         owner = db.Column(db.String(200), nullable=False)
         name = db.Column(db.String(200), nullable=False)
@@ -139,16 +279,108 @@ def model_maker(db, prefix=""):
 
         @property
         def last_master_test(self):
+            return self.latest_test(self.main_branch)
+
+        def latest_test(self, source):
+            """ Get the latest test of a branch or a pull request
+
+            The test is read through its LatestTest pointer. Branches without one, in databases which predate the
+            pointers, are looked up in the history.
+
+            :param source: Branch or Pull Request number
+            :return: Latest test or None
+            :rtype: RepoTest
+            """
+            latest = LatestTest.query.get((self.uuid, source))
+            if latest is not None:
+                return latest.test
             return self.tests.\
-                filter(RepoTest.source == self.main_branch).\
+                filter(RepoTest.source == source).\
                 order_by(RepoTest.run_at.desc()).\
                 first()
 
         def get_test(self, uuid):
-            return self.tests.\
+            test = self.tests.\
                 filter(RepoTest.uuid == uuid).\
                 order_by(RepoTest.run_at.desc()).\
                 first()
+            if test is None:
+                test = ArchivedTest.query.filter(
+                    ArchivedTest.repository == self.uuid, ArchivedTest.uuid == uuid
+                ).first()
+            return test
+
+        def diff_tests(self, base, head):
+            """ Compute the diff between two stored tests of the repository, archived or not
+
+            Results are stored as TestDiff rows and read back by later calls, up to TestDiff.CACHE_SIZE of them. Units
+            are compared in the database when both tests store them as rows, see StagedUnitDiff. The Units table is
+            missing from the diff when either test does not store its units anymore.
+
+            :param base: Test compared with
+            :type base: RepoTest or ArchivedTest
+            :param head: Test compared
+            :type head: RepoTest or ArchivedTest
+            :return: Diff dict, as given by RepoTest.diff
+            :rtype: dict
+            """
+            stored = TestDiff.query.get((head.uuid, base.uuid))
+            if stored is not None:
+                return stored.diff
+
+            unit_diff, staged = UnitDiff({}), False
+            has_units = base.has_units and head.has_units
+            if has_units:
+                if isinstance(base, RepoTest) and isinstance(head, RepoTest) and \
+                        not base.units_packed and not head.units_packed:
+                    unit_diff, staged = StagedUnitDiff(base).fill_test(head), True
+                else:
+                    unit_diff = UnitDiff(base.units_as_dict, copy=False).consume(head.units_as_dict)
+            diff = head.diff(base, (), head.words_count_as_dict or None, _unit_diff=unit_diff)
+            if staged:
+                unit_diff.clear()
+            if not has_units:
+                del diff["Units"]
+
+            if TestDiff.CACHE_SIZE > 0:
+                TestDiff.store(head, base, diff, on_ingest=False)
+                TestDiff.trim_cache()
+                db.session.commit()
+            return diff
+
+        def history(self):
+            """ Query the tests of the repository, archived ones included, the latest first
+
+            :return: Query of (Identifier, Run date, Coverage) tuples
+            """
+            history = db.union_all(
+                db.select([RepoTest.uuid, RepoTest.run_at, RepoTest.coverage]).
+                where(RepoTest.repository == self.uuid),
+                db.select([ArchivedTest.uuid, ArchivedTest.run_at, ArchivedTest.coverage]).
+                where(ArchivedTest.repository == self.uuid)
+            ).alias("history")
+            return db.session.query(history).order_by(history.c.run_at.desc(), history.c.uuid.desc())
+
+        def load_tests(self, uuids):
+            """ Load tests from the hot table or from the archive
+
+            :param uuids: Identifiers of the tests
+            :return: Tests, in the order of uuids
+            :rtype: [RepoTest or ArchivedTest]
+            """
+            uuids = list(uuids)
+            if not uuids:
+                return []
+            tests = {test.uuid: test for test in self.tests.filter(RepoTest.uuid.in_(uuids))}
+            missing = [uuid for uuid in uuids if uuid not in tests]
+            if missing:
+                tests.update({
+                    test.uuid: test
+                    for test in ArchivedTest.query.filter(
+                        ArchivedTest.repository == self.uuid, ArchivedTest.uuid.in_(missing)
+                    )
+                })
+            return [tests[uuid] for uuid in uuids if uuid in tests]
 
         def has_rights(self, user):
             """ Check that a user has rights to switch value on given repo
@@ -196,11 +428,12 @@ def model_maker(db, prefix=""):
 
             :param owner: Name of the repo owner
             :param name: Name of the repository
-            :param active: Whether this is actively receiving tests results
+            :param active: Whether the created repository is actively receiving tests results, \
+            an existing repository is found whether it is active or not
             :param _commit_on_create: Automatically commit if we created the repo
             :return:
             """
-            query = Repository.query.filter_by(owner=owner, name=name, active=active)
+            query = Repository.query.filter_by(owner=owner, name=name)
             repo = query.first()
             if not (repo):
                 repo = Repository(owner=owner, name=name, active=active)
@@ -223,13 +456,62 @@ def model_maker(db, prefix=""):
             else:
                 raise RightsException("Not enough rights")
 
+        def find_duplicates(self, builds):
+            """ Find tests already registered for some builds
+
+            :param builds: Iterable of (Travis Build Id, SHA) pairs. Pairs without SHA are never duplicates.
+            :return: Dictionary (Travis Build Id, SHA) -> RepoTest
+            :rtype: dict
+            """
+            builds = {(str(build_id), sha) for build_id, sha in builds if sha is not None}
+            if not builds:
+                return {}
+            tests = self.tests.filter(
+                RepoTest.travis_build_id.in_({build_id for build_id, _ in builds})
+            ).order_by(RepoTest.uuid)
+            duplicates = {}
+            for test in tests:
+                duplicates.setdefault((test.travis_build_id, test.sha), test)
+            return {key: test for key, test in duplicates.items() if key in builds}
+
+        def find_duplicate(self, travis_build_id, sha):
+            """ Find a test already registered for the same build and commit
+
+            :param travis_build_id: Travis Build Id
+            :param sha: SHA of the commit
+            :return: Former test or None
+            :rtype: RepoTest
+            """
+            return self.find_duplicates([(travis_build_id, sha)]).get((str(travis_build_id), sha))
+
+        @staticmethod
+        def registered(test):
+            """ Get a test registered before and the diff stored when it was
+
+            :param test: Former test
+            :type test: RepoTest
+            :return: Former test and its diff, None if it was not compared with any test
+            :rtype: (RepoTest, dict)
+            """
+            stored = TestDiff.of(test.uuid)
+            return test, stored.diff if stored is not None else None
+
         def register_test(
                 self, source, travis_uri, travis_build_id, user, avatar, texts_total,
                 texts_passing, metadata_total, metadata_passing, coverage, nodes_count,
-                units, words_count=None, sha=None, comment_uri=None, _get_diff=True, event_type="push"
+                units, words_count=None, sha=None, comment_uri=None, _get_diff=True, event_type="push",
+                _check_duplicate=True, _timer=None, _commit=True
         ):
             """ Save a test and produce a diff if this is master
 
+            A test for a build and commit which were already registered is not saved again : the former test is
+            returned with the diff stored when it was registered. Tests are unique by repository, build and commit, so
+            that a duplicate registered concurrently is found once the insert fails.
+
+            The test, its word counts and its units are written inside a savepoint : if anything fails, for example
+            streamed units which turn out to be malformed, nothing of the test is kept and the enclosing transaction
+            is left as it was.
+
             :param source: Source should be the Pull Request Number or the branch
             :type source: Str
             :param travis_uri: travis_uri
@@ -252,8 +534,8 @@ def model_maker(db, prefix=""):
             :type coverage: float
             :param nodes_count: nodes_count
             :type nodes_count: int
-            :param units: Dictionary Path->Status
-            :type units: dict
+            :param units: Dictionary Path->Status or iterable of (Path, Status) pairs, which is consumed only once
+            :type units: dict or iterable
             :param words_count: Dictionary LanguageCode -> Number of words
             :type words_count: dict
             :param comment_uri: URL Address of the comment
@@ -262,33 +544,188 @@ def model_maker(db, prefix=""):
             :type sha: str
             :param event_type: Type of the event
             :type event_type: str
+            :param _check_duplicate: Look for a former test of the same build and commit. When False, the caller looked
+            for it beforehand and a duplicate registered since is raised as DuplicateTest.
+            :param _timer: Timer recording the register, save_units and diff stages
+            :type _timer: StageTimer
+            :param _commit: Commit once the test is saved
             :return:
             """
+            if _timer is None:
+                _timer = StageTimer()
+
+            if _check_duplicate is True:
+                duplicate = self.find_duplicate(travis_build_id, sha)
+                if duplicate is not None:
+                    return Repository.registered(duplicate)
+
             last_master = self.last_master_test
-            repo = RepoTest(
-                repository=self.uuid, source=source, travis_uri=travis_uri,
-                travis_build_id=travis_build_id, user=user, avatar=avatar,
-                texts_total=texts_total, texts_passing=texts_passing, metadata_total=metadata_total,
-                metadata_passing=metadata_passing, coverage=coverage, nodes_count=nodes_count,
-                sha=sha, comment_uri=comment_uri, event_type=event_type
-            )
-            diff = None
-            if last_master is not None and _get_diff is True:
-                diff = repo.diff(self.last_master_test, units, words_count)
+            is_master = self.main_branch == source
+            # Units are compared with the ones of the last master in the database when it allows, see StagedUnitDiff
+            staged = RepoTest.SQL_DIFF and not RepoTest.PACK_UNITS and last_master is not None and \
+                not last_master.units_packed and (_get_diff is True or is_master)
+            former_units = None
+            if last_master is not None and (_get_diff is True or is_master) and not staged:
+                with _timer.stage("diff"):
+                    former_units = last_master.units_as_dict
+            # A master test is stored as the changes from the last master, unless the chain of deltas is long enough
+            # to be rebased on a full snapshot
+            as_delta = is_master and last_master is not None and not RepoTest.PACK_UNITS and \
+                not last_master.units_packed and last_master.snapshot_depth + 1 < RepoTest.SNAPSHOT_INTERVAL
+
+            savepoint = db.session.begin_nested()
+            try:
+                with _timer.stage("register"):
+                    repo = RepoTest(
+                        repository=self.uuid, source=source, travis_uri=travis_uri,
+                        travis_build_id=travis_build_id, user=user, avatar=avatar,
+                        texts_total=texts_total, texts_passing=texts_passing, metadata_total=metadata_total,
+                        metadata_passing=metadata_passing, coverage=coverage, nodes_count=nodes_count,
+                        sha=sha, comment_uri=comment_uri, event_type=event_type
+                    )
+                    if as_delta:
+                        repo.snapshot_parent = last_master.uuid
+                        repo.snapshot_base = last_master.snapshot_base or last_master.uuid
+                        repo.snapshot_depth = last_master.snapshot_depth + 1
+                    db.session.add(repo)
+                    db.session.flush()
+                    LatestTest.point(repo)
+
+                    if words_count is not None:
+                        repo.save_words_count(words_count, _commit=False)
+
+                # Units are read only once so that they can be streamed from the request body, and compared once
+                # with the former ones for both the delta and the diff
+                units = unit_pairs(units)
+                unit_diff = None
+                if former_units is not None:
+                    unit_diff = UnitDiff(former_units, copy=False)
+                if staged:
+                    with _timer.stage("diff"):
+                        unit_diff = StagedUnitDiff(last_master).fill(units)
+                    units = ()
+                    with _timer.stage("save_units"):
+                        if as_delta:
+                            unit_diff.insert_delta(repo)
+                        elif is_master:
+                            unit_diff.insert_snapshot(repo)
+                elif as_delta:
+                    units = repo.stream_delta(unit_diff.compare(units), unit_diff.deleted, _timer=_timer)
+                elif not is_master:
+                    # Units of other branches are not stored : they are compared without being passed through
+                    if unit_diff is not None and _get_diff is True:
+                        with _timer.stage("diff"):
+                            unit_diff.consume(units)
+                        units = ()
+                else:
+                    if unit_diff is not None and _get_diff is True:
+                        units = unit_diff.track(units)
+                    if RepoTest.PACK_UNITS:
+                        units = repo.stream_packed(units, _timer=_timer)
+                    else:
+                        units = repo.stream_units(units, _timer=_timer)
+
+                diff = None
+                if last_master is not None and _get_diff is True:
+                    with _timer.stage("diff"):
+                        diff = repo.diff(last_master, units, words_count, _unit_diff=unit_diff)
+                        TestDiff.store(repo, last_master, diff)
+                elif is_master:
+                    deque(units, maxlen=0)
+                if staged:
+                    unit_diff.clear()
+
+                if is_master and not as_delta and last_master is not None:
+                    with _timer.stage("save_units"):
+                        last_master.drop_snapshot()
+                savepoint.commit()
+            except IntegrityError:
+                savepoint.rollback()
+                # The same build was registered by a concurrent request
+                duplicate = self.find_duplicate(travis_build_id, sha)
+                if duplicate is None:
+                    raise
+                if _check_duplicate is True:
+                    return Repository.registered(duplicate)
+                raise DuplicateTest(
+                    "{} was already registered for {}".format(duplicate, self), *Repository.registered(duplicate)
+                )
+            except Exception:
+                savepoint.rollback()
+                raise
 
-            db.session.add(repo)
-            db.session.commit()
+            if _commit is True:
+                with _timer.stage("register"):
+                    db.session.commit()
+            return repo, diff
 
-            if words_count is not None:
-                repo.save_words_count(words_count)
+        def register_tests(self, reports, _commit=True):
+            """ Save many tests at once in a single transaction, without producing diffs
 
-            if self.main_branch == source:
-                repo.save_units(units, _commit=True, _last_master=last_master)
+            Reports are expected to be deduplicated with find_duplicates beforehand.
 
-            return repo, diff
+            Tests, word counts and units are inserted in bulk. As every master test replaces the units of the
+            previous one, only the units of the last master test of the batch are written, as a full snapshot.
+
+            :param reports: List of keyword arguments accepted by register_test, in chronological order
+            :type reports: [dict]
+            :param _commit: Automatically commit
+            :return: Registered tests, in the same order as reports
+            :rtype: [RepoTest]
+            """
+            last_master = self.last_master_test
+            tests = []
+            for report in reports:
+                kwargs = {
+                    key: value
+                    for key, value in report.items()
+                    if key not in ("units", "words_count", "_get_diff", "_check_duplicate")
+                }
+                test = RepoTest(repository=self.uuid, **kwargs)
+                if report.get("words_count") is not None:
+                    test.words_total, test.words_langs = materialize_words(report["words_count"])
+                tests.append(test)
+            db.session.add_all(tests)
+            db.session.flush()
+            for test in {test.source: test for test in tests}.values():
+                LatestTest.point(test)
+
+            bulk_insert(WordCount, (
+                {"test_id": test.uuid, "lang": lang, "count": count}
+                for test, report in zip(tests, reports)
+                for lang, count in (report.get("words_count") or {}).items()
+            ))
+
+            masters = [
+                (test, report)
+                for test, report in zip(tests, reports)
+                if report["source"] == self.main_branch
+            ]
+            if masters:
+                test, report = masters[-1]
+                if last_master is not None:
+                    last_master.drop_snapshot()
+                if RepoTest.PACK_UNITS:
+                    test.units_blob, test.units_packed = pack_units(report["units"]), True
+                else:
+                    insert_units((
+                        {"test_id": test.uuid, "path": path, "status": status}
+                        for path, status in unit_pairs(report["units"])
+                    ))
+
+            if _commit is True:
+                db.session.commit()
+            return tests
 
     class RepoTest(db.Model):
         """ Complete repository status """
+        __table_args__ = (
+            db.Index("ux_repo_test_build", "repository", "travis_build_id", "sha", unique=True),
+            db.Index("ix_repo_test_source", "repository", "source", "run_at"),
+            db.Index("ix_repo_test_history", "repository", "run_at"),
+            # Archived tests keep their identifier, which must never be given again to a new test
+            {"sqlite_autoincrement": True}
+        )
         uuid = db.Column(db.Integer, primary_key=True, autoincrement=True)
         repository = db.Column(db.Integer, db.ForeignKey('repository.uuid'), nullable=False)
 
@@ -314,6 +751,24 @@ def model_maker(db, prefix=""):
         coverage = db.Column(db.Float, nullable=False, default=0.0)
         nodes_count = db.Column(db.Integer, nullable=False, default=0)
 
+        """ Units of a master test are either a full snapshot, or the changes from the master test before it
+        (snapshot_parent), itself going back to a full snapshot (snapshot_base) """
+        snapshot_parent = db.Column(db.Integer, db.ForeignKey("repo_test.uuid"), nullable=True)
+        snapshot_base = db.Column(db.Integer, db.ForeignKey("repo_test.uuid"), nullable=True)
+        snapshot_depth = db.Column(db.Integer, nullable=False, default=0)
+
+        """ Word counts are also stored as a total and as a json map Language->Count, None for tests saved before """
+        words_total = db.Column(db.Integer, nullable=True)
+        words_langs = db.Column(db.Text, nullable=True)
+
+        """ Units can instead be stored as a single compressed blob, see Hook.packing """
+        units_packed = db.Column(db.Boolean, nullable=False, default=False)
+        units_blob = db.deferred(db.Column(db.LargeBinary, nullable=True))
+
+        SNAPSHOT_INTERVAL = 16
+        PACK_UNITS = False
+        SQL_DIFF = False
+
         units = db.relationship(
             "UnitTest",
             backref=db.backref('unit_test')
@@ -351,33 +806,168 @@ def model_maker(db, prefix=""):
         def save_units(self, unit_dict, _last_master=None, _force_clear=True, _commit=True):
             """ Save a dictionary of units in the database
 
-            :param unit_dict:
-            :type unit_dict:
+            Units are inserted in bulk, without going through the ORM, so the units relationship is expired
+            to be read again from the database.
+
+            :param unit_dict: Dictionary Path->Status or iterable of (Path, Status) pairs
+            :type unit_dict: dict or iterable
             :param _force_clear: Force removal of former scores
             :param _commit: Automatically commit
             :return:
             """
             if _force_clear:
                 if _last_master is not None:
-                    _last_master.dyn_units.delete()
-            for path, status in unit_dict.items():
-                u = UnitTest(path=path, status=status)
-                self.units.append(u)
+                    _last_master.drop_snapshot()
+            if RepoTest.PACK_UNITS:
+                self.units_blob, self.units_packed = pack_units(unit_dict), True
+            else:
+                if self.uuid is None:
+                    db.session.flush()
+                deque(self.stream_units(unit_pairs(unit_dict)), maxlen=0)
+                db.session.expire(self, ["units"])
             if _commit is True:
                 db.session.commit()
 
+        def stream_units(self, units, chunk_size=1000, _timer=None):
+            """ Insert units in the database by chunks while passing them through
+
+            :param units: Iterable of (Path, Status) pairs
+            :param chunk_size: Number of rows inserted at once
+            :param _timer: Timer recording the inserts as the save_units stage
+            :type _timer: StageTimer
+            :return: Generator of the same (Path, Status) pairs
+            """
+            if _timer is None:
+                _timer = StageTimer()
+            chunk = []
+            for path, status in units:
+                chunk.append({"test_id": self.uuid, "path": path, "status": status})
+                if len(chunk) >= chunk_size:
+                    with _timer.stage("save_units"):
+                        insert_units(chunk, chunk_size=chunk_size)
+                    chunk = []
+                yield path, status
+            if chunk:
+                with _timer.stage("save_units"):
+                    insert_units(chunk, chunk_size=chunk_size)
+
+        def stream_packed(self, units, _timer=None):
+            """ Pass units through and store them as a packed blob once they are exhausted
+
+            :param units: Iterable of (Path, Status) pairs
+            :param _timer: Timer recording the packing as the save_units stage
+            :type _timer: StageTimer
+            :return: Generator of the same (Path, Status) pairs
+            """
+            if _timer is None:
+                _timer = StageTimer()
+            seen = []
+            for path, status in units:
+                seen.append((path, status))
+                yield path, status
+            with _timer.stage("save_units"):
+                self.units_blob, self.units_packed = pack_units(seen), True
+
+        def stream_delta(self, comparison, deleted, chunk_size=1000, _timer=None):
+            """ Insert the units which changed since the parent snapshot while passing every unit through
+
+            Once the comparison is exhausted, the paths of the parent snapshot which were not seen are inserted as
+            deleted.
+
+            :param comparison: Iterable of (Path, Status, Changed) triples, see UnitDiff.compare
+            :param deleted: Units of the parent snapshot left once the comparison is exhausted, see UnitDiff.deleted
+            :type deleted: dict
+            :param chunk_size: Number of rows inserted at once
+            :param _timer: Timer recording the inserts as the save_units stage
+            :type _timer: StageTimer
+            :return: Generator of the same (Path, Status) pairs
+            """
+            if _timer is None:
+                _timer = StageTimer()
+            chunk = []
+            for path, status, changed in comparison:
+                if changed:
+                    chunk.append({"test_id": self.uuid, "path": path, "status": status, "deleted": False})
+                    if len(chunk) >= chunk_size:
+                        with _timer.stage("save_units"):
+                            insert_units(chunk, chunk_size=chunk_size)
+                        chunk = []
+                yield path, status
+            with _timer.stage("save_units"):
+                insert_units(chunk + [
+                    {"test_id": self.uuid, "path": path, "status": status, "deleted": True}
+                    for path, status in deleted.items()
+                ], chunk_size=chunk_size)
+
+        def snapshot_chain(self):
+            """ Identifiers of the tests whose units make the snapshot of this test, from the full snapshot to this one
+
+            :raises BrokenSnapshot: When a test of the chain was deleted, the units cannot be rebuilt anymore
+            :rtype: [int]
+            """
+            if self.snapshot_base is None:
+                return [self.uuid]
+            parents = dict(
+                db.session.query(RepoTest.uuid, RepoTest.snapshot_parent).
+                filter(RepoTest.snapshot_base == self.snapshot_base)
+            )
+            chain, current = [self.uuid], self.snapshot_parent
+            while current != self.snapshot_base:
+                if current not in parents:
+                    raise BrokenSnapshot(
+                        "Test {} of the snapshot chain of test {} is missing".format(current, self.uuid),
+                        test=self, missing=current
+                    )
+                chain.append(current)
+                current = parents[current]
+            chain.append(self.snapshot_base)
+            return chain[::-1]
+
+        def snapshot_rows(self, *filters):
+            """ Query the unit rows of the snapshot chain, the oldest first
+
+            :param filters: Additional filters over UnitTest and UnitPath
+            :return: Query of (Path, Status, Deleted) tuples
+            """
+            return db.session.query(UnitPath.path, UnitTest.status, UnitTest.deleted).\
+                join(UnitPath, UnitPath.uuid == UnitTest.path_id).\
+                join(RepoTest, RepoTest.uuid == UnitTest.test_id).\
+                filter(UnitTest.test_id.in_(self.snapshot_chain()), *filters).\
+                order_by(RepoTest.snapshot_depth)
+
+        def drop_snapshot(self):
+            """ Delete the units of the whole snapshot chain this test belongs to, once a new full snapshot replaced it
+            """
+            base = self.snapshot_base or self.uuid
+            chain = db.session.query(RepoTest.uuid).filter(RepoTest.snapshot_base == base)
+            UnitTest.query.filter(
+                db.or_(UnitTest.test_id == base, UnitTest.test_id.in_(chain))
+            ).delete(synchronize_session=False)
+            if self.units_packed:
+                self.units_blob = None
+            db.session.expire(self, ["units"])
+
         def save_words_count(self, words_count, _last_master=None, _force_clear=True, _commit=True):
             """ Save a dictionary of units in the database
 
+            The total and the counts per language are also stored on the test itself, so that badges and pages
+            read them without loading the WordCount rows.
+
             :param words_count: Key-value pairs of lang code + word count
             :param _commit: Automatically commit
             :return:
             """
             if _force_clear and _last_master is not None:
                 _last_master.dyn_words.delete()
-            for lang, count in words_count.items():
-                u = WordCount(lang=lang, count=count)
-                self.words_count.append(u)
+                _last_master.words_total, _last_master.words_langs = None, None
+            if self.uuid is None:
+                db.session.flush()
+            bulk_insert(WordCount, (
+                {"test_id": self.uuid, "lang": lang, "count": count}
+                for lang, count in words_count.items()
+            ))
+            self.words_total, self.words_langs = materialize_words(words_count)
+            db.session.expire(self, ["words_count"])
             if _commit is True:
                 db.session.commit()
 
@@ -387,76 +977,91 @@ def model_maker(db, prefix=""):
             :param path: Path of the unit
             :return: Status
             """
-            data = self.dyn_units.filter(UnitTest.path == path).first()
-            if data is not None:
-                return data.status
+            if self.units_packed:
+                return self.packed_units.get(path)
+            rows = self.snapshot_rows(UnitPath.path == path).all()
+            if rows and not rows[-1].deleted:
+                return rows[-1].status
 
-        def diff(self, last_master, units, words_count):
+        def diff(self, last_master, units, words_count, _former_units=None, _unit_diff=None):
             """ Compute the diff between two repos given another repo and current repo units and word count
 
             :param last_master: Last Master Test
             :type last_master: RepoTest
-            :param units:
-            :param words_count:
+            :param units: Dictionary Path->Status or iterable of (Path, Status) pairs
+            :param words_count: Dictionary LanguageCode -> Number of words
+            :param _former_units: Units of last_master, when they were already read
+            :param _unit_diff: Comparison with the units of last_master that units go through, when it already exists
+            :type _unit_diff: UnitDiff
             :return:
             """
-            items = [
-                (self.diff_dict, last_master.diff_dict, "Global"),
-                (units, last_master.units_as_dict, "Units")
-            ]
+            if _unit_diff is None:
+                if _former_units is None:
+                    _former_units = last_master.units_as_dict
+                _unit_diff = UnitDiff(_former_units).consume(units)
+            else:
+                deque(unit_pairs(units), maxlen=0)
+            new, deleted, changed = _unit_diff.categories()
+            unit_changes = defaultdict(list)
+            if new:
+                unit_changes["New"] = [self.new_object(path) for path in new]
+            if deleted:
+                unit_changes["Deleted"] = [self.del_object(path) for path in deleted]
+            if changed:
+                unit_changes["Changed"] = [self.pass_fail_object(path, status) for path, status in changed]
+
+            items = [(self.diff_dict, last_master.diff_dict, "Global")]
             if words_count is not None:
                 items.append((words_count, last_master.words_count_as_dict, "Words"))
-            ret = {}
+            ret = {"Units": unit_changes}
             for me, you, name in items:
                 current = defaultdict(list)
-                complete_keys = set(list(me.keys()) + list(you.keys()))
-                for key in complete_keys:
+                # Keys left in you once me has been read are the deleted ones
+                you = dict(you)
+                for key, value in unit_pairs(me):
                     if key not in you:
                         current["New"].append(self.new_object(key))
-                        if isinstance(me[key], bool):
-                            current["Changed"].append(self.pass_fail_object(key, me[key]))
-                    elif key not in me:
-                        current["Deleted"].append(self.del_object(key))
-                    elif me[key] != you[key]:
-                        if isinstance(me[key], bool):
-                            current["Changed"].append(self.pass_fail_object(key, me[key]))
-                        elif isinstance(me[key], float):
-                            if not isclose(me[key], you[key], rel_tol=0.0001):
-                                current["Changed"].append(self.diff_int_object(key, me[key] - you[key]))
+                        if isinstance(value, bool):
+                            current["Changed"].append(self.pass_fail_object(key, value))
+                        continue
+                    former = you.pop(key)
+                    if value != former:
+                        if isinstance(value, bool):
+                            current["Changed"].append(self.pass_fail_object(key, value))
+                        elif isinstance(value, float):
+                            if not isclose(value, former, rel_tol=0.0001):
+                                current["Changed"].append(self.diff_int_object(key, value - former))
                         else:
-                            current["Changed"].append(self.diff_int_object(key, me[key]-you[key]))
+                            current["Changed"].append(self.diff_int_object(key, value-former))
+                for key in you:
+                    current["Deleted"].append(self.del_object(key))
                 for key, val in current.items():
                     current[key] = sorted(val, key=itemgetter(0))
                 ret[name] = current
             return ret
 
         @staticmethod
-        def table(diff_dict, mode="md"):
+        def table(diff_dict, mode="md", budget=None, link=None):
             """ Takes a diff dict and creates a table from it
 
             :param diff_dict: Diff dict from self.diff
             :param mode: md or html given the wished output
+            :param budget: Maximum size of the table in bytes, rows beyond it being counted instead, see \
+            Hook.rendering. None for no limit.
+            :param link: Address of the full diff, linked from the count of the rows left out
             :return: Table as string
             """
-            if mode == "md":
-                mode = "pipe"
-            output = []
-            keys = ["Global", "Units"]
-            if "Words" in diff_dict:
-                keys = ["Global", "Words", "Units"]
-            for name in keys:
-                table = diff_dict[name]
-                if len(table["New"] + table["Deleted"] + table["Changed"]) > 0:
-                    output.append("## %s" % name)
-                    output.append(
-                        tabulate(
-                            [["`"+item+"`", value] for item, value in sorted((table["New"] + table["Deleted"]), key=itemgetter(0))] + \
-                            [["`"+item+"`", value] for item, value in sorted(table["Changed"], key=itemgetter(0))],
-                            ["Changed", "Status"],
-                            tablefmt=mode
-                        )
-                    )
-            return "\n\n".join(output)
+            return render_diff(diff_dict, mode=mode, budget=budget, link=link)
+
+        @staticmethod
+        def diff_rows(diff_dict):
+            """ Rows of the tables of a diff dict, new and deleted items first
+
+            :param diff_dict: Diff dict from self.diff, whose Words and Units tables may be missing
+            :return: (Name, [(Item, Status)]) for each table which is not empty, in display order
+            :rtype: [(str, [(str, str)])]
+            """
+            return [(name, list(rows)) for name, _, rows in diff_tables(diff_dict)]
 
         @property
         def diff_dict(self):
@@ -472,8 +1077,7 @@ def model_maker(db, prefix=""):
         @property
         def dict(self):
             dct = self.diff_dict
-            if self.words_count is not None:
-                dct["words_count"] = self.words_count_as_dict
+            dct["words_count"] = self.words_count_as_dict
 
             if self.comment_uri is not None:
                 dct["comment_uri"] = self.comment_uri
@@ -506,30 +1110,378 @@ def model_maker(db, prefix=""):
 
         @property
         def words_count_as_dict(self):
+            if self.words_langs is not None:
+                return json.loads(self.words_langs)
+            # Tests saved before the counts were stored on the test
             return {
                 wc.lang: wc.count
                 for wc in self.words_count
             }
 
+        @property
+        def words_sum(self):
+            """ Total number of words of the test
+
+            :rtype: int
+            """
+            if self.words_total is not None:
+                return self.words_total
+            return sum(self.words_count_as_dict.values())
+
+        @property
+        def packed_units(self):
+            """ Decoded view over the packed units of the test
+
+            :rtype: PackedUnits
+            """
+            return PackedUnits(self.units_blob or pack_units({}))
+
         @property
         def units_as_dict(self):
-            return {
-                u.path: u.status
-                for u in self.units
-            }
+            if self.units_packed:
+                return self.packed_units.as_dict()
+            units = {}
+            for path, status, deleted in self.snapshot_rows():
+                if deleted:
+                    units.pop(path, None)
+                else:
+                    units[path] = status
+            return units
+
+        @property
+        def has_units(self):
+            """ Whether the units of the test are stored : only master tests store them, until a new snapshot or the
+            retention policy drops them
+
+            :rtype: bool
+            """
+            if self.units_packed:
+                return self.units_blob is not None
+            return db.session.query(
+                UnitTest.query.filter(UnitTest.test_id.in_(self.snapshot_chain())).exists()
+            ).scalar()
+
+    class ArchivedTest(db.Model):
+        """ Test moved out of the hot tables by the hook-archive command
+
+        It keeps the identifier and the summary columns of the test. Its word counts are stored as json and its
+        units as a packed blob (see Hook.packing), so that archived tests do not weigh on the UnitTest and WordCount
+        tables nor on their indexes.
+        """
+        __table_args__ = (
+            db.Index("ix_archived_test_history", "repository", "run_at"),
+        )
+        uuid = db.Column(db.Integer, primary_key=True, autoincrement=False)
+        repository = db.Column(db.Integer, db.ForeignKey('repository.uuid'), nullable=False)
+        run_at = db.Column(db.DateTime, nullable=True)
+        archived_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+        source = db.Column(db.String(250), nullable=None)
+        sha = db.Column(db.String(64), nullable=True)
+        travis_uri = db.Column(db.String(2000), nullable=False)
+        travis_build_id = db.Column(db.String(10), nullable=False)
+        user = db.Column(db.String(200), nullable=False)
+        avatar = db.Column(db.String(2000), nullable=False)
+        comment_uri = db.Column(db.String(2000), nullable=True)
+        event_type = db.Column(db.String(12), nullable=False, default="push")
+
+        texts_total = db.Column(db.Integer, nullable=False, default=0)
+        texts_passing = db.Column(db.Integer, nullable=False, default=0)
+        metadata_total = db.Column(db.Integer, nullable=False, default=0)
+        metadata_passing = db.Column(db.Integer, nullable=False, default=0)
+        coverage = db.Column(db.Float, nullable=False, default=0.0)
+        nodes_count = db.Column(db.Integer, nullable=False, default=0)
+
+        words = db.Column(db.Text, nullable=False, default="{}")
+        units_blob = db.deferred(db.Column(db.LargeBinary, nullable=True))
+
+        repository_dyn = db.relationship("Repository")
+
+        SUMMARY = (
+            "uuid", "repository", "run_at", "source", "sha", "travis_uri", "travis_build_id", "user", "avatar",
+            "comment_uri", "event_type", "texts_total", "texts_passing", "metadata_total", "metadata_passing",
+            "coverage", "nodes_count"
+        )
+        units_packed = True
+
+        status = RepoTest.status
+        diff_dict = RepoTest.diff_dict
+        dict = RepoTest.dict
+        packed_units = RepoTest.packed_units
+        diff = RepoTest.diff
+        new_object, del_object = staticmethod(RepoTest.new_object), staticmethod(RepoTest.del_object)
+        pass_fail_object = staticmethod(RepoTest.pass_fail_object)
+        diff_int_object = staticmethod(RepoTest.diff_int_object)
+
+        def __repr__(self):
+            return self.travis_build_id
+
+        @staticmethod
+        def from_test(test):
+            """ Archive a test
+
+            :param test: Test to archive
+            :type test: RepoTest
+            :return: Archived version of the test, not yet added to the session
+            :rtype: ArchivedTest
+            """
+            archived = ArchivedTest(**{column: getattr(test, column) for column in ArchivedTest.SUMMARY})
+            archived.words = json.dumps(test.words_count_as_dict, sort_keys=True)
+            if test.units_packed:
+                archived.units_blob = test.units_blob
+            elif test.has_units:
+                archived.units_blob = pack_units(test.units_as_dict)
+            return archived
+
+        @property
+        def words_count_as_dict(self):
+            return json.loads(self.words)
+
+        @property
+        def words_sum(self):
+            return sum(self.words_count_as_dict.values())
+
+        @property
+        def units_as_dict(self):
+            return self.packed_units.as_dict()
+
+        @property
+        def has_units(self):
+            return self.units_blob is not None
+
+        def get_unit(self, path):
+            """ Retrieve a unit given a path
+
+            :param path: Path of the unit
+            :return: Status
+            """
+            return self.packed_units.get(path)
+
+    class LatestTest(db.Model):
+        """ Pointer to the latest test of each branch or pull request of a repository, so that badges and pages
+        read it by primary key instead of sorting the history """
+        repository = db.Column(db.Integer, db.ForeignKey('repository.uuid'), primary_key=True)
+        source = db.Column(db.String(250), primary_key=True)
+        test_id = db.Column(db.Integer, db.ForeignKey("repo_test.uuid"), nullable=False)
+
+        test = db.relationship("RepoTest", lazy="joined")
+
+        def __repr__(self):
+            return "{}:{}".format(self.source, self.test_id)
+
+        @staticmethod
+        def point(test):
+            """ Make a test the latest one of its branch
+
+            The pointer is inserted in a savepoint and updated when it exists, including when another process
+            inserted it concurrently.
+
+            :param test: Test, already flushed
+            :type test: RepoTest
+            """
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(LatestTest.__table__.insert().values(
+                        repository=test.repository, source=test.source, test_id=test.uuid
+                    ))
+            except IntegrityError:
+                LatestTest.query.filter(
+                    LatestTest.repository == test.repository, LatestTest.source == test.source
+                ).update({"test_id": test.uuid}, synchronize_session="evaluate")
+
+        @staticmethod
+        def rebuild(repository=None):
+            """ Point each branch to its latest test again, once tests were deleted or archived
+
+            :param repository: Identifier of the repository whose pointers are rebuilt, None for every repository
+            :return: Number of pointers
+            :rtype: int
+            """
+            tests = db.session.query(RepoTest.repository, RepoTest.source, RepoTest.uuid).\
+                order_by(RepoTest.run_at, RepoTest.uuid)
+            pointers = LatestTest.query
+            if repository is not None:
+                tests = tests.filter(RepoTest.repository == repository)
+                pointers = pointers.filter(LatestTest.repository == repository)
+            latest = {(repo, source): uuid for repo, source, uuid in tests}
+            pointers.delete(synchronize_session="fetch")
+            bulk_insert(LatestTest, (
+                {"repository": repo, "source": source, "test_id": uuid}
+                for (repo, source), uuid in latest.items()
+            ))
+            return len(latest)
+
+    class TestDiff(db.Model):
+        """ Diff of a test against the test it was compared with when it was registered
+
+        Diffs are stored as given by pack_diff, so that reports and comments read them back once the units of the
+        base test are gone. They are kept when their tests are archived.
+        """
+        __table_args__ = (
+            db.Index("ix_test_diff_cache", "on_ingest", "created_at"),
+        )
+        test_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+        base_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+        blob = db.Column(db.LargeBinary, nullable=False)
+        """ Diffs computed later through Repository.diff_tests are not the diff of the test """
+        on_ingest = db.Column(db.Boolean, nullable=False, default=True)
+        created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+        """ Number of comparisons of Repository.diff_tests kept, the oldest ones being deleted beyond it """
+        CACHE_SIZE = 1000
+
+        def __repr__(self):
+            return "{}:{}".format(self.test_id, self.base_id)
+
+        @property
+        def diff(self):
+            """ Diff dict, as given by RepoTest.diff
+
+            :rtype: dict
+            """
+            return unpack_diff(self.blob)
+
+        @staticmethod
+        def store(test, base, diff, on_ingest=True):
+            """ Save the diff of a test
+
+            :param test: Test, already flushed
+            :type test: RepoTest
+            :param base: Test it was compared with
+            :type base: RepoTest
+            :param diff: Diff dict from RepoTest.diff
+            :param on_ingest: Whether the diff was computed when the test was registered
+            """
+            values = dict(blob=pack_diff(diff), on_ingest=on_ingest, created_at=datetime.datetime.utcnow())
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(TestDiff.__table__.insert().values(
+                        test_id=test.uuid, base_id=base.uuid, **values
+                    ))
+            except IntegrityError:
+                # A comparison stored concurrently is the same one, the diff of the test replaces it
+                if on_ingest:
+                    TestDiff.query.filter(TestDiff.test_id == test.uuid, TestDiff.base_id == base.uuid).\
+                        update(values, synchronize_session="evaluate")
+
+        @staticmethod
+        def trim_cache():
+            """ Delete the oldest comparisons of Repository.diff_tests beyond CACHE_SIZE
+
+            :return: Number of deleted comparisons
+            :rtype: int
+            """
+            cached = TestDiff.query.filter(TestDiff.on_ingest == db.false())
+            oldest_kept = cached.with_entities(TestDiff.created_at).order_by(TestDiff.created_at.desc()).\
+                offset(TestDiff.CACHE_SIZE).limit(1).scalar()
+            if oldest_kept is None:
+                return 0
+            return cached.filter(
+                db.or_(TestDiff.created_at <= oldest_kept, TestDiff.created_at.is_(None))
+            ).delete(synchronize_session=False)
+
+        @staticmethod
+        def involving(ids):
+            """ Query the diffs to delete with some tests : their own diffs and the comparisons made against them
+
+            Diffs computed against them when a later test was registered are kept, as they are the report of the
+            later test.
+
+            :param ids: Identifiers of the tests, or a query of them
+            :return: Query of TestDiff
+            """
+            return TestDiff.query.filter(db.or_(
+                TestDiff.test_id.in_(ids),
+                db.and_(TestDiff.base_id.in_(ids), TestDiff.on_ingest == db.false())
+            ))
+
+        @staticmethod
+        def of(test_id):
+            """ Get the latest stored diff of a test
+
+            :param test_id: Identifier of the test, archived or not
+            :return: Diff stored when the test was registered, or None
+            :rtype: TestDiff
+            """
+            return TestDiff.query.filter(TestDiff.test_id == test_id, TestDiff.on_ingest == db.true()).\
+                order_by(TestDiff.base_id.desc()).first()
+
+    class UnitPath(db.Model):
+        """ Paths of units, stored once and referenced by their identifier """
+        uuid = db.Column(db.Integer, primary_key=True, autoincrement=True)
+        path = db.Column(db.String(400), nullable=False, unique=True)
+
+        @staticmethod
+        def resolve(paths, chunk_size=500):
+            """ Get the identifiers of paths, interning the unknown ones
+
+            Known identifiers are kept in a process-wide cache. Paths inserted by the current transaction are not
+            cached until they are read again, so that a rollback cannot leave unknown identifiers in the cache.
+
+            :param paths: Iterable of paths
+            :param chunk_size: Number of paths looked up at once
+            :return: Dictionary Path->Identifier
+            :rtype: dict
+            """
+            ids, missing = {}, []
+            for path in set(paths):
+                uuid = path_cache.get(path)
+                if uuid is None:
+                    missing.append(path)
+                else:
+                    ids[path] = uuid
+
+            lookup = db.select([UnitPath.path, UnitPath.uuid]).\
+                where(UnitPath.path.in_(db.bindparam("paths", expanding=True)))
+            for start in range(0, len(missing), chunk_size):
+                chunk = missing[start:start + chunk_size]
+                found = dict(db.session.execute(lookup, {"paths": chunk}).fetchall())
+                for path, uuid in found.items():
+                    path_cache.set(path, uuid, float("inf"))
+                new = [path for path in chunk if path not in found]
+                while new:
+                    try:
+                        with db.session.begin_nested():
+                            bulk_insert(UnitPath, ({"path": path} for path in new))
+                    except IntegrityError as error:
+                        # Another process interned some of them first : the savepoint dropped the others as well,
+                        # they are inserted again without the paths found now
+                        interned = dict(db.session.execute(lookup, {"paths": new}).fetchall())
+                        if not interned:
+                            raise error
+                        found.update(interned)
+                        new = [path for path in new if path not in interned]
+                    else:
+                        found.update(db.session.execute(lookup, {"paths": new}).fetchall())
+                        new = []
+                ids.update(found)
+            return ids
 
     class UnitTest(db.Model):
         """ Units parts of model """
+        __table_args__ = (
+            db.Index("ix_unit_test_path", "test_id", "path_id"),
+        )
         uuid = db.Column(db.Integer, primary_key=True, autoincrement=True)
         test_id = db.Column(db.Integer, db.ForeignKey("repo_test.uuid"))
-        path = db.Column(db.String(400), nullable=False)
+        path_id = db.Column(db.Integer, db.ForeignKey("unit_path.uuid"), nullable=False)
         status = db.Column(db.Boolean, nullable=False)
+        deleted = db.Column(db.Boolean, nullable=False, default=False)
+
+        path_dyn = db.relationship("UnitPath")
+
+        @property
+        def path(self):
+            return self.path_dyn.path
 
         def __repr__(self):
             return self.path
 
     class WordCount(db.Model):
         """ Units parts of model """
+        __table_args__ = (
+            db.Index("ix_word_count_test", "test_id"),
+        )
         uuid = db.Column(db.Integer, primary_key=True, autoincrement=True)
         test_id = db.Column(db.Integer, db.ForeignKey("repo_test.uuid"))
         lang = db.Column(db.String(5), nullable=False)
@@ -538,13 +1490,397 @@ def model_maker(db, prefix=""):
         def __repr__(self):
             return "{}:{}".format(self.lang, self.count)
 
+    class IngestJob(db.Model):
+        """ HookTest report stored durably until an ingest worker processes it
+
+        :param repository: Repository the report was sent for
+        :type repository: int
+        :param payload: Raw body of the request, as signed by HookTest
+        :type payload: bytes
+        :param content_encoding: Compression of the payload, gzip, deflate or None
+        :type content_encoding: str
+        :param host_url: Root URL of the request that queued the job, used to build links outside of requests
+        :type host_url: str
+        :param status: One of queued, running, success or error
+        :type status: str
+        :param claimed_at: Date the job was last claimed by a worker
+        :type claimed_at: datetime
+        """
+        uuid = db.Column(db.Integer, primary_key=True, autoincrement=True)
+        repository = db.Column(db.Integer, db.ForeignKey('repository.uuid'), nullable=False)
+        payload = db.Column(db.LargeBinary, nullable=False)
+        content_encoding = db.Column(db.String(12), nullable=True)
+        host_url = db.Column(db.String(2000), nullable=True)
+
+        status = db.Column(db.String(12), nullable=False, default="queued")
+        created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+        updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+        claimed_at = db.Column(db.DateTime, nullable=True)
+
+        test_id = db.Column(db.Integer, db.ForeignKey("repo_test.uuid"), nullable=True)
+        error = db.Column(db.Text, nullable=True)
+
+        repository_dyn = db.relationship("Repository")
+
+        QUEUED, RUNNING, SUCCESS, ERROR = "queued", "running", "success", "error"
+
+        @staticmethod
+        def claim(lease=None):
+            """ Take the oldest queued job and mark it as running
+
+            Jobs left running by a worker which died, thread or process, are claimed again once their lease expired.
+
+            :param lease: Seconds after which a running job is claimed again, None to never claim it again
+            :return: Claimed job or None if the queue is empty
+            :rtype: IngestJob
+            """
+            return claim_next(IngestJob, IngestJob.query, IngestJob.QUEUED, IngestJob.RUNNING, lease=lease)
+
+        def finish(self, test=None, error=None, _commit=True):
+            """ Record the outcome of the job
+
+            :param test: Test registered by the job
+            :type test: RepoTest
+            :param error: Error message if the job failed
+            :param _commit: Automatically commit
+            """
+            if error is not None:
+                self.status = IngestJob.ERROR
+                self.error = error
+            else:
+                self.status = IngestJob.SUCCESS
+                self.test_id = test.uuid
+            if _commit is True:
+                db.session.commit()
+
+        @property
+        def dict(self):
+            dct = {
+                "job": self.uuid,
+                "status": self.status,
+                "created_at": self.created_at
+            }
+            if self.test_id is not None:
+                dct["test"] = self.test_id
+            if self.error is not None:
+                dct["error"] = self.error
+            return dct
+
+        def __repr__(self):
+            return "<IngestJob {}:{}>".format(self.uuid, self.status)
+
+    class CommentOutbox(db.Model):
+        """ GitHub comment waiting to be posted by the comment dispatcher
+
+        :param test_id: Test the comment is about
+        :type test_id: int
+        :param uri: GitHub API resource to post the comment to
+        :type uri: str
+        :param body: Markdown body of the comment
+        :type body: str
+        :param attempts: Number of failed attempts
+        :type attempts: int
+        :param next_attempt_at: Date before which the comment should not be retried
+        :type next_attempt_at: datetime
+        """
+        uuid = db.Column(db.Integer, primary_key=True, autoincrement=True)
+        test_id = db.Column(db.Integer, db.ForeignKey("repo_test.uuid"), nullable=False)
+        uri = db.Column(db.String(2000), nullable=False)
+        body = db.Column(db.Text, nullable=False)
+
+        status = db.Column(db.String(12), nullable=False, default="pending")
+        attempts = db.Column(db.Integer, nullable=False, default=0)
+        created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+        next_attempt_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+        claimed_at = db.Column(db.DateTime, nullable=True)
+        error = db.Column(db.Text, nullable=True)
+
+        test = db.relationship("RepoTest")
+
+        PENDING, SENDING, SENT, FAILED = "pending", "sending", "sent", "failed"
+
+        @staticmethod
+        def claim(lease=None, max_attempts=5):
+            """ Take the oldest comment due for posting and mark it as sending
+
+            Comments left sending by a dispatcher which died are first counted as failed attempts, see release_stale.
+
+            :param lease: Seconds after which a comment still sending is considered lost with its dispatcher, None to \
+            wait for it forever
+            :param max_attempts: Number of attempts after which a lost comment is given up
+            :return: Claimed comment or None if no comment is due
+            :rtype: CommentOutbox
+            """
+            if lease is not None:
+                CommentOutbox.release_stale(lease, max_attempts=max_attempts)
+            return claim_next(
+                CommentOutbox,
+                CommentOutbox.query.filter(CommentOutbox.next_attempt_at <= datetime.datetime.utcnow()),
+                CommentOutbox.PENDING, CommentOutbox.SENDING
+            )
+
+        @staticmethod
+        def release_stale(lease, max_attempts=5, _commit=True):
+            """ Record the comments claimed longer ago than the lease as failed attempts, to be retried right away or
+            given up. The comment may have been posted before its dispatcher died : it is then posted twice.
+
+            :param lease: Seconds after which a comment still sending is considered lost with its dispatcher
+            :param max_attempts: Number of attempts after which a comment is given up
+            :param _commit: Automatically commit
+            :return: Number of released comments
+            :rtype: int
+            """
+            attempts = CommentOutbox.attempts + 1
+            released = CommentOutbox.query.filter(
+                CommentOutbox.status == CommentOutbox.SENDING,
+                CommentOutbox.claimed_at < datetime.datetime.utcnow() - datetime.timedelta(seconds=lease)
+            ).update({
+                "attempts": attempts,
+                "status": db.case([(attempts >= max_attempts, CommentOutbox.FAILED)], else_=CommentOutbox.PENDING),
+                "error": "Comment dispatcher stopped while posting"
+            }, synchronize_session=False)
+            if _commit is True:
+                db.session.commit()
+            return released
+
+        def sent(self, comment_uri, _commit=True):
+            """ Record a successful post and report its address on the test
+
+            :param comment_uri: URL Address of the comment
+            :param _commit: Automatically commit
+            """
+            self.status = CommentOutbox.SENT
+            self.test.comment_uri = comment_uri
+            if _commit is True:
+                db.session.commit()
+
+        def retry(self, error, backoff=30, max_backoff=3600, max_attempts=5, _commit=True):
+            """ Record a failed post and schedule the next attempt with an exponential backoff
+
+            :param error: Error message of the attempt
+            :param backoff: Seconds to wait after the first failure, doubled at each new failure
+            :param max_backoff: Maximum number of seconds to wait between two attempts
+            :param max_attempts: Number of attempts after which the comment is given up
+            :param _commit: Automatically commit
+            """
+            self.attempts += 1
+            self.error = error
+            if self.attempts >= max_attempts:
+                self.status = CommentOutbox.FAILED
+            else:
+                self.status = CommentOutbox.PENDING
+                self.next_attempt_at = datetime.datetime.utcnow() + datetime.timedelta(
+                    seconds=min(max_backoff, backoff * 2 ** (self.attempts - 1))
+                )
+            if _commit is True:
+                db.session.commit()
+
+        def __repr__(self):
+            return "<CommentOutbox {}:{}>".format(self.uuid, self.status)
+
+    class CacheEntry(db.Model):
+        """ Value of the database cache backend, shared by every process """
+        key = db.Column(db.String(255), primary_key=True)
+        value = db.Column(db.Text, nullable=False)
+        expires_at = db.Column(db.DateTime, nullable=False)
+
+        def __repr__(self):
+            return self.key
+
+    class StagedUnitDiff(object):
+        """ Comparison of units with the snapshot of a former test, computed by the database
+
+        Units are staged in a temporary table next to the snapshot of the former test, so that only their
+        differences are read back and the delta or snapshot of the new test is written without leaving the database.
+        Memory stays flat whatever the number of units, at the cost of a few more statements per ingest. Packed
+        snapshots cannot be joined and are compared with Hook.diffing.UnitDiff instead.
+
+        :param former: Test whose snapshot is compared with
+        :type former: RepoTest
+        """
+        FORMER, CURRENT = 0, 1
+
+        # Temporary tables only live on the connection which creates them : the stage is kept out of the metadata
+        # of the models and created on the connection of the session when needed
+        table = db.Table(
+            "hook_unit_stage", db.MetaData(),
+            db.Column("side", db.SmallInteger, primary_key=True),
+            db.Column("path_id", db.Integer, primary_key=True),
+            db.Column("status", db.Boolean, nullable=False),
+            prefixes=["TEMPORARY"]
+        )
+
+        def __init__(self, former):
+            self.former = former
+
+        def fill(self, units, chunk_size=1000):
+            """ Stage units and the snapshot of the former test
+
+            :param units: Dictionary Path->Status or iterable of (Path, Status) pairs, each path appearing once
+            :param chunk_size: Number of units staged at once
+            :return: Itself
+            :rtype: StagedUnitDiff
+            """
+            self.create()
+            chunk = []
+            for pair in unit_pairs(units):
+                chunk.append(pair)
+                if len(chunk) >= chunk_size:
+                    self.stage_chunk(chunk)
+                    chunk = []
+            if chunk:
+                self.stage_chunk(chunk)
+            self.stage_snapshot(self.former, self.FORMER)
+            return self
+
+        def fill_test(self, test):
+            """ Stage the snapshot of a stored test and the snapshot of the former test
+
+            :param test: Test whose units are stored as rows
+            :type test: RepoTest
+            :return: Itself
+            :rtype: StagedUnitDiff
+            """
+            self.create()
+            self.stage_snapshot(test, self.CURRENT)
+            self.stage_snapshot(self.former, self.FORMER)
+            return self
+
+        def create(self):
+            """ Create the stage on the connection of the session if needed, and empty it """
+            self.table.create(bind=db.session.connection(), checkfirst=True)
+            self.clear()
+
+        def stage_snapshot(self, test, side):
+            """ Stage the snapshot of a test without reading it
+
+            :param test: Test whose units are stored as rows
+            :type test: RepoTest
+            :param side: FORMER or CURRENT
+            """
+            stage = self.table
+            # Deltas are applied over the full snapshot in order, each replacing the rows of the paths it lists
+            chain = test.snapshot_chain()
+            for test_id in chain:
+                if test_id != chain[0]:
+                    db.session.execute(stage.delete().where(db.and_(
+                        stage.c.side == side,
+                        stage.c.path_id.in_(db.select([UnitTest.path_id]).where(UnitTest.test_id == test_id))
+                    )))
+                db.session.execute(stage.insert().from_select(
+                    ["side", "path_id", "status"],
+                    db.select([db.literal(side, db.SmallInteger), UnitTest.path_id, UnitTest.status]).where(
+                        db.and_(UnitTest.test_id == test_id, UnitTest.deleted == db.false())
+                    )
+                ))
+
+        def stage_chunk(self, chunk):
+            paths = UnitPath.resolve(path for path, _ in chunk)
+            db.session.execute(self.table.insert(), [
+                {"side": self.CURRENT, "path_id": paths[path], "status": status}
+                for path, status in chunk
+            ])
+
+        def changes(self):
+            """ Select the staged units which are new or whose status changed
+
+            :return: Select of (Path identifier, Status, Former status) rows, Former status being None for new units
+            """
+            current, former = self.table.alias("current"), self.table.alias("former")
+            return db.select([current.c.path_id, current.c.status, former.c.status.label("former_status")]).select_from(
+                current.outerjoin(former, db.and_(
+                    former.c.side == self.FORMER, former.c.path_id == current.c.path_id
+                ))
+            ).where(db.and_(
+                current.c.side == self.CURRENT,
+                db.or_(former.c.path_id.is_(None), former.c.status != current.c.status)
+            ))
+
+        def deletions(self):
+            """ Select the units of the former snapshot which were not staged
+
+            :return: Select of (Path identifier, Former status) rows
+            """
+            current, former = self.table.alias("current"), self.table.alias("former")
+            return db.select([former.c.path_id, former.c.status]).select_from(
+                former.outerjoin(current, db.and_(
+                    current.c.side == self.CURRENT, current.c.path_id == former.c.path_id
+                ))
+            ).where(db.and_(former.c.side == self.FORMER, current.c.path_id.is_(None)))
+
+        def categories(self):
+            """ Sorted differences, see Hook.diffing.UnitDiff.categories
+
+            :return: New paths, deleted paths and (Path, Status) pairs of the new units and of the units whose status \
+            changed, each sorted by path
+            :rtype: ([str], [str], [(str, bool)])
+            """
+            changes = self.changes().alias("changes")
+            deletions = self.deletions().alias("deletions")
+            new, changed = [], []
+            for path, status, former in db.session.execute(
+                db.select([UnitPath.path, changes.c.status, changes.c.former_status]).
+                select_from(changes.join(UnitPath.__table__, UnitPath.uuid == changes.c.path_id))
+            ):
+                if former is None:
+                    new.append(path)
+                changed.append((path, status))
+            deleted = [
+                path for path, in db.session.execute(
+                    db.select([UnitPath.path]).
+                    select_from(deletions.join(UnitPath.__table__, UnitPath.uuid == deletions.c.path_id))
+                )
+            ]
+            return sorted(new), sorted(deleted), sorted(changed, key=itemgetter(0))
+
+        def insert_delta(self, test):
+            """ Insert the units of a test as the changes from the staged snapshot
+
+            :param test: Test whose units were staged
+            :type test: RepoTest
+            """
+            columns = ["test_id", "path_id", "status", "deleted"]
+            changes, deletions = self.changes().alias("changes"), self.deletions().alias("deletions")
+            test_id = db.literal(test.uuid, db.Integer)
+            db.session.execute(UnitTest.__table__.insert().from_select(columns, db.select([
+                test_id, changes.c.path_id, changes.c.status, db.false()
+            ])))
+            db.session.execute(UnitTest.__table__.insert().from_select(columns, db.select([
+                test_id, deletions.c.path_id, deletions.c.status, db.true()
+            ])))
+
+        def insert_snapshot(self, test):
+            """ Insert the units of a test as a full snapshot
+
+            :param test: Test whose units were staged
+            :type test: RepoTest
+            """
+            stage = self.table
+            db.session.execute(UnitTest.__table__.insert().from_select(
+                ["test_id", "path_id", "status", "deleted"],
+                db.select([db.literal(test.uuid, db.Integer), stage.c.path_id, stage.c.status, db.false()]).
+                where(stage.c.side == self.CURRENT)
+            ))
+
+        def clear(self):
+            """ Empty the stage, which lives as long as the connection """
+            db.session.execute(self.table.delete())
+
     class Models(object):
         def __init__(self):
             self.User = User
             self.Repository = Repository
             self.RepoTest = RepoTest
+            self.ArchivedTest = ArchivedTest
+            self.LatestTest = LatestTest
+            self.TestDiff = TestDiff
             self.RepoOwnership = RepoOwnership
             self.UnitTest = UnitTest
+            self.UnitPath = UnitPath
+            self.StagedUnitDiff = StagedUnitDiff
             self.WordCount = WordCount
+            self.IngestJob = IngestJob
+            self.CommentOutbox = CommentOutbox
+            self.CacheEntry = CacheEntry
 
     return Models()
@@ -0,0 +1,156 @@
+""" Compact binary encoding of the units of a test
+
+A packed snapshot is a zlib-compressed byte string made of :
+
+- the number of units and the number of units per block, as varints ;
+- a bitset of the statuses, one bit per unit in path order ;
+- the offset of each block in the entries, as little-endian 32 bits integers ;
+- the entries : paths sorted and front-coded, each entry being the length of the prefix shared with the previous path,
+  the length of the rest of the path and the rest of the path. The first entry of each block shares nothing, so that
+  a single path can be found with a binary search over the blocks and a scan of a single block.
+"""
+import struct
+import zlib
+
+
+BLOCK_SIZE = 16
+OFFSET = struct.Struct("<I")
+
+
+def write_varint(value, output):
+    while value >= 0x80:
+        output.append((value & 0x7F) | 0x80)
+        value >>= 7
+    output.append(value)
+
+
+def read_varint(data, position):
+    value, shift = 0, 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+def pack_units(units, block_size=BLOCK_SIZE, level=6):
+    """ Encode units
+
+    :param units: Dictionary Path->Status or iterable of (Path, Status) pairs
+    :param block_size: Number of paths per block of front-coded entries
+    :param level: zlib compression level
+    :return: Packed units
+    :rtype: bytes
+    """
+    if isinstance(units, dict):
+        units = units.items()
+    units = sorted((path.encode("utf-8"), bool(status)) for path, status in units)
+
+    header, bitset, offsets, entries = bytearray(), bytearray((len(units) + 7) // 8), bytearray(), bytearray()
+    write_varint(len(units), header)
+    write_varint(block_size, header)
+    previous = b""
+    for index, (path, status) in enumerate(units):
+        if status:
+            bitset[index >> 3] |= 1 << (index & 7)
+        shared = 0
+        if index % block_size == 0:
+            offsets += OFFSET.pack(len(entries))
+        else:
+            limit = min(len(path), len(previous))
+            while shared < limit and path[shared] == previous[shared]:
+                shared += 1
+        write_varint(shared, entries)
+        write_varint(len(path) - shared, entries)
+        entries += path[shared:]
+        previous = path
+    return zlib.compress(bytes(header + bitset + offsets + entries), level)
+
+
+class PackedUnits(object):
+    """ Decoded view over packed units
+
+    The blob is decompressed once, paths are only decoded when they are read.
+
+    :param blob: Packed units, as produced by pack_units
+    :type blob: bytes
+    """
+    def __init__(self, blob):
+        self.data = zlib.decompress(blob)
+        self.count, position = read_varint(self.data, 0)
+        self.block_size, position = read_varint(self.data, position)
+        self.bitset = position
+        blocks = (self.count + self.block_size - 1) // self.block_size
+        self.offsets = position + (self.count + 7) // 8
+        self.entries = self.offsets + blocks * OFFSET.size
+        self.blocks = blocks
+
+    def __len__(self):
+        return self.count
+
+    def status(self, index):
+        """ Status of the unit at a given position in path order
+        """
+        return bool(self.data[self.bitset + (index >> 3)] & (1 << (index & 7)))
+
+    def block_offset(self, block):
+        return self.entries + OFFSET.unpack_from(self.data, self.offsets + block * OFFSET.size)[0]
+
+    def iter_block(self, block):
+        """ Decode the paths of a block
+
+        :param block: Index of the block
+        :return: Generator of (index, path as bytes)
+        """
+        position, previous = self.block_offset(block), b""
+        first = block * self.block_size
+        for index in range(first, min(first + self.block_size, self.count)):
+            shared, position = read_varint(self.data, position)
+            length, position = read_varint(self.data, position)
+            previous = previous[:shared] + self.data[position:position + length]
+            position += length
+            yield index, previous
+
+    def head(self, block):
+        """ First path of a block, which is never front-coded
+        """
+        position = self.block_offset(block)
+        _, position = read_varint(self.data, position)
+        length, position = read_varint(self.data, position)
+        return self.data[position:position + length]
+
+    def items(self):
+        """ Decode every unit
+
+        :return: Generator of (Path, Status) pairs, sorted by path
+        """
+        for block in range(self.blocks):
+            for index, path in self.iter_block(block):
+                yield path.decode("utf-8"), self.status(index)
+
+    def as_dict(self):
+        return dict(self.items())
+
+    def get(self, path):
+        """ Find the status of a single path
+
+        :param path: Path of the unit
+        :return: Status or None if the path is unknown
+        """
+        path = path.encode("utf-8")
+        # Binary search of the last block starting at or before path
+        low, high = 0, self.blocks
+        while low < high:
+            middle = (low + high) // 2
+            if self.head(middle) <= path:
+                low = middle + 1
+            else:
+                high = middle
+        if low == 0:
+            return None
+        for index, candidate in self.iter_block(low - 1):
+            if candidate == path:
+                return self.status(index)
+        return None
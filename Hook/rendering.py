@@ -0,0 +1,232 @@
+""" Rendering of diffs as markdown or html tables within a size budget
+
+GitHub rejects comments above 65536 characters, which a bulk change over thousands of units easily exceeds. With a
+budget, tables are written row by row and stop before the budget is exceeded, ending with a line which counts the rows
+left out and links to the full report. Rows are merged from the categories of the diff, which RepoTest.diff sorts,
+instead of being concatenated and sorted again, so that time and memory depend on the budget rather than on the size
+of the diff.
+
+Diffs small enough to fit are rendered with aligned columns, as without budget. Aligned tables are written by a
+renderer dedicated to the two columns of a diff, whose output is the one of `tabulate` 0.8 for pipe and html tables,
+column widths being counted in characters.
+"""
+from heapq import merge
+from html import escape
+from itertools import chain
+from math import isinf, isnan
+from operator import itemgetter
+
+
+# Diffs with more rows are not tried aligned, as the padded output would not fit a comment anyway
+ALIGNED_ROWS = 1000
+HEADERS = ("Changed", "Status")
+# Headers are padded by two spaces at least
+MIN_PADDING = 2
+MARKUP = {
+    "md": {
+        "open": "## {name}\n\n| Changed | Status |\n|:--------|:-------|\n",
+        "row": "| `{item}` | {value} |\n",
+        "close": "\n",
+        "more": "*…and {count} more*\n",
+        "more_link": "*[…and {count} more]({link})*\n"
+    },
+    "html": {
+        "open": "<h2>{name}</h2>\n<table>\n<thead>\n<tr><th>Changed</th><th>Status</th></tr>\n</thead>\n<tbody>\n",
+        "row": "<tr><td><code>{item}</code></td><td>{value}</td></tr>\n",
+        "close": "</tbody>\n</table>\n",
+        "more": "<p>…and {count} more</p>\n",
+        "more_link": "<p><a href=\"{link}\">…and {count} more</a></p>\n"
+    }
+}
+
+
+def size_of(text):
+    return len(text.encode("utf-8"))
+
+
+def diff_tables(diff_dict):
+    """ Tables of a diff dict, new and deleted items first
+
+    :param diff_dict: Diff dict from RepoTest.diff, whose Words and Units tables may be missing
+    :return: (Name, Number of rows, Iterator of (Item, Status) rows) for each table which is not empty, in display \
+    order
+    :rtype: [(str, int, iterator)]
+    """
+    tables = []
+    for name in ("Global", "Words", "Units"):
+        if name not in diff_dict:
+            continue
+        table = diff_dict[name]
+        size = len(table["New"]) + len(table["Deleted"]) + len(table["Changed"])
+        if size:
+            rows = chain(merge(table["New"], table["Deleted"], key=itemgetter(0)), table["Changed"])
+            tables.append((name, size, rows))
+    return tables
+
+
+def status_type(status):
+    """ Type of a status, inferred as tabulate does : int, float or str
+
+    :param status: Status of a row
+    :type status: str
+    :rtype: type
+    """
+    try:
+        int(status)
+        return int
+    except ValueError:
+        pass
+    try:
+        number = float(status)
+    except ValueError:
+        return str
+    if (isinf(number) or isnan(number)) and status.lower() not in ("inf", "-inf", "nan"):
+        return str
+    return float
+
+
+def afterpoint(status):
+    """ Number of characters after the decimal point of a formatted number, -1 without decimal point """
+    if status_type(status) is not float:
+        return -1
+    position = status.rfind(".")
+    if position < 0:
+        position = status.lower().rfind("e")
+    if position < 0:
+        return -1
+    return len(status) - position - 1
+
+
+def align(rows):
+    """ Pad the cells of rows to the width of their column
+
+    Statuses which are all numbers are aligned right on their decimal point, floats being formatted with the g format.
+
+    :param rows: List of (Item, Status) rows
+    :return: Padded headers, padded (Item, Status) cells, widths of the columns and whether statuses are aligned right
+    :rtype: ((str, str), [(str, str)], (int, int), bool)
+    """
+    items = ["`" + item + "`" for item, _ in rows]
+    statuses = [status for _, status in rows]
+    types = set(map(status_type, statuses))
+    numeric = str not in types
+    if numeric:
+        if float in types:
+            statuses = [format(float(status), "g") for status in statuses]
+        decimals = [afterpoint(status) for status in statuses]
+        most = max(decimals)
+        statuses = [status + " " * (most - point) for status, point in zip(statuses, decimals)]
+    else:
+        statuses = [status.strip() for status in statuses]
+
+    item_width = max(len(HEADERS[0]) + MIN_PADDING, max(map(len, items)))
+    status_width = max(len(HEADERS[1]) + MIN_PADDING, max(map(len, statuses)))
+    pad = str.rjust if numeric else str.ljust
+    headers = (HEADERS[0].ljust(item_width), pad(HEADERS[1], status_width))
+    cells = [(item.ljust(item_width), pad(status, status_width)) for item, status in zip(items, statuses)]
+    return headers, cells, (item_width, status_width), numeric
+
+
+def pipe_table(rows):
+    """ Render rows as a markdown pipe table
+
+    :param rows: List of (Item, Status) rows
+    :return: Table as string
+    """
+    headers, cells, (item_width, status_width), numeric = align(rows)
+    separator = "-" * (status_width + 1) + ":" if numeric else ":" + "-" * (status_width + 1)
+    lines = ["| {} | {} |".format(*headers), "|:{}|{}|".format("-" * (item_width + 1), separator)]
+    lines.extend(["| {} | {} |".format(item, status) for item, status in cells])
+    return "\n".join(lines)
+
+
+def html_table(rows):
+    """ Render rows as an html table
+
+    :param rows: List of (Item, Status) rows
+    :return: Table as string
+    """
+    headers, cells, _, numeric = align(rows)
+    style = ' style="text-align: right;"' if numeric else ""
+    lines = ["<table>", "<thead>", "<tr><th>{}</th><th{}>{}</th></tr>".format(headers[0], style, headers[1])]
+    lines.extend(["</thead>", "<tbody>"])
+    lines.extend([
+        "<tr><td>{}</td><td{}>{}</td></tr>".format(escape(item), style, escape(status))
+        for item, status in cells
+    ])
+    lines.extend(["</tbody>", "</table>"])
+    return "\n".join(lines)
+
+
+def aligned(tables, mode="md"):
+    """ Render tables with aligned columns
+
+    :param tables: Tables from diff_tables
+    :param mode: md or html
+    :return: Tables as string
+    """
+    render = pipe_table if mode == "md" else html_table
+    output = []
+    for name, _, rows in tables:
+        output.append("## %s" % name)
+        output.append(render(list(rows)))
+    return "\n\n".join(output)
+
+
+def streamed(tables, mode, budget, link=None):
+    """ Render tables row by row until the budget is reached
+
+    :param tables: Tables from diff_tables
+    :param mode: md or html
+    :param budget: Maximum size of the output in bytes
+    :param link: Address of the full diff, linked from the line counting the rows left out
+    :return: Tables as string
+    """
+    markup = MARKUP[mode]
+    quote = (lambda text: text) if mode == "md" else escape
+    more = markup["more"] if link is None else markup["more_link"]
+    total = sum(size for _, size, _ in tables)
+    # Room is kept for the footer with the largest count it could show
+    budget -= size_of(more.format(count=total, link=link))
+
+    output, used, written = [], 0, 0
+    for name, _, rows in tables:
+        opening, closing = markup["open"].format(name=name), markup["close"]
+        cost, section, truncated = size_of(opening) + size_of(closing), [], False
+        for item, value in rows:
+            row = markup["row"].format(item=quote(item), value=quote(value))
+            if used + cost + size_of(row) > budget:
+                truncated = True
+                break
+            section.append(row)
+            cost += size_of(row)
+        if section:
+            output.extend([opening] + section + [closing])
+            used += cost
+            written += len(section)
+        if truncated:
+            break
+    if written < total:
+        output.append(more.format(count=total - written, link=link))
+    return "".join(output).rstrip("\n")
+
+
+def render_diff(diff_dict, mode="md", budget=None, link=None):
+    """ Render the tables of a diff dict
+
+    :param diff_dict: Diff dict from RepoTest.diff
+    :param mode: md or html given the wished output
+    :param budget: Maximum size of the output in bytes, None for no limit
+    :param link: Address of the full diff, linked from the line counting the rows left out
+    :return: Tables as string
+    """
+    if mode not in MARKUP:
+        raise ValueError("Unknown table format " + str(mode))
+    tables = diff_tables(diff_dict)
+    total = sum(size for _, size, _ in tables)
+    if budget is None or total <= ALIGNED_ROWS:
+        text = aligned(tables, mode)
+        if budget is None or size_of(text) <= budget:
+            return text
+        tables = diff_tables(diff_dict)
+    return streamed(tables, mode, budget, link)
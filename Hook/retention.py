@@ -0,0 +1,156 @@
+""" Retention of old test data
+
+Tests, their units and their word counts, archived or not, are kept forever unless a RetentionPolicy is applied,
+usually through the `flask hook-retention` command. Rows are deleted by small batches, each batch being committed on
+its own, so that the database is never locked for long.
+
+The last master test of a repository, and every test its units are rebuilt from, are never touched : they are needed
+for the next diff and for the badges.
+"""
+import datetime
+
+
+class RetentionPolicy(object):
+    """ Rules deciding which test data is deleted
+
+    :param master_units: Number of the latest master tests of each repository which keep their units, None to keep \
+    the units of every master test
+    :param details_days: Age in days after which tests lose their units and word counts, keeping only their summary \
+    columns. None to keep them.
+    :param pr_days: Age in days after which tests of pull requests and branches other than the main one are deleted. \
+    None to keep them.
+    :param batch_size: Number of rows deleted per transaction
+    """
+    def __init__(self, master_units=None, details_days=None, pr_days=None, batch_size=500):
+        self.master_units = master_units
+        self.details_days = details_days
+        self.pr_days = pr_days
+        self.batch_size = batch_size
+
+    @staticmethod
+    def cutoff(days, now):
+        if days is None:
+            return None
+        return now - datetime.timedelta(days=days)
+
+    def apply(self, db, models, now=None, progress=None):
+        """ Delete the data the policy does not retain
+
+        :param db: Flask SQLAlchemy Database instance
+        :param models: Models of the extension
+        :param now: Reference date of the ages, defaults to the current UTC date
+        :param progress: Callable receiving a message after each batch
+        :return: Number of deleted units, word counts and tests and of cleared packed units
+        :rtype: dict
+        """
+        now = now or datetime.datetime.utcnow()
+        details_cutoff, pr_cutoff = self.cutoff(self.details_days, now), self.cutoff(self.pr_days, now)
+        progress = progress or (lambda message: None)
+        RepoTest, UnitTest, WordCount = models.RepoTest, models.UnitTest, models.WordCount
+        ArchivedTest = models.ArchivedTest
+        counts = {"units": 0, "packed": 0, "words": 0, "comments": 0, "tests": 0}
+
+        def batches(name, label, ids_query, action):
+            """ Run action over the identifiers selected by ids_query, batch by batch, counted under label unless it
+            is None, until none is left """
+            while True:
+                ids = [row[0] for row in ids_query.limit(self.batch_size)]
+                if not ids:
+                    return
+                action(ids)
+                db.session.commit()
+                if label is not None:
+                    counts[label] += len(ids)
+                    progress("{}: {} {} deleted".format(name, counts[label], label))
+
+        def delete(name, label, model, ids_query):
+            batches(
+                name, label, ids_query,
+                lambda ids: model.query.filter(model.uuid.in_(ids)).delete(synchronize_session=False)
+            )
+
+        for repo in models.Repository.query.order_by(models.Repository.uuid).all():
+            name = repo.full_name
+            masters = db.session.query(RepoTest.uuid, RepoTest.run_at).filter(
+                RepoTest.repository == repo.uuid, RepoTest.source == repo.main_branch
+            ).order_by(RepoTest.run_at.desc()).all()
+            last_master = masters[0][0] if masters else None
+
+            kept = masters if self.master_units is None else masters[:max(1, self.master_units)]
+            kept = [
+                uuid for uuid, run_at in kept
+                if uuid == last_master or details_cutoff is None or run_at >= details_cutoff
+            ]
+            protected = set()
+            for uuid in kept:
+                protected.update(RepoTest.query.get(uuid).snapshot_chain())
+            tests = db.session.query(RepoTest.uuid).filter(RepoTest.repository == repo.uuid)
+
+            # Units of master tests which are not retained anymore, and units of old tests of other branches
+            stale = tests
+            if protected:
+                stale = stale.filter(~RepoTest.uuid.in_(protected))
+            if details_cutoff is None:
+                stale = stale.filter(RepoTest.source == repo.main_branch)
+            else:
+                stale = stale.filter(db.or_(RepoTest.source == repo.main_branch, RepoTest.run_at < details_cutoff))
+            delete(
+                name, "units", UnitTest,
+                db.session.query(UnitTest.uuid).filter(UnitTest.test_id.in_(stale.subquery()))
+            )
+            batches(
+                name, "packed", stale.filter(RepoTest.units_blob.isnot(None)),
+                lambda ids: RepoTest.query.filter(RepoTest.uuid.in_(ids)).
+                update({"units_blob": None}, synchronize_session=False)
+            )
+
+            archived = db.session.query(ArchivedTest.uuid).filter(ArchivedTest.repository == repo.uuid)
+            if details_cutoff is not None:
+                old = tests.filter(RepoTest.run_at < details_cutoff, RepoTest.uuid != last_master)
+                delete(
+                    name, "words", WordCount,
+                    db.session.query(WordCount.uuid).filter(WordCount.test_id.in_(old.subquery()))
+                )
+                batches(
+                    name, None, old.filter(RepoTest.words_langs.isnot(None)),
+                    lambda ids: RepoTest.query.filter(RepoTest.uuid.in_(ids)).
+                    update({"words_total": None, "words_langs": None}, synchronize_session=False)
+                )
+                batches(
+                    name, "packed",
+                    archived.filter(
+                        ArchivedTest.run_at < details_cutoff,
+                        db.or_(ArchivedTest.units_blob.isnot(None), ArchivedTest.words != "{}")
+                    ),
+                    lambda ids: ArchivedTest.query.filter(ArchivedTest.uuid.in_(ids)).
+                    update({"units_blob": None, "words": "{}"}, synchronize_session=False)
+                )
+
+            if pr_cutoff is not None:
+                old = tests.filter(RepoTest.run_at < pr_cutoff, RepoTest.source != repo.main_branch).subquery()
+                delete(name, "units", UnitTest, db.session.query(UnitTest.uuid).filter(UnitTest.test_id.in_(old)))
+                delete(name, "words", WordCount, db.session.query(WordCount.uuid).filter(WordCount.test_id.in_(old)))
+                delete(
+                    name, "comments", models.CommentOutbox,
+                    db.session.query(models.CommentOutbox.uuid).filter(models.CommentOutbox.test_id.in_(old))
+                )
+                models.IngestJob.query.filter(models.IngestJob.test_id.in_(old)).\
+                    update({"test_id": None}, synchronize_session=False)
+                models.LatestTest.query.filter(models.LatestTest.test_id.in_(old)).delete(synchronize_session=False)
+                models.TestDiff.involving(old).delete(synchronize_session=False)
+                db.session.commit()
+                deleted = counts["tests"]
+                delete(name, "tests", RepoTest, db.session.query(RepoTest.uuid).filter(RepoTest.uuid.in_(old)))
+                if counts["tests"] > deleted:
+                    models.LatestTest.rebuild(repo.uuid)
+                    db.session.commit()
+                def delete_archived(ids):
+                    models.TestDiff.involving(ids).delete(synchronize_session=False)
+                    ArchivedTest.query.filter(ArchivedTest.uuid.in_(ids)).delete(synchronize_session=False)
+
+                batches(
+                    name, "tests",
+                    archived.filter(ArchivedTest.run_at < pr_cutoff, ArchivedTest.source != repo.main_branch),
+                    delete_archived
+                )
+        return counts
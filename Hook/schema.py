@@ -0,0 +1,235 @@
+""" Upgrade of databases created by former versions
+
+`db.create_all()` creates the missing tables but never alters existing ones. upgrade() adds to existing tables the
+columns and the indexes the models declare and the database lacks, and moves the data of former columns to the new
+ones, usually through the `flask hook-upgrade` command.
+"""
+from itertools import groupby
+from operator import itemgetter
+
+from sqlalchemy import inspect, literal, select, bindparam
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateTable
+
+from Hook.models import materialize_words
+
+
+def missing_columns(db):
+    """ Find the columns declared by the models which the tables of the database lack
+
+    :param db: Flask SQLAlchemy Database instance
+    :return: Missing columns
+    :rtype: [sqlalchemy.Column]
+    """
+    inspector = inspect(db.engine)
+    tables = set(inspector.get_table_names())
+    missing = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        missing.extend(column for column in table.columns if column.name not in existing)
+    return missing
+
+
+def column_definition(db, column):
+    """ Definition of a column for ALTER TABLE ADD COLUMN
+
+    Existing rows take the scalar default of the column. A column without such a default is added as nullable, as
+    the existing rows would not satisfy NOT NULL : the migrations fill it.
+
+    :param db: Flask SQLAlchemy Database instance
+    :param column: Column to add
+    :type column: sqlalchemy.Column
+    :rtype: str
+    """
+    dialect = db.engine.dialect
+    definition = [column.name, column.type.compile(dialect=dialect)]
+    if column.default is not None and column.default.is_scalar:
+        definition.append("DEFAULT {}".format(
+            literal(column.default.arg, type_=column.type).compile(
+                dialect=dialect, compile_kwargs={"literal_binds": True}
+            )
+        ))
+        if not column.nullable:
+            definition.append("NOT NULL")
+    for key in column.foreign_keys:
+        definition.append("REFERENCES {} ({})".format(key.column.table.name, key.column.name))
+    return " ".join(definition)
+
+
+def add_columns(db, progress):
+    """ Add the missing columns to their tables
+
+    :param db: Flask SQLAlchemy Database instance
+    :param progress: Callable receiving a message for each column
+    :return: Names of the added columns
+    :rtype: [str]
+    """
+    added = []
+    with db.engine.begin() as connection:
+        for column in missing_columns(db):
+            connection.execute("ALTER TABLE {} ADD COLUMN {}".format(column.table.name, column_definition(db, column)))
+            added.append("{}.{}".format(column.table.name, column.name))
+            progress("{} added".format(added[-1]))
+    return added
+
+
+def rebuild_table(connection, table):
+    """ Create a SQLite table again from its model, copying its rows, as SQLite cannot alter existing columns
+
+    Columns of the table which the model does not declare anymore are dropped. Indexes are dropped with the former
+    table, upgrade() creates them again.
+
+    :param connection: Connection, in a transaction
+    :param table: Table of the model
+    :type table: sqlalchemy.Table
+    """
+    quote = connection.dialect.identifier_preparer.quote
+    rebuilt = "_upgrade_{}".format(table.name)
+    definition = str(CreateTable(table).compile(dialect=connection.dialect)).strip()
+    connection.execute(definition.replace(
+        "CREATE TABLE {} ".format(quote(table.name)), "CREATE TABLE {} ".format(rebuilt), 1
+    ))
+    columns = ", ".join(quote(column.name) for column in table.columns)
+    connection.execute("INSERT INTO {0} ({1}) SELECT {1} FROM {2}".format(rebuilt, columns, quote(table.name)))
+    connection.execute("DROP TABLE {}".format(quote(table.name)))
+    connection.execute("ALTER TABLE {} RENAME TO {}".format(rebuilt, quote(table.name)))
+
+
+def migrate_unit_paths(db, progress):
+    """ Intern the paths of the units stored before UnitPath, then drop the former unit_test.path column
+
+    :param db: Flask SQLAlchemy Database instance
+    :param progress: Callable receiving a message once the paths are moved
+    :return: Number of units whose path was moved
+    :rtype: int
+    """
+    if "path" not in {column["name"] for column in inspect(db.engine).get_columns("unit_test")}:
+        return 0
+    with db.engine.begin() as connection:
+        connection.execute(
+            "INSERT INTO unit_path (path) SELECT DISTINCT path FROM unit_test "
+            "WHERE path NOT IN (SELECT path FROM unit_path)"
+        )
+        count = connection.execute(
+            "UPDATE unit_test SET path_id = (SELECT uuid FROM unit_path WHERE unit_path.path = unit_test.path) "
+            "WHERE path_id IS NULL"
+        ).rowcount
+        if connection.dialect.name == "sqlite":
+            # Also makes path_id NOT NULL, which ALTER TABLE could not
+            rebuild_table(connection, db.metadata.tables["unit_test"])
+        else:
+            connection.execute("ALTER TABLE unit_test DROP COLUMN path")
+    progress("{} unit paths moved to unit_path".format(count))
+    return count
+
+
+def backfill_words(db, progress, chunk_size=1000):
+    """ Store the word counts of the tests saved before RepoTest.words_total and RepoTest.words_langs on the tests
+
+    :param db: Flask SQLAlchemy Database instance
+    :param progress: Callable receiving a message once the counts are stored
+    :param chunk_size: Number of tests updated at once
+    :return: Number of updated tests
+    :rtype: int
+    """
+    tests, words = db.metadata.tables["repo_test"], db.metadata.tables["word_count"]
+    query = select([words.c.test_id, words.c.lang, words.c["count"]]).\
+        select_from(words.join(tests, tests.c.uuid == words.c.test_id)).\
+        where(tests.c.words_total.is_(None)).\
+        order_by(words.c.test_id)
+    update = tests.update().where(tests.c.uuid == bindparam("test")).\
+        values(words_total=bindparam("total"), words_langs=bindparam("langs"))
+    updated = []
+    with db.engine.begin() as connection:
+        for test_id, counts in groupby(connection.execute(query).fetchall(), key=itemgetter(0)):
+            total, langs = materialize_words({lang: count for _, lang, count in counts})
+            updated.append({"test": test_id, "total": total, "langs": langs})
+        for start in range(0, len(updated), chunk_size):
+            connection.execute(update, updated[start:start + chunk_size])
+    if updated:
+        progress("{} word counts stored on their tests".format(len(updated)))
+    return len(updated)
+
+
+def rebuild_autoincrement(db, progress):
+    """ Rebuild the SQLite tables created before their model asked for AUTOINCREMENT
+
+    sqlite_autoincrement only applies when a table is created. Without it, SQLite gives the identifier of the last
+    deleted row to the next one, which archived tests and stored diffs would then be mistaken for.
+
+    :param db: Flask SQLAlchemy Database instance
+    :param progress: Callable receiving a message for each table
+    :return: Names of the rebuilt tables
+    :rtype: [str]
+    """
+    if db.engine.dialect.name != "sqlite":
+        return []
+    rebuilt = []
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            if not table.dialect_options["sqlite"]["autoincrement"]:
+                continue
+            definition = connection.execute(
+                "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table.name, )
+            ).scalar()
+            if definition is None or "AUTOINCREMENT" in definition.upper():
+                continue
+            rebuild_table(connection, table)
+            rebuilt.append(table.name)
+            progress("{} rebuilt with AUTOINCREMENT".format(table.name))
+    return rebuilt
+
+
+def missing_indexes(db):
+    """ Find the indexes declared by the models which the database lacks
+
+    Tables which do not exist yet are ignored, `db.create_all()` creates them with their indexes.
+
+    :param db: Flask SQLAlchemy Database instance
+    :return: Missing indexes
+    :rtype: [sqlalchemy.Index]
+    """
+    inspector = inspect(db.engine)
+    tables = set(inspector.get_table_names())
+    missing = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        missing.extend(
+            index for index in sorted(table.indexes, key=lambda index: index.name)
+            if index.name not in existing
+        )
+    return missing
+
+
+def upgrade(db, progress=None):
+    """ Add the missing columns, move the data of former columns, then create the missing indexes
+
+    Indexes come last, as they may cover the new columns and as the migrations may rebuild tables. A unique index
+    cannot be created over duplicated rows : it is reported and skipped, so that it can be created again once the
+    duplicates are removed.
+
+    :param db: Flask SQLAlchemy Database instance
+    :param progress: Callable receiving a message for each column, each migration and each index
+    :return: Names of the created indexes and names of the indexes which could not be created
+    :rtype: ([str], [str])
+    """
+    progress = progress or (lambda message: None)
+    add_columns(db, progress)
+    migrate_unit_paths(db, progress)
+    backfill_words(db, progress)
+    rebuild_autoincrement(db, progress)
+    created, failed = [], []
+    for index in missing_indexes(db):
+        try:
+            index.create(bind=db.engine)
+        except IntegrityError as error:
+            failed.append(index.name)
+            progress("{} could not be created: {}".format(index.name, error.orig))
+        else:
+            created.append(index.name)
+            progress("{} created on {}".format(index.name, index.table.name))
+    return created, failed
@@ -0,0 +1,186 @@
+""" Incremental reading of HookTest reports
+
+Large corpora produce reports whose `units` object weights hundreds of megabytes once decoded. The functions of this
+module read a report body from a stream without ever building the `units` dictionary : the body is spooled to a
+temporary file while its signature is computed, the small top-level values are then read in a first pass and the
+units are finally streamed as (path, status) pairs in a second pass.
+
+Streaming requires the optional `ijson` dependency (`pip install capitains-hook[streaming]`).
+
+Bodies sent with a gzip or deflate Content-Encoding are decompressed on the fly by DecompressedReader, which refuses to
+produce more than a given number of bytes.
+"""
+import hmac
+import hashlib
+import zlib
+from io import BytesIO, UnsupportedOperation
+from tempfile import SpooledTemporaryFile
+
+from Hook.exceptions import InvalidPayload, PayloadTooLarge
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+CHUNK_SIZE = 64 * 1024
+SCALARS = ("string", "number", "boolean", "null")
+STREAMED = object()
+ENCODINGS = {
+    "gzip": 16 + zlib.MAX_WBITS,
+    "deflate": zlib.MAX_WBITS
+}
+
+
+class DecompressedReader(object):
+    """ Read-only file-like object decompressing a gzip or deflate file on the fly
+
+    Decompression is done by chunks of at most CHUNK_SIZE bytes, so that a small compressed body can never expand in
+    memory beyond what has been asked for.
+
+    :param fileobj: Readable and seekable binary file of the compressed data
+    :param encoding: gzip or deflate
+    :param max_size: Maximum number of decompressed bytes, above which PayloadTooLarge is raised
+    """
+    def __init__(self, fileobj, encoding, max_size):
+        self.fileobj = fileobj
+        self.wbits = ENCODINGS[encoding]
+        self.max_size = max_size
+        self.seek(0)
+
+    def seek(self, offset, whence=0):
+        """ Go back to the start of the data, the only position supported
+        """
+        if offset != 0 or whence != 0:
+            raise UnsupportedOperation("DecompressedReader can only seek to its start")
+        self.fileobj.seek(0)
+        self.decompressor = zlib.decompressobj(self.wbits)
+        self.size = 0
+        self.eof = False
+        return 0
+
+    def read(self, size=-1):
+        """ Read at most size decompressed bytes, or everything if size is negative
+
+        :param size: Number of bytes to read
+        :return: Decompressed bytes
+        :rtype: bytes
+        """
+        chunks, length = [], 0
+        while (size < 0 or length < size) and not self.eof:
+            data = self.decompressor.unconsumed_tail or self.fileobj.read(CHUNK_SIZE)
+            try:
+                if not data:
+                    chunk, self.eof = self.decompressor.flush(), True
+                else:
+                    limit = CHUNK_SIZE if size < 0 else min(CHUNK_SIZE, size - length)
+                    chunk = self.decompressor.decompress(data, limit)
+                    self.eof = self.decompressor.eof
+            except zlib.error:
+                raise InvalidPayload("Data could not be decompressed")
+            self.size += len(chunk)
+            if self.size > self.max_size:
+                raise PayloadTooLarge("Decompressed data is larger than {} bytes".format(self.max_size))
+            chunks.append(chunk)
+            length += len(chunk)
+        return b"".join(chunks)
+
+    def close(self):
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def decompress(body, encoding, max_size):
+    """ Decompress a body held in memory
+
+    :param body: Compressed body
+    :type body: bytes
+    :param encoding: gzip, deflate or None if the body is not compressed
+    :param max_size: Maximum number of decompressed bytes
+    :return: Decompressed body
+    :rtype: bytes
+    """
+    if encoding is None:
+        return body
+    return DecompressedReader(BytesIO(body), encoding, max_size).read()
+
+
+def spool_body(stream, secret, max_memory=1024 * 1024):
+    """ Copy a request body to a temporary file and sign it on the fly
+
+    :param stream: Readable binary stream of the body
+    :param secret: Secret of the repository
+    :type secret: str
+    :param max_memory: Size in bytes above which the spool is written to disk
+    :return: Spooled file positioned at its start, size of the body and HookTest signature of the body
+    :rtype: (SpooledTemporaryFile, int, str)
+    """
+    signature = hmac.new(bytes(secret, encoding="utf-8"), digestmod=hashlib.sha1)
+    spool = SpooledTemporaryFile(max_size=max_memory)
+    size = 0
+    for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+        signature.update(chunk)
+        spool.write(chunk)
+        size += len(chunk)
+    spool.seek(0)
+    return spool, size, signature.hexdigest()
+
+
+def read_report(fileobj):
+    """ Read the top-level values of a report and its words count, skipping its units
+
+    :param fileobj: Readable binary file of the report
+    :return: Report where the `units` object is replaced by the STREAMED marker
+    :rtype: dict
+    """
+    report, key, word, depth = {}, None, None, 0
+    for _, event, value in ijson.parse(fileobj, use_float=True):
+        if event in ("end_map", "end_array"):
+            depth -= 1
+        elif depth == 1 and event == "map_key":
+            key = value
+        elif depth == 1 and event in SCALARS:
+            report[key] = value
+        elif depth == 2 and key == "words_count":
+            if event == "map_key":
+                word = value
+            elif event in SCALARS:
+                report["words_count"][word] = value
+
+        if event in ("start_map", "start_array"):
+            depth += 1
+            if depth == 2 and key == "words_count":
+                report["words_count"] = {}
+            elif depth == 2 and key == "units" and event == "start_map":
+                report["units"] = STREAMED
+    return report
+
+
+def iter_units(fileobj):
+    """ Stream the units of a report
+
+    :param fileobj: Readable binary file of the report
+    :return: Generator of (path, status) pairs
+    """
+    for path, status in ijson.kvitems(fileobj, "units", use_float=True):
+        yield path, status
+
+
+def read_streamed_report(fileobj):
+    """ Read a report with its units as a lazy iterator
+
+    :param fileobj: Readable and seekable binary file of the report
+    :return: Report whose `units` value is a generator of (path, status) pairs
+    :rtype: dict
+    """
+    report = read_report(fileobj)
+    fileobj.seek(0)
+    if report.get("units") is STREAMED:
+        report["units"] = iter_units(fileobj)
+    return report
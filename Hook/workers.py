@@ -0,0 +1,72 @@
+from threading import Thread, Event
+from logging import getLogger
+
+
+class WorkerPool(object):
+    """ Pool of daemon threads repeatedly running a task inside the application context
+
+    The task is a callable taking no argument and returning a truthy value when it did some work. When it returns a
+    falsy value, the worker sleeps for `interval` seconds before polling again.
+
+    :param app: Flask Application
+    :param task: Callable to run
+    :param size: Number of threads
+    :param interval: Seconds to wait when the task had nothing to do
+    :param name: Name prefix of the threads
+    """
+    def __init__(self, app, task, size=2, interval=1.0, name="hook-worker"):
+        self.app = app
+        self.task = task
+        self.size = size
+        self.interval = interval
+        self.name = name
+        self.threads = []
+        self.logger = getLogger(name)
+        self.__stop = Event()
+
+    @property
+    def running(self):
+        return len(self.threads) > 0 and not self.__stop.is_set()
+
+    def start(self):
+        """ Start the threads of the pool
+        """
+        if self.running:
+            return
+        self.__stop.clear()
+        self.threads = [
+            Thread(target=self.run, name="{}-{}".format(self.name, i), daemon=True)
+            for i in range(self.size)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self, timeout=None):
+        """ Ask the threads to stop and wait for them
+
+        :param timeout: Maximum time to wait for each thread
+        """
+        self.__stop.set()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def wake(self):
+        """ Run the task once in the current thread
+
+        :return: Whether the task did some work
+        """
+        with self.app.app_context():
+            return self.task()
+
+    def run(self):
+        """ Loop of a single worker
+        """
+        while not self.__stop.is_set():
+            try:
+                worked = self.wake()
+            except Exception:
+                self.logger.exception("Worker task failed")
+                worked = False
+            if not worked:
+                self.__stop.wait(self.interval)
@@ -0,0 +1,236 @@
+""" Compare the unit comparison of HookTest ingests before and after Hook.diffing.UnitDiff
+
+Usage : python -m benchmarks.diff
+
+The former implementation is the code of RepoTest.stream_delta and RepoTest.diff before UnitDiff, copied as it was.
+A master ingest compared its units with the ones of the last master twice : once for the rows of the delta and once
+for the diff, each pass copying the former units. A pull request ingest compared them once, for the diff. The current
+implementation is the one of register_test : a single UnitDiff over the former units, passed to RepoTest.stream_delta
+and to RepoTest.diff. Both run in memory : the rows of the delta are collected instead of inserted, the same way for
+both. Each measure is the best of REPEAT runs without garbage collection, and both implementations must give the
+same rows and the same diff.
+
+Pull request ingests are also measured with a merge join over the units sorted by path, the engine first asked for,
+which the current implementation does not use : sorting both sides costs more than the dictionary lookups.
+"""
+import gc
+from collections import defaultdict
+from math import isclose
+from operator import itemgetter
+from time import perf_counter
+
+from flask_sqlalchemy import SQLAlchemy
+
+from Hook.diffing import UnitDiff
+from Hook.models import model_maker, unit_pairs
+
+
+SIZES = (10000, 100000, 200000)
+# Share of the units which change between the two tests : a usual commit, and a large refactoring
+CHANGE_RATES = (0.01, 0.3)
+REPEAT = 15
+
+RepoTest = model_maker(SQLAlchemy()).RepoTest
+
+
+def make_tests(size, rate):
+    """ Last master and new test, with their units, a part of which were flipped, added or deleted """
+    step = int(1 / rate)
+    former = {"data/tlg{0:07d}/__cts__.xml".format(i): i % 7 != 0 for i in range(size)}
+    units = dict(former)
+    for i in range(0, size, step):
+        path = "data/tlg{0:07d}/__cts__.xml".format(i)
+        if i % 3 == 0:
+            units[path] = not units[path]
+        elif i % 3 == 1:
+            del units[path]
+        else:
+            units[path.replace("__cts__", "__new__")] = True
+    summary = dict(texts_total=size, metadata_total=size, metadata_passing=size, nodes_count=size * 10)
+    last_master = RepoTest(texts_passing=size - 5, coverage=99.1, **summary)
+    test = RepoTest(texts_passing=size - 3, coverage=99.3, **summary)
+    return last_master, test, former, units
+
+
+def former_stream_delta(self, units, former_units, rows, chunk_size=1000):
+    """ RepoTest.stream_delta before UnitDiff, rows being collected instead of inserted """
+    remaining, missing = dict(former_units), object()
+    chunk = []
+    for path, status in units:
+        if remaining.pop(path, missing) != status:
+            chunk.append({"test_id": self.uuid, "path": path, "status": status, "deleted": False})
+            if len(chunk) >= chunk_size:
+                rows.extend(chunk)
+                chunk = []
+        yield path, status
+    rows.extend(chunk + [
+        {"test_id": self.uuid, "path": path, "status": status, "deleted": True}
+        for path, status in remaining.items()
+    ])
+
+
+def former_diff(self, last_master, units, words_count, _former_units=None):
+    """ RepoTest.diff before UnitDiff """
+    if _former_units is None:
+        _former_units = last_master.units_as_dict
+    items = [
+        (self.diff_dict, last_master.diff_dict, "Global"),
+        (units, _former_units, "Units")
+    ]
+    if words_count is not None:
+        items.append((words_count, last_master.words_count_as_dict, "Words"))
+    ret = {}
+    for me, you, name in items:
+        current = defaultdict(list)
+        # Keys left in you once me has been read are the deleted ones
+        you = dict(you)
+        for key, value in unit_pairs(me):
+            if key not in you:
+                current["New"].append(self.new_object(key))
+                if isinstance(value, bool):
+                    current["Changed"].append(self.pass_fail_object(key, value))
+                continue
+            former = you.pop(key)
+            if value != former:
+                if isinstance(value, bool):
+                    current["Changed"].append(self.pass_fail_object(key, value))
+                elif isinstance(value, float):
+                    if not isclose(value, former, rel_tol=0.0001):
+                        current["Changed"].append(self.diff_int_object(key, value - former))
+                else:
+                    current["Changed"].append(self.diff_int_object(key, value-former))
+        for key in you:
+            current["Deleted"].append(self.del_object(key))
+        for key, val in current.items():
+            current[key] = sorted(val, key=itemgetter(0))
+        ret[name] = current
+    return ret
+
+
+def stream_delta(self, comparison, deleted, rows, chunk_size=1000):
+    """ RepoTest.stream_delta, rows being collected instead of inserted """
+    chunk = []
+    for path, status, changed in comparison:
+        if changed:
+            chunk.append({"test_id": self.uuid, "path": path, "status": status, "deleted": False})
+            if len(chunk) >= chunk_size:
+                rows.extend(chunk)
+                chunk = []
+        yield path, status
+    rows.extend(chunk + [
+        {"test_id": self.uuid, "path": path, "status": status, "deleted": True}
+        for path, status in deleted.items()
+    ])
+
+
+def former_master(last_master, test, former_units, units):
+    rows = []
+    diff = former_diff(
+        test, last_master, former_stream_delta(test, units.items(), former_units, rows), None,
+        _former_units=former_units
+    )
+    return rows, diff
+
+
+def current_master(last_master, test, former_units, units):
+    rows = []
+    unit_diff = UnitDiff(former_units, copy=False)
+    diff = test.diff(
+        last_master, stream_delta(test, unit_diff.compare(units.items()), unit_diff.deleted, rows), None,
+        _unit_diff=unit_diff
+    )
+    return rows, diff
+
+
+def former_pull_request(last_master, test, former_units, units):
+    return former_diff(test, last_master, units.items(), None, _former_units=former_units)
+
+
+def current_pull_request(last_master, test, former_units, units):
+    unit_diff = UnitDiff(former_units, copy=False).consume(units.items())
+    return test.diff(last_master, (), None, _unit_diff=unit_diff)
+
+
+class MergeJoin(object):
+    """ Categories of UnitDiff computed by a merge join over the units sorted by path, as asked for the diff engine """
+    def __init__(self, former_units, units):
+        self.former_units, self.units = former_units, units
+
+    def categories(self):
+        former, units = sorted(self.former_units.items()), sorted(self.units.items())
+        new, deleted, changed = [], [], []
+        i, j, former_size, size = 0, 0, len(former), len(units)
+        while i < former_size and j < size:
+            former_path, former_status = former[i]
+            path, status = units[j]
+            if former_path == path:
+                if former_status != status:
+                    changed.append((path, status))
+                i, j = i + 1, j + 1
+            elif former_path < path:
+                deleted.append(former_path)
+                i += 1
+            else:
+                new.append(path)
+                changed.append((path, status))
+                j += 1
+        deleted.extend(path for path, _ in former[i:])
+        for path, status in units[j:]:
+            new.append(path)
+            changed.append((path, status))
+        return new, deleted, changed
+
+
+def merge_pull_request(last_master, test, former_units, units):
+    return test.diff(last_master, (), None, _unit_diff=MergeJoin(former_units, units))
+
+
+def normalize(diff):
+    """ Diffs without their empty categories, which the former implementation did not create """
+    return {name: {category: rows for category, rows in table.items() if rows} for name, table in diff.items()}
+
+
+def measure(ingests, last_master, test, former_units, units):
+    """ Best duration of each ingest over REPEAT runs, each one on its own copy of the units of the last master as
+    read from the database. Runs of the ingests alternate, so that they share the same load of the machine. """
+    best, results = [float("inf")] * len(ingests), [None] * len(ingests)
+    for _ in range(REPEAT):
+        for index, ingest in enumerate(ingests):
+            former = dict(former_units)
+            gc.collect()
+            gc.disable()
+            start = perf_counter()
+            results[index] = ingest(last_master, test, former, units)
+            best[index] = min(best[index], perf_counter() - start)
+            gc.enable()
+    return best, results
+
+
+def main():
+    print("{:>13} {:>8} {:>6} {:>13} {:>13} {:>8} {:>15}".format(
+        "ingest", "units", "rate", "former (s)", "current (s)", "speedup", "merge join (s)"
+    ))
+    for size in SIZES:
+        for rate in CHANGE_RATES:
+            last_master, test, former_units, units = make_tests(size, rate)
+            for name, ingests in [
+                ("master", [former_master, current_master]),
+                ("pull request", [former_pull_request, current_pull_request, merge_pull_request])
+            ]:
+                durations, results = measure(ingests, last_master, test, former_units, units)
+                expected = results[0]
+                if name == "master":
+                    assert sorted(results[1][0], key=itemgetter("path")) == \
+                        sorted(expected[0], key=itemgetter("path"))
+                    expected, results = expected[1], [result[1] for result in results]
+                for result in results[1:]:
+                    assert normalize(result) == normalize(expected)
+                before, after = durations[:2]
+                merged = "{:.3f}".format(durations[2]) if len(durations) > 2 else "-"
+                print("{:>13} {:>8} {:>6} {:>13.3f} {:>13.3f} {:>7.1f}x {:>15}".format(
+                    name, size, rate, before, after, before / after, merged
+                ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+""" Compare the hot read queries with and without the composite indexes of the models
+
+Usage : python -m benchmarks.indexes [database_uri]
+
+The database, by default an SQLite file in a temporary directory, is filled with 100k tests, then the indexes which
+former versions did not declare are dropped. Each query is timed, and its plan printed on SQLite, before and after
+Hook.schema.upgrade() creates the indexes again and the LatestTest pointers are filled, as `flask hook-upgrade` does.
+Plans are those of the history queries, which are still used for branches without pointer.
+"""
+import datetime
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+
+from Hook.models import model_maker
+from Hook.schema import upgrade
+
+
+REPOSITORIES = 100
+TESTS = 100000
+UNITS = 200
+UNIT_TESTS = 500
+REPEAT = 200
+NEW_INDEXES = (
+    "ux_repository_name", "ix_repo_test_source", "ix_repo_test_history", "ix_unit_test_path", "ix_word_count_test"
+)
+
+
+def make_app(uri):
+    app = Flask("benchmark")
+    app.config["SQLALCHEMY_DATABASE_URI"] = uri
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    db = SQLAlchemy(app)
+    return app, db, model_maker(db)
+
+
+def fill(db, models):
+    """ Insert the repositories, the tests, and the units of the latest tests """
+    insert = lambda model, rows: db.session.execute(model.__table__.insert(), rows)
+    insert(models.Repository, [
+        {"uuid": repo, "owner": "PerseusDl", "name": "repository-{}".format(repo), "active": True,
+         "main_branch": "master"}
+        for repo in range(1, REPOSITORIES + 1)
+    ])
+    start = datetime.datetime(2017, 1, 1)
+    insert(models.RepoTest, [
+        {"uuid": test, "repository": test % REPOSITORIES + 1, "run_at": start + datetime.timedelta(minutes=test),
+         "source": "master" if test % 4 == 0 else "issue-{}".format(test % 50), "travis_uri": "https://travis-ci.org",
+         "travis_build_id": str(test), "user": "ponteineptique", "avatar": "https://avatars.githubusercontent.com",
+         "event_type": "push", "texts_total": 0, "texts_passing": 0, "metadata_total": 0, "metadata_passing": 0,
+         "coverage": 90.0, "nodes_count": 0, "snapshot_depth": 0, "units_packed": False}
+        for test in range(1, TESTS + 1)
+    ])
+    insert(models.UnitPath, [
+        {"uuid": path, "path": "data/tlg{0:04d}/__cts__.xml".format(path)} for path in range(1, UNITS * 10 + 1)
+    ])
+    insert(models.UnitTest, [
+        {"test_id": test, "path_id": (test * 7 + unit) % (UNITS * 10) + 1, "status": unit % 3 != 0, "deleted": False}
+        for test in range(TESTS - UNIT_TESTS + 1, TESTS + 1)
+        for unit in range(UNITS)
+    ])
+    db.session.commit()
+
+
+def queries(db, models):
+    """ Queries to measure, as name -> (query whose plan is printed, callable running the query through the API) """
+    Repository, RepoTest, UnitPath = models.Repository, models.RepoTest, models.UnitPath
+    # Every test of repository-41 is a master test, repository-42 has none
+    repo = Repository.query.filter_by(owner="PerseusDl", name="repository-41").first()
+    test = RepoTest.query.get(TESTS)
+    path = "data/tlg{0:04d}/__cts__.xml".format((TESTS * 7 + 5) % (UNITS * 10) + 1)
+    repo_test = RepoTest.query.join(Repository, Repository.uuid == RepoTest.repository).filter(
+        Repository.owner == "PerseusDl", Repository.name == "repository-42", RepoTest.source == "issue-41"
+    ).order_by(RepoTest.run_at.desc())
+    return {
+        "last_master_test": (
+            repo.tests.filter(RepoTest.source == repo.main_branch).order_by(RepoTest.run_at.desc()).limit(1),
+            lambda: repo.last_master_test
+        ),
+        # Same queries as HookUI.get_repo_test for a branch
+        "get_repo_test": (
+            repo_test.limit(1),
+            lambda: Repository.query.filter_by(owner="PerseusDl", name="repository-42").first().latest_test("issue-41")
+        ),
+        "get_unit": (test.snapshot_rows(UnitPath.path == path), lambda: test.get_unit(path))
+    }
+
+
+def plan(db, query):
+    if db.engine.dialect.name != "sqlite":
+        return []
+    statement = str(query.statement.compile(dialect=db.engine.dialect, compile_kwargs={"literal_binds": True}))
+    return [row[-1] for row in db.session.execute("EXPLAIN QUERY PLAN " + statement)]
+
+
+def measure(db, models, label):
+    for name, (query, run) in queries(db, models).items():
+        run()
+        start = perf_counter()
+        for _ in range(REPEAT):
+            run()
+        duration = (perf_counter() - start) / REPEAT * 1000
+        print("{:>17} {:>9} {:>10.3f} ms".format(name, label, duration))
+        for step in plan(db, query):
+            print("{:>28} {}".format("", step))
+
+
+def main(uri=None):
+    with tempfile.TemporaryDirectory() as directory:
+        uri = uri or "sqlite:///" + os.path.join(directory, "benchmark.db")
+        app, db, models = make_app(uri)
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            fill(db, models)
+            for table in db.metadata.sorted_tables:
+                for index in table.indexes:
+                    if index.name in NEW_INDEXES:
+                        index.drop(bind=db.engine)
+
+            measure(db, models, "before")
+            start = perf_counter()
+            created, _ = upgrade(db)
+            models.LatestTest.rebuild()
+            db.session.commit()
+            print("upgrade created {} indexes in {:.3f} s".format(len(created), perf_counter() - start))
+            # Pooled connections keep the statements they prepared with the former plans
+            db.session.remove()
+            db.engine.dispose()
+            measure(db, models, "after")
+            db.session.remove()
+            db.drop_all()
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
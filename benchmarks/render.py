@@ -0,0 +1,76 @@
+""" Compare the former tabulate rendering of RepoTest.table with the renderer of Hook.rendering
+
+Usage : python -m benchmarks.render
+
+Requires tabulate, which the package does not depend on anymore. Both implementations render the same diff, without
+budget, and must write the same bytes.
+"""
+from collections import defaultdict
+from operator import itemgetter
+from time import perf_counter
+
+from tabulate import tabulate
+
+from Hook.rendering import render_diff
+
+
+SIZES = (1000, 10000, 100000)
+
+
+def make_diff(size):
+    """ Diff of size units, a third of them new, deleted or changed, with the global and word changes of a test """
+    paths = ["data/tlg{0:07d}/__cts__.xml".format(i) for i in range(size)]
+    return {
+        "Global": defaultdict(list, {"Changed": [("coverage", "-0.01"), ("nodes_count", "+1131790")]}),
+        "Words": defaultdict(list, {"Changed": [("eng", "+1"), ("lat", "-11")]}),
+        "Units": defaultdict(list, {
+            "New": [(path, "New") for path in paths[::3]],
+            "Deleted": [(path, "Deleted") for path in paths[1::3]],
+            "Changed": sorted(
+                [(path, "Failing") for path in paths[::3]] + [(path, "Passing") for path in paths[2::3]]
+            )
+        })
+    }
+
+
+def former_table(diff_dict, mode="md"):
+    """ Former implementation, sorting the categories again and measuring every cell with tabulate """
+    if mode == "md":
+        mode = "pipe"
+    output = []
+    keys = ["Global", "Units"]
+    if "Words" in diff_dict:
+        keys = ["Global", "Words", "Units"]
+    for name in keys:
+        table = diff_dict[name]
+        if len(table["New"] + table["Deleted"] + table["Changed"]) > 0:
+            output.append("## %s" % name)
+            output.append(
+                tabulate(
+                    [["`"+item+"`", value] for item, value in sorted((table["New"] + table["Deleted"]), key=itemgetter(0))] + \
+                    [["`"+item+"`", value] for item, value in sorted(table["Changed"], key=itemgetter(0))],
+                    ["Changed", "Status"],
+                    tablefmt=mode
+                )
+            )
+    return "\n\n".join(output)
+
+
+def measure(render, diff, mode):
+    start = perf_counter()
+    text = render(diff, mode=mode)
+    return perf_counter() - start, text
+
+
+def main():
+    print("{:>8} {:>5} {:>14} {:>14} {:>8}".format("units", "mode", "tabulate (s)", "rendering (s)", "speedup"))
+    for size in SIZES:
+        diff = make_diff(size)
+        for mode in ("md", "html"):
+            (before, expected), (after, text) = measure(former_table, diff, mode), measure(render_diff, diff, mode)
+            assert text == expected
+            print("{:>8} {:>5} {:>14.3f} {:>14.3f} {:>7.1f}x".format(size, mode, before, after, before / after))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+""" Compare the ORM and the bulk paths of RepoTest.save_units and RepoTest.save_words_count
+
+Usage : python -m benchmarks.save_units [database_uri]
+
+Each size is run against a fresh database, by default an SQLite file in a temporary directory.
+"""
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+
+from Hook.models import model_maker
+
+
+SIZES = (1000, 10000, 100000)
+LANGS = 300
+
+
+def make_app(uri):
+    app = Flask("benchmark")
+    app.config["SQLALCHEMY_DATABASE_URI"] = uri
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    db = SQLAlchemy(app)
+    return app, db, model_maker(db)
+
+
+def make_test(db, models):
+    repo = models.Repository(owner="PerseusDl", name="canonical-latinLit")
+    db.session.add(repo)
+    db.session.commit()
+    test = models.RepoTest(
+        repository=repo.uuid, source="master", travis_uri="https://travis-ci.org", travis_build_id="1",
+        user="ponteineptique", avatar="https://avatars.githubusercontent.com/u/1929830"
+    )
+    db.session.add(test)
+    db.session.commit()
+    return test
+
+
+def orm_save(db, models, test, units, words):
+    """ Former implementation, building one ORM object per row """
+    paths = models.UnitPath.resolve(units)
+    for path, status in units.items():
+        test.units.append(models.UnitTest(path_id=paths[path], status=status))
+    for lang, count in words.items():
+        test.words_count.append(models.WordCount(lang=lang, count=count))
+    db.session.commit()
+
+
+def bulk_save(db, models, test, units, words):
+    test.save_units(units, _commit=False)
+    test.save_words_count(words, _commit=False)
+    db.session.commit()
+
+
+def run(uri, size, save):
+    app, db, models = make_app(uri)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        test = make_test(db, models)
+        units = {"data/tlg{0:07d}/__cts__.xml".format(i): i % 7 != 0 for i in range(size)}
+        words = {"l{}".format(i): i for i in range(LANGS)}
+        start = perf_counter()
+        save(db, models, test, units, words)
+        duration = perf_counter() - start
+        assert models.UnitTest.query.count() == size
+        db.session.remove()
+        db.drop_all()
+    return duration
+
+
+def main(uri=None):
+    with tempfile.TemporaryDirectory() as directory:
+        uri = uri or "sqlite:///" + os.path.join(directory, "benchmark.db")
+        print("{:>8} {:>10} {:>10} {:>8}".format("units", "orm (s)", "bulk (s)", "speedup"))
+        for size in SIZES:
+            orm, bulk = run(uri, size, orm_save), run(uri, size, bulk_save)
+            print("{:>8} {:>10.3f} {:>10.3f} {:>7.1f}x".format(size, orm, bulk, orm / bulk))
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -13,13 +13,17 @@ setup(
         "Flask>=0.12",
         "flask-login>=0.4.0",
         "GitHub-Flask==2.1.1",
-        "Flask-SQLAlchemy==2.2",
-        "tabulate==0.7.7"
+        "Flask-SQLAlchemy==2.2"
     ],
+    extras_require={
+        "streaming": ["ijson>=3.1"]
+    },
     tests_require=[
         "mock==2.0.0",
         "requests-mock==1.3.0",
-        "beautifulsoup4==4.5.3"
+        "beautifulsoup4==4.5.3",
+        "ijson>=3.1",
+        "tabulate>=0.8"
     ],
     test_suite="tests",
     include_package_data=True,
@@ -110,6 +110,12 @@ def make_moke(db, models):
             self.test1 = test
             self.test2 = test2
             self.units = former_unit
+            self.build_id = 28
+
+        def next_build_id(self):
+            """ Every new test comes from a new build, otherwise it would be ignored as a duplicate """
+            self.build_id += 1
+            return str(self.build_id)
 
         def add_repo_to_pi(self):
             self.ponteineptique.repositories.append(self.latinLit)
@@ -123,7 +129,7 @@ def make_moke(db, models):
             ).first().register_test(
                 source="master",
                 travis_uri="https://travis-ci.org/PerseusDl/canonical-latinLit/builds/216262588",
-                travis_build_id="29",
+                travis_build_id=self.next_build_id(),
                 user="sonofmun",
                 avatar="https://avatars0.githubusercontent.com/u/3787067?v=3&s=126",
                 texts_total=637,
@@ -194,7 +200,7 @@ def make_moke(db, models):
                 source="55",
                 event_type="pull_request",
                 travis_uri="https://travis-ci.org/PerseusDl/canonical-latinLit/builds/216262588",
-                travis_build_id="29",
+                travis_build_id=self.next_build_id(),
                 user="sonofmun",
                 avatar="https://avatars0.githubusercontent.com/u/3787067?v=3&s=126",
                 texts_total=637,
@@ -2,7 +2,9 @@ from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from unittest import TestCase
 from Hook.models import model_maker
-from Hook.exceptions import RightsException
+from Hook.exceptions import RightsException, DuplicateTest, BrokenSnapshot
+from sqlalchemy import event
+from unittest.mock import patch
 import os
 from time import sleep
 
@@ -21,7 +23,9 @@ class TestModels(TestCase):
         self.RepoTest = Models.RepoTest
         self.RepoOwnership = Models.RepoOwnership
         self.UnitTest = Models.UnitTest
+        self.UnitPath = Models.UnitPath
         self.WordCount = Models.WordCount
+        self.LatestTest = Models.LatestTest
         self.db.create_all()
         self.client = app.test_client()
         self.former_unit = {
@@ -298,6 +302,69 @@ class TestModels(TestCase):
             "Dictionary of units should be equivalent"
         )
 
+    def test_bulk_units(self):
+        """ Ensure units saved in bulk are seen by a relationship which was loaded before """
+        pi, ll = self.createPonteineptique(), self.createLatinLit()
+        self.commit()
+        test = self.RepoTest(
+            source="master",
+            travis_uri="https://travis-ci.org/sonofmun/First1KGreek/builds/216262544",
+            travis_build_id="27", user="sonofmun", avatar="sonofmun@yahoooooooooooooooooooooooooooooooooooooo.com",
+            repository=ll.uuid
+        )
+        self.db.session.add(test)
+        self.commit()
+        self.assertEqual((test.units_as_dict, test.words_count_as_dict), ({}, {}))
+        units = {"data/{}.xml".format(i): i % 2 == 0 for i in range(2500)}
+        test.save_units(units, _commit=False)
+        test.save_words_count({"lat": 7899984}, _commit=False)
+        self.assertEqual(test.units_as_dict, units, "Units should be reloaded after their insertion by chunks")
+        self.assertEqual(test.words_count_as_dict, {"lat": 7899984})
+
+    def test_unit_paths(self):
+        """ Ensure paths are stored once whatever the number of tests using them """
+        pi, ll = self.createPonteineptique(), self.createLatinLit()
+        self.commit()
+        tests = []
+        for build in ["27", "28"]:
+            test = self.RepoTest(
+                source="issue-5", travis_uri="https://travis-ci.org/sonofmun/First1KGreek/builds/216262544",
+                travis_build_id=build, user="sonofmun", avatar="sonofmun@yahoooooooooooooooooooooooooooooooooooooo.com",
+                repository=ll.uuid
+            )
+            self.db.session.add(test)
+            self.commit()
+            test.save_units(self.former_unit)
+            tests.append(test)
+        self.assertEqual(self.UnitTest.query.count(), 2 * len(self.former_unit))
+        self.assertEqual(self.UnitPath.query.count(), len(self.former_unit), "Paths should be interned")
+        self.assertEqual([test.units_as_dict for test in tests], [self.former_unit, self.former_unit])
+
+        paths = self.UnitPath.resolve(["data/stoa0121/__cts__.xml", "data/new.xml"])
+        self.assertEqual(
+            paths["data/stoa0121/__cts__.xml"],
+            self.UnitPath.query.filter_by(path="data/stoa0121/__cts__.xml").first().uuid
+        )
+        self.assertEqual(self.UnitPath.query.get(paths["data/new.xml"]).path, "data/new.xml", "New path is interned")
+
+        # Another process interns one of the new paths between the lookup and the insert
+        inserts = []
+
+        def intern_first(conn, cursor, statement, *args):
+            if statement.startswith("INSERT INTO unit_path") and not inserts:
+                inserts.append(statement)
+                with self.db.engine.begin() as other:
+                    other.execute(self.UnitPath.__table__.insert().values(path="data/b.xml"))
+        event.listen(self.db.engine, "before_cursor_execute", intern_first)
+        self.addCleanup(event.remove, self.db.engine, "before_cursor_execute", intern_first)
+        self.commit()
+        paths = self.UnitPath.resolve(["data/a.xml", "data/b.xml", "data/c.xml"])
+        self.assertEqual(
+            {path: self.UnitPath.query.get(uuid).path for path, uuid in paths.items()},
+            {"data/a.xml": "data/a.xml", "data/b.xml": "data/b.xml", "data/c.xml": "data/c.xml"},
+            "Paths interned concurrently should not prevent the others from being interned"
+        )
+
     def test_repo_word_count(self):
         pi, ll = self.createPonteineptique(), self.createLatinLit()
         self.commit()
@@ -333,6 +400,21 @@ class TestModels(TestCase):
             },
             "Relationship and saving dict should work correctly"
         )
+        self.assertEqual(test.words_total, 55555 + 7899984 + 78945, "Total should be stored on the test")
+        self.assertEqual(test.words_sum, 55555 + 7899984 + 78945)
+
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(self.db.engine, "before_cursor_execute", record)
+        self.addCleanup(event.remove, self.db.engine, "before_cursor_execute", record)
+        self.assertEqual(test.words_count_as_dict["lat"], 7899984)
+        self.assertEqual(statements, [], "Counts should be read from the test row")
+
+        test.words_total, test.words_langs = None, None
+        self.commit()
+        self.assertEqual(test.words_sum, 55555 + 7899984 + 78945, "Tests saved before should read their rows")
 
     def test_diff(self):
         pi, ll = self.createPonteineptique(), self.createLatinLit()
@@ -529,6 +611,193 @@ class TestModels(TestCase):
 | `data/tlg0015/tlg001/tlg0015.tlg001.opp-grc1.xml` | Passing  |
 | `data/tlg0015/tlg002/__cts__.xml`                 | Failing  |""")
 
+    def test_register_test_transaction(self):
+        """ Check that a test is registered with a single commit and leaves nothing behind when it fails """
+        pi, ll = self.createPonteineptique(), self.createLatinLit()
+        self.commit()
+        kwargs = dict(
+            source="master", travis_uri="https://travis-ci.org/sonofmun/First1KGreek/builds/216262544",
+            user="sonofmun", avatar="sonofmun@yahoooooooooooooooooooooooooooooooooooooo.com",
+            texts_total=637, texts_passing=635, metadata_total=720, metadata_passing=719, coverage=99.79,
+            nodes_count=113179, words_count={"eng": 125, "lat": 956}
+        )
+        commits = []
+
+        def record(conn):
+            commits.append(conn)
+        event.listen(self.db.engine, "commit", record)
+        self.addCleanup(event.remove, self.db.engine, "commit", record)
+        test, _ = ll.register_test(travis_build_id="27", units=self.former_unit, **kwargs)
+        self.assertEqual(len(commits), 1, "Test, words and units should be saved in a single commit")
+
+        def broken_units():
+            yield "data/stoa0033a/__cts__.xml", False
+            raise ValueError("Malformed report")
+
+        with self.assertRaises(ValueError):
+            ll.register_test(travis_build_id="28", units=broken_units(), **kwargs)
+        self.commit()
+        self.assertEqual(self.RepoTest.query.count(), 1, "Failed test should not be saved")
+        self.assertEqual(self.WordCount.query.count(), 2, "Words of the failed test should not be saved")
+        self.assertEqual(ll.last_master_test, test)
+        self.assertEqual(test.units_as_dict, self.former_unit, "Units of the last master should be kept")
+
+    def test_latest_test(self):
+        """ Check that the latest test of each branch is pointed to when registered and read by its pointer """
+        pi, ll = self.createPonteineptique(), self.createLatinLit()
+        self.commit()
+        kwargs = dict(
+            travis_uri="https://travis-ci.org/sonofmun/First1KGreek/builds/216262544",
+            user="sonofmun", avatar="sonofmun@yahoooooooooooooooooooooooooooooooooooooo.com",
+            texts_total=637, texts_passing=635, metadata_total=720, metadata_passing=719, coverage=99.79,
+            nodes_count=113179, units=self.former_unit
+        )
+        master, _ = ll.register_test(source="master", travis_build_id="27", **kwargs)
+        pr, _ = ll.register_test(source="5", travis_build_id="28", **kwargs)
+        batch = ll.register_tests([
+            dict(source="master", travis_build_id="29", **kwargs),
+            dict(source="6", travis_build_id="30", **kwargs),
+            dict(source="master", travis_build_id="31", **kwargs)
+        ])
+        self.assertEqual(
+            sorted((latest.source, latest.test_id) for latest in self.LatestTest.query),
+            [("5", pr.uuid), ("6", batch[1].uuid), ("master", batch[2].uuid)],
+            "Each branch should point to its latest test"
+        )
+
+        self.assertEqual(ll.main_branch, "master")
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(self.db.engine, "before_cursor_execute", record)
+        self.addCleanup(event.remove, self.db.engine, "before_cursor_execute", record)
+        self.assertEqual(ll.last_master_test, batch[2])
+        self.assertEqual(ll.latest_test("5"), pr)
+        self.assertEqual(len(statements), 2, "Latest tests should be read with a single query")
+        self.assertNotIn("ORDER BY", statements[0], "Latest tests should not be sorted")
+        self.assertIsNone(ll.latest_test("7"))
+
+        self.LatestTest.query.delete()
+        self.commit()
+        self.assertEqual(ll.latest_test("5"), pr, "Branches without pointer should be found in the history")
+        self.assertEqual(self.LatestTest.rebuild(ll.uuid), 3)
+        self.commit()
+        self.assertEqual(self.LatestTest.query.get((ll.uuid, "master")).test_id, batch[2].uuid)
+
+        # Another process points the branch first
+        with self.db.engine.begin() as connection:
+            connection.execute(self.LatestTest.__table__.insert().values(
+                repository=ll.uuid, source="7", test_id=batch[0].uuid
+            ))
+        pr7, _ = ll.register_test(source="7", travis_build_id="32", **kwargs)
+        self.assertEqual(ll.latest_test("7"), pr7, "An existing pointer should be updated")
+
+    def test_snapshot_rebase(self):
+        """ Check that chains of unit deltas are rebased on a full snapshot """
+        pi, ll = self.createPonteineptique(), self.createLatinLit()
+        self.commit()
+        kwargs = dict(
+            source="master", travis_uri="https://travis-ci.org/sonofmun/First1KGreek/builds/216262544",
+            user="sonofmun", avatar="sonofmun@yahoooooooooooooooooooooooooooooooooooooo.com",
+            texts_total=637, texts_passing=635, metadata_total=720, metadata_passing=719, coverage=99.79,
+            nodes_count=113179
+        )
+        self.RepoTest.SNAPSHOT_INTERVAL = 3
+        self.addCleanup(setattr, self.RepoTest, "SNAPSHOT_INTERVAL", 16)
+        snapshots, tests = [], []
+        for build in range(5):
+            units = dict(self.former_unit, **{"data/build{}.xml".format(build): True})
+            test, _ = ll.register_test(travis_build_id=str(build), units=units, **kwargs)
+            snapshots.append(units)
+            tests.append(test)
+            sleep(0.01)
+
+        self.assertEqual(
+            [test.snapshot_depth for test in tests], [0, 1, 2, 0, 1],
+            "A full snapshot should be written every SNAPSHOT_INTERVAL master tests"
+        )
+        self.assertEqual(tests[4].snapshot_chain(), [tests[3].uuid, tests[4].uuid])
+        self.assertEqual(tests[4].units_as_dict, snapshots[4])
+        self.assertEqual(tests[3].units_as_dict, snapshots[3])
+        self.assertEqual(len(tests[4].units), 2, "Delta should hold a new and a deleted unit")
+        self.assertEqual(
+            [test.units_as_dict for test in tests[:3]], [{}, {}, {}],
+            "Former chain should be removed once rebased"
+        )
+        self.assertEqual(self.UnitTest.query.count(), len(self.former_unit) + 1 + 2)
+
+        self.RepoTest.query.filter_by(uuid=tests[1].uuid).delete()
+        self.commit()
+        with self.assertRaises(BrokenSnapshot) as context:
+            tests[2].snapshot_chain()
+        self.assertEqual(context.exception.missing, tests[1].uuid, "A chain missing a test should be reported")
+
+    def test_packed_units(self):
+        """ Check that units of master tests can be stored as a packed blob """
+        pi, ll = self.createPonteineptique(), self.createLatinLit()
+        self.commit()
+        kwargs = dict(
+            source="master", travis_uri="https://travis-ci.org/sonofmun/First1KGreek/builds/216262544",
+            user="sonofmun", avatar="sonofmun@yahoooooooooooooooooooooooooooooooooooooo.com",
+            texts_total=637, texts_passing=635, metadata_total=720, metadata_passing=719, coverage=99.79,
+            nodes_count=113179
+        )
+        self.RepoTest.PACK_UNITS = True
+        self.addCleanup(setattr, self.RepoTest, "PACK_UNITS", False)
+        second_units = dict(self.former_unit, **{"data/tlg0015/__cts__.xml": False})
+        first, _ = ll.register_test(travis_build_id="27", units=self.former_unit, **kwargs)
+        second, diff = ll.register_test(travis_build_id="28", units=iter(second_units.items()), **kwargs)
+
+        self.assertEqual(self.UnitTest.query.count(), 0, "No unit row should be written")
+        self.assertEqual(dict(diff["Units"]), {"Changed": [("data/tlg0015/__cts__.xml", "Failing")]})
+        self.assertEqual(second.units_as_dict, second_units)
+        self.assertEqual(second.get_unit("data/tlg0015/__cts__.xml"), False)
+        self.assertEqual(second.get_unit("data/unknown.xml"), None)
+        self.assertEqual(first.units_as_dict, {}, "Former packed units should be replaced")
+
+        self.RepoTest.PACK_UNITS = False
+        third, _ = ll.register_test(travis_build_id="29", units=self.former_unit, **kwargs)
+        self.assertEqual(third.snapshot_depth, 0, "Packed units cannot be the parent of a delta")
+        self.assertEqual((third.units_as_dict, second.units_as_dict), (self.former_unit, {}))
+
+    def test_sql_diff(self):
+        """ Check that units compared in the database give the same diffs and snapshots """
+        pi, ll = self.createPonteineptique(), self.createLatinLit()
+        self.commit()
+        kwargs = dict(
+            travis_uri="https://travis-ci.org/sonofmun/First1KGreek/builds/216262544",
+            user="sonofmun", avatar="sonofmun@yahoooooooooooooooooooooooooooooooooooooo.com",
+            texts_total=637, texts_passing=635, metadata_total=720, metadata_passing=719, coverage=99.79,
+            nodes_count=113179
+        )
+        self.RepoTest.SQL_DIFF = True
+        self.RepoTest.SNAPSHOT_INTERVAL = 3
+        self.addCleanup(setattr, self.RepoTest, "SQL_DIFF", False)
+        self.addCleanup(setattr, self.RepoTest, "SNAPSHOT_INTERVAL", 16)
+        first, diff = ll.register_test(travis_build_id="1", source="master", units=self.former_unit, **kwargs)
+        self.assertIsNone(diff)
+
+        units = dict(self.former_unit)
+        for build in range(2, 7):
+            units = dict(units, **{"data/build{}.xml".format(build): build % 2 == 0})
+            units["data/tlg0015/__cts__.xml"] = not units["data/tlg0015/__cts__.xml"]
+            units.pop("data/build{}.xml".format(build - 2), None)
+            last_master = ll.last_master_test
+            expected = last_master.diff(last_master, units, None)["Units"]
+            source = "master" if build != 4 else "issue-12"
+            test, diff = ll.register_test(
+                travis_build_id=str(build), source=source, units=iter(units.items()), **kwargs
+            )
+            self.assertEqual(diff["Units"], expected, "Diff of build {} should match".format(build))
+            if source == "master":
+                self.assertEqual(test.units_as_dict, units)
+            sleep(0.01)
+
+        self.assertEqual([test.snapshot_depth for test in ll.tests.order_by(self.RepoTest.run_at)], [0, 1, 2, 0, 0, 1])
+        self.assertIn("Deleted", diff["Units"])
+        self.assertIn("New", diff["Units"])
+
     def test_register_test(self):
         """ Check that register test produce all necessary informations """
         pi, ll = self.createPonteineptique(), self.createLatinLit()
@@ -666,10 +935,26 @@ class TestModels(TestCase):
         )
         # Ensure we still have the same units inside
         self.assertEqual(ll.last_master_test, test3, "New test should overwrite old test")
-        self.assertEqual(test.units_as_dict, {}, "Old units should be removed")
-        self.assertEqual(test.dyn_units.all(), [], "Old units should be emptied")
+        self.assertEqual(test.units_as_dict, self.former_unit, "Parent snapshot should be kept")
         self.assertEqual(ll.last_master_test.units_as_dict, test3_units, "New units should should be saved")
         self.assertEqual(test3.units_as_dict, test3_units, "New units should should be saved in current RepoTest")
+        self.assertEqual(
+            sorted((u.path, u.status, u.deleted) for u in test3.units),
+            [
+                ("data/tlg0015/__cts__.xml", True, True),
+                ("data/tlg0015/tlg001/__cts__.xml", False, False),
+                ("data/tlg0015/tlg001/tlg0015.tlg001.opp-grc1.xml", True, False),
+                ("data/tlg0015/tlg002/__cts__.xml", False, False)
+            ],
+            "Only changes from the former master should be written"
+        )
+        self.assertEqual(
+            [test3.get_unit(path) for path in [
+                "data/tlg0015/__cts__.xml", "data/tlg0015/tlg002/__cts__.xml", "data/stoa0121/__cts__.xml"
+            ]],
+            [None, False, False],
+            "Units should be read through the snapshot chain"
+        )
         self.assertEqual(test2.units, [], "There should be no units registered for test2")
 
         self.assertEqual(
@@ -682,3 +967,30 @@ class TestModels(TestCase):
         )
         self.assertEqual(test.words_count_as_dict, {"eng": 125, "lat": 956}, "Old wordcount should still be okay")
         self.assertEqual(test2.words_count_as_dict, {"eng":55556, "lat":7899973, "ger":78945}, "There should be no wordcount registered for test2")
+
+    def test_duplicate_test(self):
+        """ Ensure a build registered twice, even concurrently, is saved once and returned with its diff """
+        ll = self.createLatinLit()
+        self.commit()
+        kwargs = dict(
+            source="master", travis_uri="https://travis-ci.org/sonofmun/First1KGreek/builds/216262544",
+            user="sonofmun", avatar="sonofmun@yahoooooooooooooooooooooooooooooooooooooo.com",
+            texts_total=637, texts_passing=635, metadata_total=720, metadata_passing=719, coverage=99.79,
+            nodes_count=113179, units=self.former_unit, sha="7d3d6a0b62f0d244b684843c7546906d742013fd"
+        )
+        ll.register_test(travis_build_id="27", **kwargs)
+        test, diff = ll.register_test(travis_build_id="28", **dict(kwargs, texts_passing=636))
+        self.assertEqual(diff["Global"]["Changed"], [("texts_passing", "+1")])
+
+        self.assertEqual(
+            ll.register_test(travis_build_id="28", **kwargs), (test, diff),
+            "The former test should be returned with its diff"
+        )
+        # The test is registered by another request between the lookup and the insert
+        with patch.object(self.Repository, "find_duplicate", side_effect=[None, test]):
+            self.assertEqual(ll.register_test(travis_build_id="28", **kwargs), (test, diff))
+        with self.assertRaises(DuplicateTest) as context:
+            ll.register_test(travis_build_id="28", _check_duplicate=False, **kwargs)
+        self.assertEqual((context.exception.test, context.exception.diff), (test, diff))
+        self.assertEqual(self.RepoTest.query.count(), 2, "Duplicates should not be saved")
+        self.assertEqual(ll.last_master_test, test)
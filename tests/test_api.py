@@ -1,9 +1,12 @@
 import datetime
+import gzip
+import zlib
 
 import re
 from json import loads, dumps
 from copy import deepcopy
 from tests.baseTest import BaseTest
+from Hook.metrics import units_bucket
 
 
 class TestAPI(BaseTest):
@@ -112,9 +115,90 @@ class TestAPI(BaseTest):
                 "reponame": "canonical-latinLit",
                 "username": "PerseusDl",
                 'comment_uri': 'https://github.com/PerseusDL/canonical-latinLit/commit/7d3d6a0b62f0d244b684843c7546906d742013fd#all_commit_comments',
+                "diff": {
+                    "base": 1,
+                    "tables": {
+                        "Global": {
+                            "Changed": [["coverage", "+0.06"], ["metadata_passing", "-1"], ["texts_passing", "+6"]]
+                        },
+                        "Units": {
+                            "Changed": [
+                                ["data/tlg0015/tlg001/__cts__.xml", "Failing"],
+                                ["data/tlg0015/tlg001/tlg0015.tlg001.opp-grc1.xml", "Passing"],
+                                ["data/tlg0015/tlg002/__cts__.xml", "Failing"]
+                            ],
+                            "Deleted": [["data/tlg0015/__cts__.xml", "Deleted"]],
+                            "New": [["data/tlg0015/tlg002/__cts__.xml", "New"]]
+                        },
+                        "Words": {"Changed": [["lat", "+94"]], "New": [["ger", "New"]]}
+                    }
+                }
             }
         )
 
+    def test_repository_api_diff(self):
+        """ Ensure any two tests of a repository can be compared, and the comparison stored """
+        test3 = self.Mokes.make_new_latinLit_test(session=self.db.session)
+        url = "/api/hook/v2.0/user/repositories/PerseusDl/canonical-latinLit/diff?base={}&head={}"
+        response = self.client.get(url.format(test3.uuid, 1))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(loads(response.data.decode()), {
+            "base": 3,
+            "head": 1,
+            "tables": {
+                "Global": {
+                    "Changed": [["coverage", "-0.06"], ["metadata_passing", "+1"], ["texts_passing", "-6"]]
+                },
+                "Units": {
+                    "Changed": [
+                        ["data/tlg0015/__cts__.xml", "Passing"],
+                        ["data/tlg0015/tlg001/__cts__.xml", "Passing"],
+                        ["data/tlg0015/tlg001/tlg0015.tlg001.opp-grc1.xml", "Failing"]
+                    ],
+                    "Deleted": [["data/tlg0015/tlg002/__cts__.xml", "Deleted"]],
+                    "New": [["data/tlg0015/__cts__.xml", "New"]]
+                },
+                "Words": {"Changed": [["lat", "-94"]], "Deleted": [["ger", "Deleted"]]}
+            }
+        }, "Units of the master snapshots should be compared")
+        self.assertEqual(self.Models.TestDiff.query.get((1, 3)).on_ingest, False)
+        self.assertIsNone(self.Models.TestDiff.of(1), "Comparisons are not the diff of their head test")
+
+        self.Models.UnitTest.query.delete()
+        self.db.session.commit()
+        response = self.client.get(url.format(test3.uuid, 1) + "&format=md")
+        self.assertEqual(response.mimetype, "text/markdown")
+        self.assertRegex(response.data.decode(), r"\| `data/tlg0015/tlg002/__cts__.xml` +\| Deleted +\|",
+                         "Comparisons should be read back once computed")
+
+        response = loads(self.client.get(url.format(2, 1)).data.decode())
+        self.assertNotIn("Units", response["tables"], "Units of pull request tests are not stored")
+        self.assertEqual(response["tables"]["Words"], {"Changed": [["lat", "-94"]], "Deleted": [["ger", "Deleted"]]})
+
+        self.assertEqual(self.client.get(url.format(1, "")).status_code, 400)
+        self.assertEqual(self.client.get(url.format(1, 3) + "&format=pdf").status_code, 400)
+        self.assertEqual(self.client.get(url.format(1, 78)).status_code, 404)
+
+        self.Models.TestDiff.CACHE_SIZE = 1
+        self.addCleanup(setattr, self.Models.TestDiff, "CACHE_SIZE", 1000)
+        self.assertEqual(self.client.get(url.format(test3.uuid, 2)).status_code, 200)
+        self.assertEqual(
+            [(diff.test_id, diff.base_id) for diff in self.Models.TestDiff.query.filter_by(on_ingest=False)],
+            [(2, 3)], "Oldest comparisons should be deleted beyond the cache size"
+        )
+        self.Models.TestDiff.CACHE_SIZE = 0
+        self.assertEqual(self.client.get(url.format(2, test3.uuid)).status_code, 200)
+        self.assertIsNone(self.Models.TestDiff.query.get((3, 2)), "Comparisons should not be stored without cache")
+
+        head, base = self.Models.RepoTest.query.get(2), self.Models.RepoTest.query.get(3)
+        self.Models.TestDiff.store(head, base, {"Global": {"Changed": [["coverage", "+1.0"]]}})
+        self.Models.TestDiff.store(head, base, {"Global": {}}, on_ingest=False)
+        self.db.session.commit()
+        self.assertEqual(
+            self.Models.TestDiff.of(2).diff["Global"]["Changed"], [("coverage", "+1.0")],
+            "A comparison stored concurrently should not replace the diff of the test"
+        )
+
     @property
     def pr_push(self):
         return {
@@ -301,4 +385,633 @@ class TestAPI(BaseTest):
             self.assertEqual(
                 reply["comment_uri"],
                 'https://github.com/PerseusDl/canonical-latinLit/commit/6dcb09b5b57875f334f61aebed695e2e4193db5e#commitcomment-1'
-            )
\ No newline at end of file
+            )
+
+    def test_async_ingest(self):
+        """ Ensure reports are queued with a status link and processed by the ingest workers """
+        self.hook.async_ingest = True
+        reply = self.client.post(
+            "/api/hook/v2.0/user/repositories/PerseusDl/canonical-latinLit",
+            data=dumps(self.comment_push),
+            content_type='application/json',
+            headers={
+                "HookTest-Secure-X": self.hook.make_hooktest_signature(
+                    dumps(self.comment_push).encode(),
+                    secret=self.Mokes.latinLit.travis_env
+                )
+            }
+        )
+        self.assertEqual(reply.status_code, 202, "Report should be accepted for processing")
+        self.assertEqual(
+            {
+                'status': 'queued', 'job': 1,
+                'link': '/api/hook/v2.0/user/repositories/PerseusDl/canonical-latinLit/ingest/1'
+            },
+            loads(reply.data.decode())
+        )
+        self.assertTrue(reply.headers["Location"].endswith("/ingest/1"))
+        self.assertEqual(self.Models.RepoTest.query.count(), 2, "Nothing should be registered before processing")
+
+        with self.mocks([
+                (
+                    "post",
+                    re.compile("api.github.com/repos/PerseusDl/canonical-latinLit/commits/24880f5078f0c1e84653b5fa8e6c6985fc411d57/comments"),
+                    dict(
+                        json=self.fixtures['./tests/fixtures/commit.comment.response.json'][0],
+                        headers=self.fixtures['./tests/fixtures/commit.comment.response.json'][1],
+                        status_code=201
+                    )
+                 ),
+                (
+                    "get",
+                    re.compile("api.github.com/repos/PerseusDl/canonical-latinLit/commits/24880f5078f0c1e84653b5fa8e6c6985fc411d57"),
+                    dict(
+                        json=self.fixtures['./tests/fixtures/commit.push.response.json'][0],
+                        status_code=200
+                    )
+                )
+        ]):
+            with self.app.app_context():
+                self.assertEqual(self.hook.process_ingest_jobs(), 1, "Queued job should be processed")
+
+        status = loads(self.client.get(
+            "/api/hook/v2.0/user/repositories/PerseusDl/canonical-latinLit/ingest/1"
+        ).data.decode())
+        self.assertEqual(status["status"], "success")
+        self.assertEqual(status["link"], "/repo/PerseusDl/canonical-latinLit/3")
+        reply = loads(self.client.get(
+            "/api/hook/v2.0/user/repositories/PerseusDl/canonical-latinLit/history?uuid=3"
+        ).data.decode())
+        self.assertEqual(
+            reply["comment_uri"],
+            'https://github.com/PerseusDl/canonical-latinLit/commit/6dcb09b5b57875f334f61aebed695e2e4193db5e#commitcomment-1'
+        )
+
+    def test_async_ingest_failure(self):
+        """ Ensure invalid queued reports end up in error """
+        self.hook.async_ingest = True
+        d = dumps({k: v for k, v in self.comment_push.items() if k not in ["source"]})
+        self.client.post(
+            "/api/hook/v2.0/user/repositories/PerseusDl/canonical-latinLit",
+            data=d,
+            content_type='application/json',
+            headers={
+                "HookTest-Secure-X": self.hook.make_hooktest_signature(
+                    d.encode(), secret=self.Mokes.latinLit.travis_env
+                )
+            }
+        )
+        with self.app.app_context():
+            self.hook.process_ingest_jobs()
+        status = loads(self.client.get(
+            "/api/hook/v2.0/user/repositories/PerseusDl/canonical-latinLit/ingest/1"
+        ).data.decode())
+        self.assertEqual(status["status"], "error")
+        self.assertEqual(status["error"], "Missing parameter 'source'")
+        reply = self.client.get("/api/hook/v2.0/user/repositories/PerseusDl/canonical-greekLit/ingest/1")
+        self.assertEqual(reply.status_code, 404, "Jobs are scoped to their repository")
+
+    def test_async_ingest_recovery(self):
+        """ Ensure reports left running by a dead worker are processed again once their lease expired """
+        self.hook.async_ingest = True
+        d = dumps({k: v for k, v in self.comment_push.items() if k not in ["source"]})
+        self.client.post(
+            "/api/hook/v2.0/user/repositories/PerseusDl/canonical-latinLit",
+            data=d,
+            content_type='application/json',
+            headers={
+                "HookTest-Secure-X": self.hook.make_hooktest_signature(
+                    d.encode(), secret=self.Mokes.latinLit.travis_env
+                )
+            }
+        )
+        with self.app.app_context():
+            # A worker claims the job and dies before finishing it
+            self.assertEqual(self.Models.IngestJob.claim().status, "running")
+            self.assertEqual(self.hook.process_ingest_jobs(), 0, "Job should be left to its worker during the lease")
+
+            job = self.Models.IngestJob.query.get(1)
+            job.claimed_at = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.hook.ingest_lease + 1)
+            self.db.session.commit()
+            self.assertEqual(self.hook.process_ingest_jobs(), 1, "Job should be claimed again once its lease expired")
+        status = loads(self.client.get(
+            "/api/hook/v2.0/user/repositories/PerseusDl/canonical-latinLit/ingest/1"
+        ).data.decode())
+        self.assertEqual(status["status"], "error")
+        self.assertEqual(status["error"], "Missing parameter 'source'")
+
+    def test_async_comments(self):
+        """ Ensure comments go through the outbox and are retried with a backoff """
+        self.hook.async_comments = True
+        with self.mocks([
+                (
+                    "get",
+                    re.compile("api.github.com/repos/PerseusDl/canonical-latinLit/commits/24880f5078f0c1e84653b5fa8e6c6985fc411d57"),
+                    dict(
+                        json=self.fixtures['./tests/fixtures/commit.push.response.json'][0],
+                        status_code=200
+                    )
+                ),
+                (
+                    "post",
+                    re.compile("api.github.com/repos/PerseusDl/canonical-latinLit/commits/24880f5078f0c1e84653b5fa8e6c6985fc411d57/comments"),
+                    dict(json={"message": "Server Error"}, status_code=502)
+                )
+        ]):
+            reply = self.client.post(
+                "/api/hook/v2.0/user/repositories/PerseusDl/canonical-latinLit",
+                data=dumps(self.comment_push),
+                content_type='application/json',
+                headers={
+                    "HookTest-Secure-X": self.hook.make_hooktest_signature(
+                        dumps(self.comment_push).encode(),
+                        secret=self.Mokes.latinLit.travis_env
+                    )
+                }
+            )
+            self.assertEqual(reply.status_code, 200, "Ingest should not wait for the comment")
+            self.assertNotIn(
+                "comment_uri",
+                loads(self.client.get(
+                    "/api/hook/v2.0/user/repositories/PerseusDl/canonical-latinLit/history?uuid=3"
+                ).data.decode()),
+                "Comment should not be posted yet"
+            )
+            with self.app.app_context():
+                self.assertEqual(self.hook.dispatch_comments(), 1, "Due comment should be tried once")
+                comment = self.Models.CommentOutbox.query.get(1)
+                self.assertEqual((comment.status, comment.attempts), ("pending", 1), "Failure should be retried")
+                self.assertGreater(
+                    comment.next_attempt_at, datetime.datetime.utcnow() + datetime.timedelta(seconds=20),
+                    "Retry should be delayed by the backoff"
+                )
+                self.assertEqual(self.hook.dispatch_comments(), 0, "Comment should not be due yet")
+                comment.next_attempt_at = datetime.datetime.utcnow()
+                self.db.session.commit()
+
+        with self.mocks([
+                (
+                    "post",
+                    re.compile("api.github.com/repos/PerseusDl/canonical-latinLit/commits/24880f5078f0c1e84653b5fa8e6c6985fc411d57/comments"),
+                    dict(
+                        json=self.fixtures['./tests/fixtures/commit.comment.response.json'][0],
+                        headers=self.fixtures['./tests/fixtures/commit.comment.response.json'][1],
+                        status_code=201
+                    )
+                )
+        ]):
+            with self.app.app_context():
+                self.assertEqual(self.hook.dispatch_comments(), 1)
+                self.assertEqual(self.Models.CommentOutbox.query.get(1).status, "sent")
+        reply = loads(self.client.get(
+            "/api/hook/v2.0/user/repositories/PerseusDl/canonical-latinLit/history?uuid=3"
+        ).data.decode())
+        self.assertEqual(
+            reply["comment_uri"],
+            'https://github.com/PerseusDl/canonical-latinLit/commit/6dcb09b5b57875f334f61aebed695e2e4193db5e#commitcomment-1'
+        )
+
+    def test_async_comments_recovery(self):
+        """ Ensure comments left sending by a dead dispatcher are retried, then given up, once their lease expired """
+        uri = "repos/PerseusDl/canonical-latinLit/commits/24880f5078f0c1e84653b5fa8e6c6985fc411d57/comments"
+        expired = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.hook.comment_lease + 1)
+        self.hook.comment_max_attempts = 2
+        with self.app.app_context():
+            self.db.session.add(self.Models.CommentOutbox(test_id=1, uri=uri, body="Recap"))
+            self.db.session.commit()
+            # A dispatcher claims the comment and dies before posting it
+            self.assertEqual(self.Models.CommentOutbox.claim().status, "sending")
+            self.assertEqual(self.hook.dispatch_comments(), 0, "Comment should be left to its dispatcher during the lease")
+
+            comment = self.Models.CommentOutbox.query.get(1)
+            comment.claimed_at = expired
+            self.db.session.commit()
+            with self.mocks([
+                    (
+                        "post",
+                        re.compile("api.github.com/" + uri),
+                        dict(
+                            json=self.fixtures['./tests/fixtures/commit.comment.response.json'][0],
+                            headers=self.fixtures['./tests/fixtures/commit.comment.response.json'][1],
+                            status_code=201
+                        )
+                    )
+            ]):
+                self.assertEqual(self.hook.dispatch_comments(), 1, "Lost comment should be retried")
+            comment = self.Models.CommentOutbox.query.get(1)
+            self.assertEqual((comment.status, comment.attempts), ("sent", 1), "Lost attempt should be counted")
+
+            self.db.session.add(self.Models.CommentOutbox(test_id=1, uri=uri, body="Recap", attempts=1))
+            self.db.session.commit()
+            self.Models.CommentOutbox.claim()
+            comment = self.Models.CommentOutbox.query.get(2)
+            comment.claimed_at = expired
+            self.db.session.commit()
+            self.assertEqual(self.hook.dispatch_comments(), 0)
+            comment = self.Models.CommentOutbox.query.get(2)
+            self.assertEqual(
+                (comment.status, comment.attempts, comment.error),
+                ("failed", 2, "Comment dispatcher stopped while posting"),
+                "Lost comment should be given up after the last attempt"
+            )
+
+    def test_batch_ingest(self):
+        """ Ensure many reports can be registered at once with a status per report """
+        invalid = {k: v for k, v in self.pr_push.items() if k not in ["source"]}
+        secret = self.Mokes.latinLit.travis_env
+        for content_type, build_id in [("application/json", 213), ("application/x-ndjson", 215)]:
+            pr = dict(self.pr_push, build_id=str(build_id))
+            master = dict(self.comment_push, source="master", build_id=str(build_id + 1))
+            if content_type == "application/json":
+                body = dumps([pr, invalid, master])
+            else:
+                body = "\n".join([dumps(pr), dumps(invalid), dumps(master), ""])
+            with self.mocks([
+                    (
+                        "get",
+                        re.compile("api.github.com/repos/PerseusDl/canonical-latinLit/commits/24880f5078f0c1e84653b5fa8e6c6985fc411d57"),
+                        dict(json=self.fixtures['./tests/fixtures/commit.push.response.json'][0], status_code=200)
+                    ),
+                    (
+                        "get",
+                        re.compile("api.github.com/repos/PerseusDl/canonical-latinLit/pulls/5"),
+                        dict(json=self.fixtures['./tests/fixtures/commit.pull_request.response.json'][0], status_code=200)
+                    )
+            ]):
+                start = self.Models.RepoTest.query.count()
+                reply = self.client.post(
+                    "/api/hook/v2.0/user/repositories/PerseusDl/canonical-latinLit/batch",
+                    data=body,
+                    content_type=content_type,
+                    headers={
+                        "HookTest-Secure-X": self.hook.make_hooktest_signature(
+                            body.encode(), secret=secret
+                        )
+                    }
+                )
+            self.assertEqual(reply.status_code, 200)
+            self.assertEqual(
+                loads(reply.data.decode()),
+                {"reports": [
+                    {"status": "success", "link": "/repo/PerseusDl/canonical-latinLit/{}".format(start + 1)},
+                    {"status": "error", "error": "Missing parameter 'source'"},
+                    {"status": "success", "link": "/repo/PerseusDl/canonical-latinLit/{}".format(start + 2)}
+                ]},
+                "Every report should get its own status"
+            )
+            with self.app.app_context():
+                repo = self.Models.Repository.query.filter_by(name="canonical-latinLit").first()
+                self.assertEqual(repo.last_master_test.uuid, start + 2, "Master test should be registered")
+                self.assertEqual(repo.last_master_test.units_as_dict, self.Mokes.units, "Master units should be saved")
+                self.assertEqual(
+                    self.Models.UnitTest.query.count(), len(self.Mokes.units),
+                    "Former master units should be removed"
+                )
+
+    def test_batch_ingest_failures(self):
+        body = dumps([self.pr_push])
+        reply = self.client.post(
+            "/api/hook/v2.0/user/repositories/PerseusDl/canonical-latinLit/batch",
+            data=body, content_type="application/json"
+        )
+        self.assertEqual(reply.status_code, 403, "Signature is not right")
+        body = dumps(self.pr_push)
+        reply = self.client.post(
+            "/api/hook/v2.0/user/repositories/PerseusDl/canonical-latinLit/batch",
+            data=body, content_type="application/json",
+            headers={
+                "HookTest-Secure-X": self.hook.make_hooktest_signature(
+                    body.encode(), secret=self.Mokes.latinLit.travis_env
+                )
+            }
+        )
+        self.assertEqual(reply.status_code, 400)
+        self.assertIn("Batch should be a json array of reports", reply.data.decode())
+
+    def test_streaming_ingest(self):
+        """ Ensure reports can be read incrementally and their units stored """
+        self.hook.streaming_ingest = True
+        master = dict(self.comment_push, source="master", units=dict(self.Mokes.units, **{"data/new.xml": False}))
+        with self.mocks([
+                (
+                    "post",
+                    re.compile("api.github.com/repos/PerseusDl/canonical-latinLit/commits/24880f5078f0c1e84653b5fa8e6c6985fc411d57/comments"),
+                    dict(
+                        json=self.fixtures['./tests/fixtures/commit.comment.response.json'][0],
+                        headers=self.fixtures['./tests/fixtures/commit.comment.response.json'][1],
+                        status_code=201
+                    )
+                 ),
+                (
+                    "get",
+                    re.compile("api.github.com/repos/PerseusDl/canonical-latinLit/commits/24880f5078f0c1e84653b5fa8e6c6985fc411d57"),
+                    dict(
+                        json=self.fixtures['./tests/fixtures/commit.push.response.json'][0],
+                        status_code=200
+                    )
+                )
+        ]):
+            reply = self.client.post(
+                "/api/hook/v2.0/user/repositories/PerseusDl/canonical-latinLit",
+                data=dumps(master),
+                content_type='application/json',
+                headers={
+                    "HookTest-Secure-X": self.hook.make_hooktest_signature(
+                        dumps(master).encode(),
+                        secret=self.Mokes.latinLit.travis_env
+                    )
+                }
+            )
+            self.assertEqual(reply.status_code, 200, "Data is all right !")
+            self.assertEqual(
+                {'status': 'success', 'link': '/repo/PerseusDl/canonical-latinLit/3'},
+                loads(reply.data.decode())
+            )
+            post = self.__mocks__.request_history[-1]
+            self.assertIn("data/new.xml", loads(post.body)["body"], "Streamed units should be diffed")
+
+        with self.app.app_context():
+            test = self.Models.RepoTest.query.get(3)
+            self.assertEqual(test.units_as_dict, master["units"], "Streamed units should be saved")
+            self.assertEqual(test.coverage, 76.01)
+
+        reply = self.client.post(
+            "/api/hook/v2.0/user/repositories/PerseusDl/canonical-latinLit",
+            data=dumps(master),
+            content_type='application/json'
+        )
+        self.assertEqual(reply.status_code, 403, "Signature is not right")
+
+    def test_compressed_ingest(self):
+        """ Ensure gzip and deflate bodies are accepted, with the signature computed on the compressed bytes """
+        secret = self.Mokes.latinLit.travis_env
+        for streaming, encoding, compress in [(False, "gzip", gzip.compress), (True, "deflate", zlib.compress)]:
+            self.hook.streaming_ingest = streaming
+            body = compress(dumps(dict(self.pr_push, build_id=encoding)).encode())
+            with self.mocks([
+                    (
+                        "post",
+                        re.compile("api.github.com/repos/PerseusDl/canonical-latinLit/issues/5/comments"),
+                        dict(
+                            json=self.fixtures['./tests/fixtures/pr.comment.response.json'][0],
+                            headers=self.fixtures['./tests/fixtures/pr.comment.response.json'][1],
+                            status_code=201
+                        )
+                     ),
+                    (
+                        "get",
+                        re.compile("api.github.com/repos/PerseusDl/canonical-latinLit/pulls/5"),
+                        dict(json=self.fixtures['./tests/fixtures/commit.pull_request.response.json'][0], status_code=200)
+                    )
+            ]):
+                reply = self.client.post(
+                    "/api/hook/v2.0/user/repositories/PerseusDl/canonical-latinLit",
+                    data=body,
+                    content_type='application/json',
+                    headers={
+                        "Content-Encoding": encoding,
+                        "HookTest-Secure-X": self.hook.make_hooktest_signature(body, secret=secret)
+                    }
+                )
+            self.assertEqual(reply.status_code, 200, "Compressed data is all right !")
+            self.assertEqual(loads(reply.data.decode())["status"], "success")
+
+    def test_compressed_ingest_failures(self):
+        """ Ensure decompression is bounded and unknown encodings are refused """
+        self.hook.max_payload_size = 1024
+        for streaming in (False, True):
+            self.hook.streaming_ingest = streaming
+            for encoding, body, status, message in [
+                ("gzip", gzip.compress(b"[" + b" " * 1024 * 1024 + b"]"), 413, "Decompressed data is larger than 1024 bytes"),
+                ("gzip", b"not gzip", 400, "Data could not be decompressed"),
+                ("br", b"{}", 415, "Unsupported content encoding br")
+            ]:
+                reply = self.client.post(
+                    "/api/hook/v2.0/user/repositories/PerseusDl/canonical-latinLit",
+                    data=body,
+                    content_type='application/json',
+                    headers={
+                        "Content-Encoding": encoding,
+                        "HookTest-Secure-X": self.hook.make_hooktest_signature(
+                            body, secret=self.Mokes.latinLit.travis_env
+                        )
+                    }
+                )
+                self.assertEqual(reply.status_code, status, message)
+                self.assertIn(message, reply.data.decode())
+
+    def test_author_cache(self):
+        """ Ensure GitHub author lookups are cached, failures included, and skipped when the report has them """
+        secret = self.Mokes.latinLit.travis_env
+        anonymous = {k: v for k, v in self.pr_push.items() if k not in ["user", "avatar"]}
+
+        def post(report):
+            return self.client.post(
+                "/api/hook/v2.0/user/repositories/PerseusDl/canonical-latinLit",
+                data=dumps(report),
+                content_type='application/json',
+                headers={"HookTest-Secure-X": self.hook.make_hooktest_signature(dumps(report).encode(), secret=secret)}
+            )
+
+        comment = (
+            "post",
+            re.compile("api.github.com/repos/PerseusDl/canonical-latinLit/issues/5/comments"),
+            dict(
+                json=self.fixtures['./tests/fixtures/pr.comment.response.json'][0],
+                headers=self.fixtures['./tests/fixtures/pr.comment.response.json'][1],
+                status_code=201
+            )
+        )
+        with self.mocks([comment, (
+            "get", re.compile("api.github.com/repos/PerseusDl/canonical-latinLit/pulls/5"),
+            dict(json=self.fixtures['./tests/fixtures/commit.pull_request.response.json'][0], status_code=200)
+        )]):
+            for build_id in ["300", "301"]:
+                self.assertEqual(post(dict(anonymous, build_id=build_id)).status_code, 200)
+            self.assertEqual(post(self.pr_push).status_code, 200)
+            lookups = [r for r in self.__mocks__.request_history if r.method == "GET"]
+            self.assertEqual(len(lookups), 1, "Author should be looked up once")
+
+        with self.mocks([(
+            "get", re.compile("api.github.com/repos/PerseusDl/canonical-latinLit/pulls/6"),
+            dict(json={"message": "Not Found"}, status_code=404)
+        )]):
+            for _ in range(2):
+                with self.assertRaises(Exception):
+                    self.hook.get_user_information_from_github(
+                        {"event_type": "pull_request", "source": "6"}, "PerseusDl", "canonical-latinLit"
+                    )
+            self.assertEqual(len(self.__mocks__.request_history), 1, "Failed lookups should be cached too")
+
+    def test_duplicate_ingest(self):
+        """ Ensure a build which was already registered is neither saved nor commented again """
+        secret = self.Mokes.latinLit.travis_env
+        with self.mocks([
+                (
+                    "post",
+                    re.compile("api.github.com/repos/PerseusDl/canonical-latinLit/issues/5/comments"),
+                    dict(
+                        json=self.fixtures['./tests/fixtures/pr.comment.response.json'][0],
+                        headers=self.fixtures['./tests/fixtures/pr.comment.response.json'][1],
+                        status_code=201
+                    )
+                 )
+        ]):
+            replies = [
+                loads(self.client.post(
+                    "/api/hook/v2.0/user/repositories/PerseusDl/canonical-latinLit",
+                    data=dumps(self.pr_push),
+                    content_type='application/json',
+                    headers={
+                        "HookTest-Secure-X": self.hook.make_hooktest_signature(
+                            dumps(self.pr_push).encode(), secret=secret
+                        )
+                    }
+                ).data.decode())
+                for _ in range(2)
+            ]
+            self.assertEqual(len(self.__mocks__.request_history), 1, "Comment should be posted once")
+        self.assertEqual(
+            replies,
+            [
+                {'status': 'success', 'link': '/repo/PerseusDl/canonical-latinLit/3'},
+                {'status': 'duplicate', 'link': '/repo/PerseusDl/canonical-latinLit/3'}
+            ]
+        )
+
+        body = dumps([self.pr_push, dict(self.pr_push, build_id="400"), dict(self.pr_push, build_id="400")])
+        reply = self.client.post(
+            "/api/hook/v2.0/user/repositories/PerseusDl/canonical-latinLit/batch",
+            data=body, content_type="application/json",
+            headers={"HookTest-Secure-X": self.hook.make_hooktest_signature(body.encode(), secret=secret)}
+        )
+        self.assertEqual(
+            loads(reply.data.decode())["reports"],
+            [
+                {'status': 'duplicate', 'link': '/repo/PerseusDl/canonical-latinLit/3'},
+                {'status': 'success', 'link': '/repo/PerseusDl/canonical-latinLit/4'},
+                {'status': 'duplicate', 'link': '/repo/PerseusDl/canonical-latinLit/4'}
+            ],
+            "Duplicates should be found in the database and in the batch"
+        )
+        with self.app.app_context():
+            self.assertEqual(self.Models.RepoTest.query.count(), 4, "Duplicates should not be saved")
+
+    def test_ingest_backpressure(self):
+        """ Ensure requests above the concurrency limits are answered with a 429 and a Retry-After """
+        secret, greek_secret = self.Mokes.latinLit.travis_env, self.Mokes.greekLit.travis_env
+        body = dumps(dict(self.pr_push, build_id="500"))
+        headers = {"HookTest-Secure-X": self.hook.make_hooktest_signature(body.encode(), secret=secret)}
+        limiter = self.hook.ingest_limiter
+        limiter.limit, limiter.per_key_limit = 2, 1
+
+        limiter.acquire("PerseusDl/canonical-latinLit")
+        reply = self.client.post(
+            "/api/hook/v2.0/user/repositories/PerseusDl/canonical-latinLit",
+            data=body, content_type='application/json', headers=headers
+        )
+        self.assertEqual(reply.status_code, 429, "Repository limit is reached")
+        self.assertEqual(reply.headers["Retry-After"], "2", "Rejected request is waiting for a single slot")
+        reply = self.client.post(
+            "/api/hook/v2.0/user/repositories/PerseusDl/canonical-latinLit/batch",
+            data=dumps([]), content_type='application/json'
+        )
+        self.assertEqual(reply.status_code, 403, "Signatures are checked before taking a slot")
+        reply = self.client.post(
+            "/api/hook/v2.0/user/repositories/PerseusDl/canonical-latinLit/batch",
+            data=dumps([]), content_type='application/json',
+            headers={"HookTest-Secure-X": self.hook.make_hooktest_signature(dumps([]).encode(), secret=secret)}
+        )
+        self.assertEqual(reply.status_code, 429, "Batches share the repository limit")
+        self.assertEqual(reply.headers["Retry-After"], "3", "Retry-After grows with the rejected requests")
+
+        limiter.acquire("PerseusDl/canonical-greekLit")
+        reply = self.client.post(
+            "/api/hook/v2.0/user/repositories/PerseusDl/canonical-greekLit",
+            data=body, content_type='application/json',
+            headers={"HookTest-Secure-X": self.hook.make_hooktest_signature(body.encode(), secret=greek_secret)}
+        )
+        self.assertEqual(reply.status_code, 429, "Global limit is reached")
+        self.assertIn(b"Hook is already ingesting 2 reports", reply.data)
+
+        metrics = self.client.get("/api/hook/v2.0/metrics").data.decode().splitlines()
+        for line in [
+            "hook_ingest_in_flight 2.0", "hook_ingest_limit 2.0", "hook_ingest_repository_limit 1.0",
+            "hook_ingest_queued_reports 0.0", "hook_comments_pending 0.0",
+            "# TYPE hook_ingest_rejected_total counter", "hook_ingest_rejected_total 3.0"
+        ]:
+            self.assertIn(line, metrics)
+        self.assertNotIn(
+            "hook_ingest_mean_duration_seconds", "\n".join(metrics), "Unknown values should not be exposed"
+        )
+
+        limiter.release("PerseusDl/canonical-latinLit")
+        limiter.release("PerseusDl/canonical-greekLit")
+        with self.mocks([
+                (
+                    "post",
+                    re.compile("api.github.com/repos/PerseusDl/canonical-latinLit/issues/5/comments"),
+                    dict(json=self.fixtures['./tests/fixtures/pr.comment.response.json'][0], status_code=201)
+                )
+        ]):
+            reply = self.client.post(
+                "/api/hook/v2.0/user/repositories/PerseusDl/canonical-latinLit",
+                data=body, content_type='application/json', headers=headers
+            )
+        self.assertEqual(reply.status_code, 200, "Slots are freed once requests are done")
+        metrics = limiter.metrics
+        self.assertEqual((metrics["in_flight"], metrics["repositories"]), (0, {}))
+        self.assertIsNotNone(metrics["mean_duration"], "Duration of the request should be recorded")
+
+    def test_ingest_stage_metrics(self):
+        """ Ensure the duration of each ingest stage is exposed in the Prometheus format """
+        self.hook.streaming_ingest = True
+        master = dict(self.comment_push, source="master")
+        del master["user"]
+        with self.mocks([
+                (
+                    "post",
+                    re.compile("api.github.com/repos/PerseusDl/canonical-latinLit/commits/24880f5078f0c1e84653b5fa8e6c6985fc411d57/comments"),
+                    dict(json=self.fixtures['./tests/fixtures/commit.comment.response.json'][0], status_code=201)
+                 ),
+                (
+                    "get",
+                    re.compile("api.github.com/repos/PerseusDl/canonical-latinLit/commits/24880f5078f0c1e84653b5fa8e6c6985fc411d57"),
+                    dict(json=self.fixtures['./tests/fixtures/commit.push.response.json'][0], status_code=200)
+                )
+        ]):
+            reply = self.client.post(
+                "/api/hook/v2.0/user/repositories/PerseusDl/canonical-latinLit",
+                data=dumps(master),
+                content_type='application/json',
+                headers={
+                    "HookTest-Secure-X": self.hook.make_hooktest_signature(
+                        dumps(master).encode(), secret=self.Mokes.latinLit.travis_env
+                    )
+                }
+            )
+        self.assertEqual(reply.status_code, 200)
+        reply = self.client.post(
+            "/api/hook/v2.0/user/repositories/PerseusDl/canonical-greekLit",
+            data=dumps(master),
+            content_type='application/json'
+        )
+        self.assertEqual(reply.status_code, 403)
+
+        reply = self.client.get("/api/hook/v2.0/metrics")
+        self.assertEqual(reply.status_code, 200)
+        self.assertEqual(reply.headers["Content-Type"], "text/plain; version=0.0.4; charset=utf-8")
+        metrics = reply.data.decode()
+        self.assertIn("# TYPE hook_ingest_stage_seconds histogram", metrics)
+        units = units_bucket(len(self.Mokes.units))
+        for stage in ["signature", "parse", "author", "register", "save_units", "diff", "table", "comment"]:
+            self.assertIn(
+                'hook_ingest_stage_seconds_count{{stage="{}",units="{}"}} 1'.format(stage, units),
+                metrics
+            )
+        self.assertIn(
+            'hook_ingest_stage_seconds_count{stage="signature",units="unknown"} 1',
+            metrics,
+            "Rejected reports should be timed too"
+        )
+        self.assertNotIn("repository=", metrics, "Series should not grow with the number of repositories")
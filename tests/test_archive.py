@@ -0,0 +1,116 @@
+import datetime
+from json import loads
+
+from tests.baseTest import BaseTest
+from Hook.archive import ArchivePolicy
+from Hook.retention import RetentionPolicy
+
+
+class TestArchive(BaseTest):
+    def setUp(self):
+        super(TestArchive, self).setUp()
+        old = datetime.datetime(2017, 1, 1)
+        self.delta = self.Mokes.make_new_latinLit_test(self.db.session)
+        self.old_prs = self.Mokes.make_lots_of_tests(3, self.db.session, self.Mokes.latinLit)
+        self.master = self.Models.RepoTest(
+            repository=self.Mokes.latinLit.uuid, source="master", travis_uri="https://travis-ci.org",
+            travis_build_id="99", user="sonofmun", avatar="https://avatars0.githubusercontent.com/u/3787067",
+            sha="7d3d6a0b62f0d244b684843c7546906d742013fd"
+        )
+        self.db.session.add(self.master)
+        self.db.session.commit()
+        self.master.save_units(self.Mokes.units)
+        for days, test in enumerate([self.Mokes.test1, self.Mokes.test2, self.delta]):
+            test.run_at = old + datetime.timedelta(days=days)
+        self.db.session.commit()
+        self.delta_units = self.delta.units_as_dict
+        self.ids = [test.uuid for test in [self.Mokes.test1, self.Mokes.test2, self.delta] + self.old_prs]
+
+    def test_archive(self):
+        """ Ensure old tests are moved to the archive, except the last master and its snapshot chain """
+        self.assertEqual(ArchivePolicy().apply(self.db, self.Models), 0, "Default policy archives nothing")
+        units, words = self.Models.UnitTest.query.count(), self.Models.WordCount.query.count()
+        master, delta = self.master.uuid, self.delta.uuid
+
+        messages = []
+        count = ArchivePolicy(days=30, batch_size=4).apply(self.db, self.Models, progress=messages.append)
+        self.assertEqual(count, 6)
+        self.assertEqual(messages, [
+            "PerseusDl/canonical-latinLit: 4 tests archived", "PerseusDl/canonical-latinLit: 6 tests archived"
+        ])
+        self.assertEqual([test.uuid for test in self.Models.RepoTest.query.all()], [master])
+        self.assertEqual(self.Models.UnitTest.query.count(), len(self.Mokes.units), "Only hot units are left")
+        self.assertLess(self.Models.UnitTest.query.count(), units)
+        self.assertEqual(self.Models.WordCount.query.count(), 0)
+        self.assertGreater(words, 0)
+        self.assertEqual(ArchivePolicy(days=30).apply(self.db, self.Models), 0, "Nothing left to archive")
+
+        latinLit = self.Models.Repository.query.filter_by(name="canonical-latinLit").first()
+        archived = latinLit.get_test(delta)
+        self.assertIsInstance(archived, self.Models.ArchivedTest)
+        self.assertEqual(archived.units_as_dict, self.delta_units, "Units of deltas are rebuilt before archiving")
+        self.assertEqual(archived.get_unit("data/tlg0015/tlg002/__cts__.xml"), False)
+        self.assertEqual(archived.words_count_as_dict, {"eng": 125, "lat": 1050, "ger": 1088})
+        self.assertEqual(archived.status, "success")
+        self.assertIsInstance(latinLit.get_test(master), self.Models.RepoTest, "Hot tests are read first")
+        self.assertEqual(latinLit.last_master_test.uuid, master, "Pointers to archived tests are rebuilt")
+        self.assertEqual(self.Models.LatestTest.query.count(), 1)
+        self.assertIsNone(latinLit.get_test(1000))
+
+    def test_archive_without_units(self):
+        """ Ensure tests which do not store their units are archived without units """
+        self.Models.TestDiff.CACHE_SIZE = 0
+        self.addCleanup(setattr, self.Models.TestDiff, "CACHE_SIZE", 1000)
+        pr, master = self.Mokes.test2.uuid, self.master.uuid
+        latinLit = self.Models.Repository.query.filter_by(name="canonical-latinLit").first()
+        hot = latinLit.diff_tests(latinLit.get_test(master), latinLit.get_test(pr))
+        self.assertEqual(sorted(hot), ["Global", "Words"], "Units of pull request tests are not stored")
+
+        ArchivePolicy(days=30).apply(self.db, self.Models)
+        archived = latinLit.get_test(pr)
+        self.assertIsInstance(archived, self.Models.ArchivedTest)
+        self.assertFalse(archived.has_units)
+        self.assertEqual(
+            latinLit.diff_tests(latinLit.get_test(master), archived), hot,
+            "Archiving should not make up units for the diff"
+        )
+
+    def test_read_through(self):
+        """ Ensure archived tests are still served by the history API and the report pages """
+        ArchivePolicy(days=30).apply(self.db, self.Models)
+
+        history = loads(self.client.get(
+            "/api/hook/v2.0/user/repositories/PerseusDl/canonical-latinLit/history"
+        ).data.decode())
+        self.assertEqual(len(history["logs"]), 7, "Hot and archived tests are listed")
+        self.assertEqual(history["logs"][0]["uuid"], self.master_uuid(), "Tests are sorted by date")
+        self.assertEqual(
+            [log["uuid"] for log in history["logs"][-3:]], self.ids[2::-1], "Archived tests are sorted by date"
+        )
+
+        report = loads(self.client.get(
+            "/api/hook/v2.0/user/repositories/PerseusDl/canonical-latinLit/history?uuid={}".format(self.ids[2])
+        ).data.decode())
+        self.assertEqual(report["coverage"], 99.85)
+        self.assertEqual(report["words_count"], {"eng": 125, "lat": 1050, "ger": 1088})
+
+        page = self.client.get("/repo/PerseusDl/canonical-latinLit/{}".format(self.ids[2])).data.decode()
+        self.assertIn('<dd aria-label="Words in lat">1050</dd>', page)
+        page = self.client.get("/repo/PerseusDl/canonical-latinLit").data.decode()
+        self.assertIn('href="/repo/PerseusDl/canonical-latinLit/{}"'.format(self.ids[0]), page)
+
+    def test_retention(self):
+        """ Ensure the retention policy applies to archived tests, and the command archives tests """
+        result = self.app.test_cli_runner().invoke(args=["hook-archive", "--days", "30"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("6 tests archived", result.output)
+
+        counts = RetentionPolicy(details_days=30, pr_days=30).apply(self.db, self.Models)
+        self.assertEqual(counts["tests"], 4, "Archived tests of other branches are deleted")
+        self.assertEqual(counts["packed"], 6, "Archived tests lose their details")
+        archived = self.Models.ArchivedTest.query.get(self.ids[0])
+        self.assertEqual((archived.units_as_dict, archived.words_count_as_dict), ({}, {}))
+        self.assertEqual(archived.coverage, 99.79, "Summary columns are kept")
+
+    def master_uuid(self):
+        return self.Models.RepoTest.query.filter_by(travis_build_id="99").first().uuid
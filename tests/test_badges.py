@@ -10,6 +10,7 @@ from Hook.ext import HookUI
 from Hook.exceptions import RightsException
 
 from unittest import TestCase
+from sqlalchemy import event
 from tests.make_moke import make_moke
 
 
@@ -165,6 +166,19 @@ class TestBadgesRoutes(TestCase):
         self.assertIn("1088", response, "Last Master Should have 956 words")
         self.assertIn("ger", response, "Badge should be Latin only")
 
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(self.db.engine, "before_cursor_execute", record)
+        self.addCleanup(event.remove, self.db.engine, "before_cursor_execute", record)
+        self.client.get("/api/hook/v2.0/badges/PerseusDl/canonical-latinLit/words.svg?lang=ger")
+        self.client.get("/api/hook/v2.0/badges/PerseusDl/canonical-latinLit/words.svg")
+        self.assertEqual(
+            [statement for statement in statements if "word_count" in statement], [],
+            "Badges should read the counts stored on the test"
+        )
+
     def test_wrong_words_badges(self):
         """ Ensure route for badges are failing with wrong badges"""
         response = self.client.get("/api/hook/v2.0/badges/PerseusDl/canonical-farsiLit/words.svg")
@@ -0,0 +1,58 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy import event
+
+from Hook.cache import MemoryCache, DatabaseCache
+from tests.baseTest import BaseTest
+
+
+class TestMemoryCache(TestCase):
+    def test_lru(self):
+        """ Ensure the least recently used entries are dropped first """
+        cache = MemoryCache(size=2)
+        cache.set("a", 1, 60)
+        cache.set("b", 2, 60)
+        self.assertEqual(cache.get("a"), 1, "Reading a refreshes its position")
+        cache.set("c", 3, 60)
+        self.assertEqual(cache.get("b"), None, "b is the least recently used entry")
+        self.assertEqual((cache.get("a"), cache.get("c")), (1, 3))
+
+    def test_ttl(self):
+        """ Ensure entries expire """
+        cache = MemoryCache()
+        with patch("Hook.cache.monotonic", return_value=100):
+            cache.set("a", {"user": "ponteineptique"}, 10)
+            cache.set("b", {"error": "404"}, 1)
+        with patch("Hook.cache.monotonic", return_value=105):
+            self.assertEqual(cache.get("a"), {"user": "ponteineptique"})
+            self.assertEqual(cache.get("b"), None, "Entry should have expired")
+        with patch("Hook.cache.monotonic", return_value=110):
+            self.assertEqual(cache.get("a"), None, "Entry should have expired")
+        self.assertEqual(cache.entries, {}, "Expired entries are removed")
+
+
+class TestDatabaseCache(BaseTest):
+    def test_transaction(self):
+        """ Ensure entries are written on their own, whatever the state of the session """
+        cache = DatabaseCache(self.db, self.Models.CacheEntry)
+        self.db.session.add(self.Models.Repository(owner="PerseusDl", name="canonical-farsiLit"))
+        cache.set("a", {"user": "ponteineptique"}, 60)
+        cache.set("a", {"user": "sonofmun"}, 60)
+        self.db.session.rollback()
+        self.assertEqual(cache.get("a"), {"user": "sonofmun"}, "Entries should be replaced")
+        self.assertIsNone(
+            self.Models.Repository.query.filter_by(name="canonical-farsiLit").first(),
+            "The session of the caller should not be committed"
+        )
+
+    def test_concurrent_set(self):
+        """ Ensure a key cached by another process between the lookup and the insert does not fail """
+        cache = DatabaseCache(self.db, self.Models.CacheEntry)
+
+        def concurrent_insert(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith("INSERT INTO cache_entry"):
+                cursor.execute(statement, parameters)
+        event.listen(self.db.engine, "before_cursor_execute", concurrent_insert)
+        self.addCleanup(event.remove, self.db.engine, "before_cursor_execute", concurrent_insert)
+        cache.set("a", {"user": "ponteineptique"}, 60)
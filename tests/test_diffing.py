@@ -0,0 +1,32 @@
+from unittest import TestCase
+
+from Hook.diffing import UnitDiff
+
+
+class TestDiffing(TestCase):
+    def setUp(self):
+        self.former = {"data/a.xml": True, "data/b.xml": False, "data/c.xml": True, "data/d.xml": True}
+        self.units = [("data/e.xml", False), ("data/b.xml", True), ("data/a.xml", True), ("data/d.xml", True)]
+
+    def test_compare(self):
+        """ Ensure units are passed through in order and flagged when they are new or changed """
+        unit_diff = UnitDiff(self.former)
+        self.assertEqual(list(unit_diff.compare(self.units)), [
+            ("data/e.xml", False, True), ("data/b.xml", True, True),
+            ("data/a.xml", True, False), ("data/d.xml", True, False)
+        ])
+        self.assertEqual(unit_diff.deleted, {"data/c.xml": True})
+        self.assertEqual(unit_diff.categories(), (
+            ["data/e.xml"], ["data/c.xml"], [("data/b.xml", True), ("data/e.xml", False)]
+        ))
+        self.assertEqual(len(self.former), 4, "Former units are copied by default")
+
+    def test_track(self):
+        """ Ensure tracking passes pairs through and gives the same differences as consuming at once """
+        tracked = UnitDiff(self.former)
+        self.assertEqual(list(tracked.track(self.units)), self.units)
+        self.assertEqual(tracked.categories(), UnitDiff(self.former).consume(dict(self.units)).categories())
+        self.assertEqual(UnitDiff({}).consume(self.units).categories(), (
+            ["data/a.xml", "data/b.xml", "data/d.xml", "data/e.xml"], [],
+            [("data/a.xml", True), ("data/b.xml", True), ("data/d.xml", True), ("data/e.xml", False)]
+        ))
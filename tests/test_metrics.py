@@ -0,0 +1,56 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+from Hook.metrics import Histogram, StageTimer, units_bucket, render_value
+
+
+class TestStageTimer(TestCase):
+    def test_nested_stages(self):
+        """ Ensure time spent in a nested stage is not counted in the outer one """
+        timer = StageTimer()
+        with patch("Hook.metrics.monotonic", side_effect=[0, 1, 3, 4, 10, 11, 12, 13]):
+            with timer.stage("diff"):
+                with timer.stage("save_units"):
+                    pass
+                units = list(timer.iterate("parse", [("a.xml", True)]))
+        self.assertEqual(units, [("a.xml", True)])
+        self.assertEqual(timer.units, 1, "Streamed units should be counted")
+        self.assertEqual(dict(timer.durations), {"diff": 1 + 1 + 1 + 1, "save_units": 2, "parse": 6 + 1})
+
+    def test_units_bucket(self):
+        self.assertEqual(
+            [units_bucket(count) for count in [None, 0, 100, 101, 99999, 100001]],
+            ["unknown", "0-100", "0-100", "100-1k", "10k-100k", "100k+"]
+        )
+
+
+class TestHistogram(TestCase):
+    def test_render(self):
+        """ Ensure histograms are written in the Prometheus text format """
+        histogram = Histogram("ingest_seconds", "Ingest duration", labels=("stage", ), buckets=(1, 5))
+        histogram.observe(0.5, stage="diff")
+        histogram.observe(2, stage="diff")
+        histogram.observe(3, stage='"odd"')
+        self.assertEqual(histogram.render(), [
+            "# HELP ingest_seconds Ingest duration",
+            "# TYPE ingest_seconds histogram",
+            'ingest_seconds_bucket{stage="diff",le="1.0"} 1',
+            'ingest_seconds_bucket{stage="diff",le="5.0"} 2',
+            'ingest_seconds_bucket{stage="diff",le="+Inf"} 2',
+            'ingest_seconds_sum{stage="diff"} 2.5',
+            'ingest_seconds_count{stage="diff"} 2',
+            'ingest_seconds_bucket{stage="\\"odd\\"",le="1.0"} 0',
+            'ingest_seconds_bucket{stage="\\"odd\\"",le="5.0"} 1',
+            'ingest_seconds_bucket{stage="\\"odd\\"",le="+Inf"} 1',
+            'ingest_seconds_sum{stage="\\"odd\\""} 3.0',
+            'ingest_seconds_count{stage="\\"odd\\""} 1'
+        ])
+
+    def test_render_value(self):
+        """ Ensure metrics without labels are written, unless their value is unknown """
+        self.assertEqual(render_value("ingest_rejected_total", "Rejected ingests", 3, kind="counter"), [
+            "# HELP ingest_rejected_total Rejected ingests",
+            "# TYPE ingest_rejected_total counter",
+            "ingest_rejected_total 3.0"
+        ])
+        self.assertEqual(render_value("ingest_limit", "Limit", None), [])
@@ -0,0 +1,33 @@
+import random
+from unittest import TestCase
+
+from Hook.packing import pack_units, PackedUnits
+
+
+class TestPacking(TestCase):
+    def setUp(self):
+        rng = random.Random(42)
+        self.units = {
+            "data/tlg{:04d}/tlg{:03d}/tlg{:04d}.tlg{:03d}.perseus-grc{}.xml".format(
+                author, work, author, work, rng.randint(1, 3)
+            ): rng.random() > 0.2
+            for author in range(60)
+            for work in range(rng.randint(1, 10))
+        }
+
+    def test_round_trip(self):
+        """ Ensure packed units decode to the same units, sorted by path """
+        packed = PackedUnits(pack_units(self.units))
+        self.assertEqual(len(packed), len(self.units))
+        self.assertEqual(packed.as_dict(), self.units)
+        self.assertEqual([path for path, _ in packed.items()], sorted(self.units))
+        self.assertEqual(PackedUnits(pack_units({})).as_dict(), {})
+
+    def test_get(self):
+        """ Ensure single paths are found, including the first and last of each block """
+        packed = PackedUnits(pack_units(self.units.items(), block_size=4))
+        for path, status in self.units.items():
+            self.assertIs(packed.get(path), status, path)
+        self.assertIsNone(packed.get("data/aaa.xml"), "Path before the first block")
+        self.assertIsNone(packed.get("data/zzz.xml"), "Path after the last block")
+        self.assertIsNone(packed.get("data/tlg0001/tlg000/unknown.xml"), "Path inside a block")
@@ -0,0 +1,87 @@
+import random
+import re
+from collections import defaultdict
+from unittest import TestCase
+
+from tabulate import tabulate
+
+from Hook.rendering import render_diff, pipe_table, html_table
+
+
+class TestRendering(TestCase):
+    def make_diff(self, units):
+        """ Diff where a share of units is new, deleted or changed, each category sorted as RepoTest.diff does """
+        paths = ["data/tlg{:05d}/__cts__.xml".format(unit) for unit in range(units)]
+        return {
+            "Global": defaultdict(list, {"Changed": [("coverage", "-0.01"), ("texts_total", "+5")]}),
+            "Units": defaultdict(list, {
+                "New": [(path, "New") for path in paths[::3]],
+                "Deleted": [(path, "Deleted") for path in paths[1::3]],
+                "Changed": sorted(
+                    [(path, "Failing") for path in paths[::3]] + [(path, "Passing") for path in paths[2::3]]
+                )
+            })
+        }
+
+    def test_small(self):
+        """ Ensure diffs which fit are rendered aligned, as without budget """
+        diff = self.make_diff(30)
+        self.assertEqual(render_diff(diff, budget=60000), render_diff(diff))
+        self.assertIn("| `data/tlg00001/__cts__.xml` | Deleted  |", render_diff(diff))
+        with self.assertRaises(ValueError):
+            render_diff(diff, mode="grid")
+
+    def test_tabulate(self):
+        """ Ensure aligned tables are the ones tabulate writes """
+        rng = random.Random(42)
+        statuses = [
+            ["New", "Deleted", "Passing", "Failing"],
+            ["+1", "-11", "+113179", "-2"],
+            ["-0.01", "+5", "-44", "+1131790", "+0.25", "-12.50"],
+            ["New", "+94", "Deleted", "-0.01"]
+        ]
+        for choices in statuses:
+            for size in (1, 5, 50):
+                rows = [
+                    ("data/tlg{:04d}/{}.xml".format(rng.randint(0, 9999), "<&>'" * rng.randint(0, 1)),
+                     rng.choice(choices))
+                    for _ in range(size)
+                ]
+                reference = [["`" + item + "`", status] for item, status in rows]
+                self.assertEqual(pipe_table(rows), tabulate(reference, ["Changed", "Status"], tablefmt="pipe"))
+                self.assertEqual(html_table(rows), tabulate(reference, ["Changed", "Status"], tablefmt="html"))
+
+    def test_budget(self):
+        """ Ensure large diffs stop before the budget, counting the rows left out """
+        diff = self.make_diff(30000)
+        link = "https://hook.perseus.org/repo/PerseusDl/canonical-latinLit/3"
+        for mode in ("md", "html"):
+            table = render_diff(diff, mode=mode, budget=60000, link=link)
+            self.assertLessEqual(len(table.encode("utf-8")), 60000)
+            rows = table.count("`coverage`" if mode == "md" else "<code>coverage") + table.count("texts_total") + \
+                table.count("data/tlg")
+            more = int(re.search(r"…and (\d+) more", table).group(1))
+            self.assertEqual(rows + more, 2 + 10000 + 10000 + 20000, "Every row should be written or counted")
+            self.assertIn(link, table.splitlines()[-1])
+        self.assertTrue(table.startswith("<h2>Global</h2>"))
+        self.assertIn("</tbody>\n</table>\n<p><a href", table, "Tables should be closed before the footer")
+
+        table = render_diff(diff, budget=2000)
+        self.assertEqual(
+            table.splitlines()[:12],
+            [
+                "## Global", "", "| Changed | Status |", "|:--------|:-------|",
+                "| `coverage` | -0.01 |", "| `texts_total` | +5 |", "",
+                "## Units", "", "| Changed | Status |", "|:--------|:-------|",
+                "| `data/tlg00000/__cts__.xml` | New |"
+            ]
+        )
+        self.assertEqual(table.splitlines()[12], "| `data/tlg00001/__cts__.xml` | Deleted |",
+                         "New and deleted units should be merged in path order")
+        self.assertTrue(table.endswith("more*"), "The footer has no link unless given")
+
+    def test_escape(self):
+        """ Ensure items are escaped in html """
+        diff = {"Global": defaultdict(list), "Units": defaultdict(list, {"New": [("data/<a>.xml", "New")] * 2000})}
+        table = render_diff(diff, mode="html", budget=500)
+        self.assertIn("<code>data/&lt;a&gt;.xml</code>", table)
@@ -0,0 +1,84 @@
+import datetime
+
+from tests.baseTest import BaseTest
+from Hook.retention import RetentionPolicy
+
+
+class TestRetention(BaseTest):
+    def setUp(self):
+        super(TestRetention, self).setUp()
+        self.delta = self.Mokes.make_new_latinLit_test(self.db.session)
+        self.old_prs = self.Mokes.make_lots_of_tests(3, self.db.session, self.Mokes.latinLit)
+        # Master test whose units were saved as a full snapshot outside of the former chain
+        self.master = self.Models.RepoTest(
+            repository=self.Mokes.latinLit.uuid, source="master", travis_uri="https://travis-ci.org",
+            travis_build_id="99", user="sonofmun", avatar="https://avatars0.githubusercontent.com/u/3787067",
+            run_at=datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        )
+        self.db.session.add(self.master)
+        self.db.session.commit()
+        self.master.save_units(self.Mokes.units)
+        self.old_prs[0].save_units(self.Mokes.units)
+
+    def unit_counts(self):
+        return {
+            test.uuid: self.Models.UnitTest.query.filter_by(test_id=test.uuid).count()
+            for test in [self.Mokes.test1, self.delta, self.master, self.old_prs[0]]
+        }
+
+    def test_master_units(self):
+        """ Ensure only the units of the latest master tests and of their snapshot chain are kept """
+        self.assertEqual(RetentionPolicy().apply(self.db, self.Models), {
+            "units": 0, "packed": 0, "words": 0, "comments": 0, "tests": 0
+        }, "Default policy keeps everything")
+
+        RetentionPolicy(master_units=2).apply(self.db, self.Models)
+        self.assertEqual(self.Models.UnitTest.query.count(), 3 * len(self.Mokes.units) + 4, "Nothing to delete")
+        self.assertEqual(self.Mokes.test1.units_as_dict, self.Mokes.units, "Base of a kept delta is kept")
+
+        messages = []
+        counts = RetentionPolicy(master_units=1, batch_size=5).apply(self.db, self.Models, progress=messages.append)
+        self.assertEqual(counts["units"], len(self.Mokes.units) + 4, "Former chain should be deleted")
+        self.assertEqual(self.master.units_as_dict, self.Mokes.units)
+        self.assertEqual(self.unit_counts()[self.old_prs[0].uuid], len(self.Mokes.units), "Other branches are kept")
+        self.assertEqual(messages[0], "PerseusDl/canonical-latinLit: 5 units deleted", "Progress of each batch")
+        self.assertEqual(len(messages), (len(self.Mokes.units) + 4 + 4) // 5)
+
+    def test_old_tests(self):
+        """ Ensure old tests lose their details, and old tests of other branches are deleted """
+        tests, words = self.Models.RepoTest.query.count(), self.Models.WordCount.query.count()
+        counts = RetentionPolicy(details_days=30).apply(self.db, self.Models)
+        self.assertEqual(counts, {
+            "units": len(self.Mokes.units), "packed": 0, "words": 9, "comments": 0, "tests": 0
+        })
+        self.assertEqual(self.Models.WordCount.query.count(), words - 9)
+        self.assertEqual(self.old_prs[0].units_as_dict, {}, "Old tests lose their units")
+        self.assertEqual(self.old_prs[1].words_count_as_dict, {}, "Old tests lose their word counts")
+        self.assertEqual(self.old_prs[1].coverage, 84.5, "Summary columns are kept")
+
+        self.db.session.add(self.Models.CommentOutbox(
+            test_id=self.old_prs[2].uuid, uri="repos/PerseusDl/canonical-latinLit/issues/3/comments", body="Hello"
+        ))
+        self.db.session.commit()
+        self.Models.TestDiff.store(self.delta, self.old_prs[2], {"Global": {}}, on_ingest=False)
+        self.Models.TestDiff.store(self.delta, self.old_prs[1], {"Global": {}})
+        self.Models.TestDiff.store(self.old_prs[2], self.delta, {"Global": {}}, on_ingest=False)
+        self.db.session.commit()
+        delta, old_prs = self.delta.uuid, [test.uuid for test in self.old_prs]
+        result = self.app.test_cli_runner().invoke(args=["hook-retention", "--pr-days", "30"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("1 comments deleted, 3 tests deleted", result.output)
+        self.assertEqual(self.Models.RepoTest.query.count(), tests - 3)
+        self.assertEqual(
+            self.Models.RepoTest.query.get(delta).words_count_as_dict, {"eng": 125, "lat": 1050, "ger": 1088},
+            "Recent tests keep their details"
+        )
+        self.assertEqual(
+            [
+                (diff.test_id, diff.base_id) for diff in self.Models.TestDiff.query.filter(self.db.or_(
+                    self.Models.TestDiff.test_id.in_(old_prs), self.Models.TestDiff.base_id.in_(old_prs)
+                ))
+            ],
+            [(delta, old_prs[1])],
+            "Comparisons with deleted tests should be deleted, diffs registered against them kept"
+        )
@@ -0,0 +1,215 @@
+from sqlalchemy import inspect
+
+from tests.baseTest import BaseTest
+from Hook.schema import missing_indexes, upgrade
+
+
+""" Tables as created by the first versions, before any column or index was added to them """
+BASELINE = [
+    """CREATE TABLE repository (
+        uuid INTEGER NOT NULL, owner VARCHAR(200) NOT NULL, name VARCHAR(200) NOT NULL, active BOOLEAN NOT NULL,
+        main_branch VARCHAR(200) NOT NULL, travis_env VARCHAR(200),
+        PRIMARY KEY (uuid), CHECK (active IN (0, 1))
+    )""",
+    """CREATE TABLE user (
+        uuid INTEGER NOT NULL, email VARCHAR(255), login VARCHAR(255) NOT NULL, git_id VARCHAR(255),
+        github_access_token VARCHAR(200) NOT NULL, avatar VARCHAR(2000), refreshed DATE,
+        PRIMARY KEY (uuid), UNIQUE (email), UNIQUE (login)
+    )""",
+    """CREATE TABLE repo_test (
+        uuid INTEGER NOT NULL, repository INTEGER NOT NULL, run_at DATETIME, source VARCHAR(250) NOT NULL,
+        sha VARCHAR(64), travis_uri VARCHAR(2000) NOT NULL, travis_build_id VARCHAR(10) NOT NULL,
+        user VARCHAR(200) NOT NULL, avatar VARCHAR(2000) NOT NULL, comment_uri VARCHAR(2000),
+        event_type VARCHAR(12) NOT NULL, texts_total INTEGER NOT NULL, texts_passing INTEGER NOT NULL,
+        metadata_total INTEGER NOT NULL, metadata_passing INTEGER NOT NULL, coverage FLOAT NOT NULL,
+        nodes_count INTEGER NOT NULL,
+        PRIMARY KEY (uuid), FOREIGN KEY(repository) REFERENCES repository (uuid)
+    )""",
+    """CREATE TABLE repoownership (
+        user_uuid INTEGER, repo_uuid INTEGER,
+        FOREIGN KEY(user_uuid) REFERENCES user (uuid), FOREIGN KEY(repo_uuid) REFERENCES repository (uuid)
+    )""",
+    """CREATE TABLE unit_test (
+        uuid INTEGER NOT NULL, test_id INTEGER, path VARCHAR(400) NOT NULL, status BOOLEAN NOT NULL,
+        PRIMARY KEY (uuid), FOREIGN KEY(test_id) REFERENCES repo_test (uuid), CHECK (status IN (0, 1))
+    )""",
+    """CREATE TABLE word_count (
+        uuid INTEGER NOT NULL, test_id INTEGER, lang VARCHAR(5) NOT NULL, count INTEGER NOT NULL,
+        PRIMARY KEY (uuid), FOREIGN KEY(test_id) REFERENCES repo_test (uuid)
+    )""",
+    "INSERT INTO repository VALUES (1, 'PerseusDl', 'canonical-latinLit', 1, 'master', 'secret')",
+    """INSERT INTO repo_test VALUES
+        (1, 1, '2017-01-01 00:00:00', 'master', 'sha1', 'https://travis-ci.org/1', '1', 'sonofmun', 'avatar', NULL,
+         'push', 2, 1, 2, 2, 75.0, 10),
+        (2, 1, '2017-01-02 00:00:00', 'issue-1', 'sha2', 'https://travis-ci.org/2', '2', 'sonofmun', 'avatar', NULL,
+         'pull_request', 2, 2, 2, 2, 100.0, 12)""",
+    """INSERT INTO unit_test VALUES
+        (1, 1, 'data/phi1294/__cts__.xml', 1), (2, 1, 'data/phi1294/phi002/__cts__.xml', 0),
+        (3, 2, 'data/phi1294/__cts__.xml', 1), (4, 2, 'data/phi1294/phi002/__cts__.xml', 1)""",
+    "INSERT INTO word_count VALUES (1, 1, 'lat', 1500), (2, 1, 'eng', 20), (3, 2, 'lat', 1600)"
+]
+
+
+class TestSchema(BaseTest):
+    def make_baseline(self):
+        """ Replace the tables by the ones of the first versions, holding two tests """
+        self.db.session.close()
+        self.db.drop_all()
+        with self.db.engine.begin() as connection:
+            for statement in BASELINE:
+                connection.execute(statement)
+
+    def drop_indexes(self, *names):
+        """ Drop indexes, as a database created before they were declared would lack them """
+        self.db.session.commit()
+        for table in self.db.metadata.sorted_tables:
+            for index in table.indexes:
+                if index.name in names:
+                    index.drop(bind=self.db.engine)
+
+    def test_upgrade(self):
+        """ Ensure missing indexes are created on existing tables """
+        self.assertEqual(missing_indexes(self.db), [], "create_all creates every index")
+        self.assertEqual(upgrade(self.db), ([], []))
+
+        self.drop_indexes("ix_repo_test_source", "ix_unit_test_path")
+        self.assertEqual(
+            [index.name for index in missing_indexes(self.db)], ["ix_repo_test_source", "ix_unit_test_path"]
+        )
+        messages = []
+        self.assertEqual(upgrade(self.db, progress=messages.append), (
+            ["ix_repo_test_source", "ix_unit_test_path"], []
+        ))
+        self.assertEqual(messages, [
+            "ix_repo_test_source created on repo_test", "ix_unit_test_path created on unit_test"
+        ])
+        self.assertIn(
+            "ix_unit_test_path", [index["name"] for index in inspect(self.db.engine).get_indexes("unit_test")]
+        )
+        self.assertEqual(self.Mokes.test1.get_unit("data/stoa0121/__cts__.xml"), False)
+
+    def test_duplicates(self):
+        """ Ensure a unique index is skipped while the table holds duplicates """
+        self.drop_indexes("ux_repository_name")
+        self.db.session.add(self.Models.Repository(owner="PerseusDl", name="canonical-greekLit"))
+        self.db.session.commit()
+
+        result = self.app.test_cli_runner().invoke(args=["hook-upgrade"])
+        self.assertEqual(result.exit_code, 1, result.output)
+        self.assertIn("ux_repository_name could not be created", result.output)
+        self.assertIn("0 indexes created, 1 failed", result.output)
+
+        duplicate = self.Models.Repository.query.filter_by(name="canonical-greekLit").order_by(
+            self.Models.Repository.uuid.desc()
+        ).first()
+        self.db.session.delete(duplicate)
+        self.db.session.commit()
+        result = self.app.test_cli_runner().invoke(args=["hook-upgrade"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("1 indexes created, 0 failed", result.output)
+        self.assertIn("2 latest tests pointed", result.output, "Pointers are rebuilt for former databases")
+
+    def test_upgrade_columns(self):
+        """ Ensure the columns added since the first versions are added to existing tables with their defaults """
+        self.make_baseline()
+        self.db.create_all()
+        messages = []
+        upgrade(self.db, progress=messages.append)
+        self.assertIn("repo_test.snapshot_depth added", messages)
+        self.assertIn("unit_test.deleted added", messages)
+        columns = {column["name"] for column in inspect(self.db.engine).get_columns("repo_test")}
+        self.assertTrue({"snapshot_parent", "snapshot_base", "snapshot_depth"}.issubset(columns))
+        self.assertEqual(
+            self.db.engine.execute(
+                "SELECT snapshot_parent, snapshot_base, snapshot_depth, units_packed FROM repo_test"
+            ).fetchall(),
+            [(None, None, 0, 0), (None, None, 0, 0)],
+            "Former tests are full snapshots"
+        )
+        self.assertEqual(
+            [deleted for deleted, in self.db.engine.execute("SELECT deleted FROM unit_test")], [0, 0, 0, 0]
+        )
+        self.assertEqual(upgrade(self.db), ([], []), "Upgrading twice should not change anything")
+
+    def test_upgrade_unit_paths(self):
+        """ Ensure the paths of former units are interned and the former path column dropped """
+        self.make_baseline()
+        self.db.create_all()
+        messages = []
+        upgrade(self.db, progress=messages.append)
+        self.assertIn("4 unit paths moved to unit_path", messages)
+        self.assertNotIn("path", [column["name"] for column in inspect(self.db.engine).get_columns("unit_test")])
+        self.assertEqual(self.Models.UnitPath.query.count(), 2, "Each path should be stored once")
+        self.assertEqual(self.Models.RepoTest.query.get(1).units_as_dict, {
+            "data/phi1294/__cts__.xml": True, "data/phi1294/phi002/__cts__.xml": False
+        })
+        self.assertEqual(self.Models.RepoTest.query.get(2).get_unit("data/phi1294/phi002/__cts__.xml"), True)
+        self.assertIn(
+            "ix_unit_test_path", [index["name"] for index in inspect(self.db.engine).get_indexes("unit_test")]
+        )
+
+        self.Models.RepoTest.query.get(2).save_units({"data/phi1294/phi003/__cts__.xml": True})
+        self.assertEqual(self.Models.UnitTest.query.count(), 5, "Units should be saved in the upgraded table")
+
+    def test_upgrade_autoincrement(self):
+        """ Ensure repo_test is rebuilt with AUTOINCREMENT, so that identifiers of deleted tests are not given again """
+        self.make_baseline()
+        self.db.create_all()
+        messages = []
+        upgrade(self.db, progress=messages.append)
+        self.assertIn("repo_test rebuilt with AUTOINCREMENT", messages)
+        self.assertIn("AUTOINCREMENT", self.db.engine.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'repo_test'"
+        ).scalar())
+        self.assertEqual(
+            [test.source for test in self.Models.RepoTest.query.order_by(self.Models.RepoTest.uuid)],
+            ["master", "issue-1"], "Tests should be kept"
+        )
+        self.assertIn(
+            "ix_repo_test_history", [index["name"] for index in inspect(self.db.engine).get_indexes("repo_test")]
+        )
+
+        self.Models.RepoTest.query.filter_by(uuid=2).delete()
+        test = self.Models.RepoTest(
+            repository=1, source="issue-2", travis_uri="https://travis-ci.org/3", travis_build_id="3",
+            user="sonofmun", avatar="avatar"
+        )
+        self.db.session.add(test)
+        self.db.session.commit()
+        self.assertEqual(test.uuid, 3, "The identifier of the deleted test should not be given again")
+
+    def test_upgrade_baseline(self):
+        """ Ensure hook-upgrade brings a database created by the first versions to the current schema """
+        self.make_baseline()
+        result = self.app.test_cli_runner().invoke(args=["hook-upgrade"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("repo_test.snapshot_depth added", result.output)
+        self.assertIn("unit paths moved to unit_path", result.output)
+        self.assertIn("0 failed", result.output)
+        self.assertIn("2 latest tests pointed", result.output)
+        self.assertEqual(missing_indexes(self.db), [])
+
+        repository = self.Models.Repository.query.get(1)
+        self.assertEqual(repository.latest_test("issue-1").uuid, 2)
+        self.assertEqual(repository.last_master_test.words_sum, 1520)
+        test, diff = repository.register_test(
+            source="master", travis_uri="https://travis-ci.org/3", travis_build_id="3", user="sonofmun",
+            avatar="avatar", texts_total=2, texts_passing=2, metadata_total=2, metadata_passing=2, coverage=100.0,
+            nodes_count=12, units={"data/phi1294/__cts__.xml": True, "data/phi1294/phi002/__cts__.xml": True},
+            words_count={"lat": 1600}, sha="sha3"
+        )
+        self.assertEqual(diff["Units"]["Changed"], [("data/phi1294/phi002/__cts__.xml", "Passing")])
+        self.assertEqual(repository.latest_test("master"), test)
+
+    def test_upgrade_words(self):
+        """ Ensure the word counts of former tests are stored on the tests """
+        self.make_baseline()
+        self.db.create_all()
+        messages = []
+        upgrade(self.db, progress=messages.append)
+        self.assertIn("2 word counts stored on their tests", messages)
+        self.assertEqual(
+            self.db.engine.execute("SELECT words_total, words_langs FROM repo_test ORDER BY uuid").fetchall(),
+            [(1520, '{"eng": 20, "lat": 1500}'), (1600, '{"lat": 1600}')]
+        )
+        self.assertEqual(self.Models.RepoTest.query.get(1).words_count_as_dict, {"eng": 20, "lat": 1500})
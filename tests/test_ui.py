@@ -270,6 +270,43 @@ class TestGithubCommunication(BaseTest):
                 "Github API is parsed correctly"
             )
 
+    def test_fetch_active_repositories(self):
+        """ Test that refreshing repositories finds the ones which are already active """
+        octodog = self.Models.Repository(owner="octocat", name="octodog", active=True)
+        self.db.session.add(octodog)
+        self.db.session.commit()
+        with self.logged_in(
+            access_token="nbiousndegoijubdognlksdngndsgmngds",
+            extra_mocks=[
+                (
+                    "get",
+                    "https://api.github.com/user/repos",
+                    dict(
+                        json=self.fixtures['./tests/fixtures/repos_ponteineptique.response.json'][0],
+                        headers=self.fixtures['./tests/fixtures/repos_ponteineptique.response.json'][1]
+                    )
+                 ),
+                (
+                    "get",
+                    re.compile("https://api.github.com/user/repos\?.*page=2"),
+                    dict(
+                        json=self.fixtures['./tests/fixtures/repos_ponteineptique.page2.response.json'][0],
+                        headers=self.fixtures['./tests/fixtures/repos_ponteineptique.page2.response.json'][1]
+                    )
+                 )
+            ]
+        ):
+            response = self.client.post("/api/hook/v2.0/user/repositories")
+            self.assertEqual(response.status_code, 200, "Refreshing should not create the active repository again")
+            self.assertIn({'name': 'octodog', 'owner': 'octocat'}, loads(response.data.decode())["repositories"])
+
+        repositories = self.Models.Repository.query.filter_by(owner="octocat", name="octodog").all()
+        self.assertEqual(len(repositories), 1, "The active repository should be reused")
+        self.assertTrue(repositories[0].active, "The repository should stay active")
+        self.assertEqual(
+            [user.login for user in repositories[0].users], ["ponteineptique"], "The user should be given access"
+        )
+
     def test_index_repositories(self):
         """ Test that index links all known repositories """
         self.Mokes.add_repo_to_pi()
@@ -530,6 +567,17 @@ class TestGithubCommunication(BaseTest):
             len(index.select("div.dl-horizontal.card div.left.success")), 1,
             "Success class should be applied"
         )
+        self.assertEqual(
+            [[cell.text for cell in row.select("td")] for row in index.select('table[aria-label="Units diff"] tbody tr')],
+            [
+                ["data/tlg0015/__cts__.xml", "Deleted"], ["data/tlg0015/tlg002/__cts__.xml", "New"],
+                ["data/tlg0015/tlg001/__cts__.xml", "Failing"],
+                ["data/tlg0015/tlg001/tlg0015.tlg001.opp-grc1.xml", "Passing"],
+                ["data/tlg0015/tlg002/__cts__.xml", "Failing"]
+            ],
+            "Stored diff should be shown once the units of the former master are dropped"
+        )
+        self.assertEqual(len(index.select('a[href="/repo/PerseusDl/canonical-latinLit/1"]')), 1)
 
         self.Mokes.make_new_latinLit_test(session=self.db.session, coverage=75.01)
         response = self.client.get("/repo/PerseusDl/canonical-latinLit/3").data.decode()